@@ -1,274 +1,346 @@
 import json
-import os
-import psycopg2
-import random
-from datetime import datetime, timedelta
+import db
+import batch
+import harvest
+import idempotency
+import leaderboard
+import ledger
+import listings
+import instrument
+import memo_codes
+import money
+import shards
+import throttle
 from decimal import Decimal
 
-def get_db_connection():
-    '''Подключение к БД'''
-    dsn = os.environ.get('DATABASE_URL')
-    return psycopg2.connect(dsn)
+# Покупка и обмен выполняются одним запросом: накопленное золото фиксируется,
+# баланс проверяется в WHERE, запись в transactions добавляется в том же CTE.
+# Строка из player без changed означает, что средств недостаточно.
+BUY_GOBLINS_SQL = f"""
+    WITH {harvest.PLAYER_CTE}, changed AS (
+        UPDATE players p
+        SET ton_balance = p.ton_balance - %(price)s,
+            goblins = p.goblins + %(goblins)s,
+            gold = p.gold + player.earned,
+            {harvest.ADVANCE_HARVEST}
+        FROM player
+        WHERE p.id = player.id AND player.ton_balance >= %(price)s
+        RETURNING p.id, p.ton_balance, p.goblins, {harvest.CHANGED_RETURNING}
+    ), {harvest.HARVEST_LOG_CTE}, logged AS (
+        INSERT INTO transactions (player_id, type, amount, description)
+        SELECT id, 'goblin_purchase', %(price)s, %(description)s FROM changed
+    )
+    SELECT player.id, changed.ton_balance, changed.goblins
+    FROM player LEFT JOIN changed ON changed.id = player.id
+"""
 
-def generate_memo():
-    '''Генерация уникального 6-значного MEMO кода'''
-    return ''.join([str(random.randint(0, 9)) for _ in range(6)])
+EXCHANGE_GOLD_SQL = f"""
+    WITH {harvest.PLAYER_CTE}, changed AS (
+        UPDATE players p
+        SET gold = p.gold + player.earned - %(amount)s,
+            goblins = p.goblins + %(goblins)s,
+            {harvest.ADVANCE_HARVEST}
+        FROM player
+        WHERE p.id = player.id AND player.gold + player.earned >= %(amount)s
+        RETURNING p.id, p.gold, p.goblins, {harvest.CHANGED_RETURNING}
+    ), {harvest.HARVEST_LOG_CTE}, logged AS (
+        INSERT INTO transactions (player_id, type, amount, description)
+        SELECT id, 'gold_exchange', %(amount)s, %(description)s FROM changed
+    )
+    SELECT player.id, changed.gold, changed.goblins
+    FROM player LEFT JOIN changed ON changed.id = player.id
+"""
 
+PACKAGES = {
+    'small': {'goblins': 3000, 'price': Decimal('1')},
+    'large': {'goblins': 15000, 'price': Decimal('5')}
+}
+
+def init(cur, body: dict) -> tuple:
+    '''Состояние игрока с учётом накопленного золота; новый игрок регистрируется'''
+    user_id = body.get('user_id')
+
+    if not user_id:
+        return 400, {'error': 'user_id обязателен'}
+
+    cur.execute(
+        "SELECT id, memo_code, goblins, gold, ton_balance, last_harvest, LOCALTIMESTAMP FROM players WHERE user_id = %s",
+        (user_id,)
+    )
+    player = cur.fetchone()
+
+    if player:
+        player_id, memo, goblins, gold, ton_balance, last_harvest, now = player
+        gold = gold + harvest.accrued(goblins, last_harvest, now)
+    else:
+        player_id, memo, goblins, gold, ton_balance = memo_codes.register(cur, user_id)
+
+    return 200, {
+        'player_id': player_id,
+        'memo': memo,
+        'goblins': goblins,
+        'gold': gold,
+        'ton_balance': ton_balance
+    }
+
+def buy_goblins(cur, body: dict) -> tuple:
+    '''Покупка пакета гоблинов за TON'''
+    user_id = body.get('user_id')
+    package = body.get('package')
+
+    if package not in PACKAGES:
+        return 400, {'error': 'Неверный пакет'}
+
+    pkg = PACKAGES[package]
+
+    cur.execute(BUY_GOBLINS_SQL, {
+        'user_id': user_id,
+        'price': pkg['price'],
+        'goblins': pkg['goblins'],
+        'description': f"Куплено {pkg['goblins']} гоблинов"
+    })
+    player = cur.fetchone()
+
+    if not player:
+        return 404, {'error': 'Игрок не найден'}
+
+    player_id, new_balance, new_goblins = player
+
+    if new_balance is None:
+        return 400, {'error': 'Недостаточно TON'}
+
+    return 200, {
+        'success': True,
+        'new_balance': new_balance,
+        'new_goblins': new_goblins
+    }
+
+def exchange_gold(cur, body: dict) -> tuple:
+    '''Обмен золота на гоблинов: 100 кг -> 95 гоблинов'''
+    user_id = body.get('user_id')
+    try:
+        gold_amount = money.gold(body.get('gold_amount', 0))
+    except money.MoneyError as e:
+        return 400, {'error': str(e)}
+
+    if gold_amount < 100:
+        return 400, {'error': 'Минимум 100 кг золота'}
+
+    goblins_received = int(gold_amount * 95 / 100)
+
+    cur.execute(EXCHANGE_GOLD_SQL, {
+        'user_id': user_id,
+        'amount': gold_amount,
+        'goblins': goblins_received,
+        'description': f"Обменяно {gold_amount} кг золота на {goblins_received} гоблинов"
+    })
+    player = cur.fetchone()
+
+    if not player:
+        return 404, {'error': 'Игрок не найден'}
+
+    player_id, new_gold, new_goblins = player
+
+    if new_gold is None:
+        return 400, {'error': 'Недостаточно золота'}
+
+    return 200, {
+        'success': True,
+        'new_gold': new_gold,
+        'new_goblins': new_goblins,
+        'goblins_received': goblins_received
+    }
+
+def history(cur, params: dict) -> tuple:
+    '''История операций игрока с keyset-пагинацией'''
+    if not params.get('user_id'):
+        return 400, {'error': 'user_id обязателен'}
+    try:
+        return 200, ledger.fetch_history(cur, params)
+    except ledger.HistoryError as e:
+        return 400, {'error': str(e)}
+
+def rating(cur, params: dict) -> tuple:
+    '''Первые места рейтинга и место игрока, если передан user_id'''
+    cluster = shards.cluster()
+    own = cluster.shard_of(cur.connection)
+    remote = [shard for shard in range(cluster.count) if shard != own]
+    try:
+        with cluster.cursors(remote, cursor_factory=instrument.TimedCursor) as remote_cursors:
+            return 200, leaderboard.leaderboard(cur, params, remote_cursors)
+    except leaderboard.LeaderboardError as e:
+        return 400, {'error': str(e)}
+
+def listings_page(cur, params: dict) -> tuple:
+    '''Страница ленты маркета только для чтения: её можно взять одним пакетом с init'''
+    cluster = shards.cluster()
+    own = cluster.shard_of(cur.connection)
+    remote = [shard for shard in range(cluster.count) if shard != own]
+    try:
+        with cluster.cursors(remote, cursor_factory=instrument.TimedCursor) as remote_cursors:
+            return 200, listings.fetch_page(cur, params, remote_cursors)
+    except listings.PageError as e:
+        return 400, {'error': str(e)}
+
+# Действие -> (HTTP-метод, обработчик). Обработчик получает тело POST или
+# параметры GET и возвращает (статус, тело ответа); коммитит вызывающий код
+ACTIONS = {
+    'init': ('POST', init),
+    'buy-goblins': ('POST', buy_goblins),
+    'exchange-gold': ('POST', exchange_gold),
+    'history': ('GET', history),
+    'leaderboard': ('GET', rating),
+    'listings': ('GET', listings_page),
+}
+
+# Действия, повтор которых по Idempotency-Key отдаёт сохранённый ответ
+IDEMPOTENT = {'buy-goblins', 'exchange-gold'}
+
+# Одновременные init одного игрока в экземпляре выполняются один раз
+inits = throttle.SingleFlight()
+
+def run_init(data: dict) -> tuple:
+    '''init на отдельном соединении: результат может достаться нескольким запросам'''
+    cluster = shards.cluster()
+    conn = cluster.acquire(cluster.for_user(data.get('user_id')))
+    try:
+        with conn.cursor(cursor_factory=instrument.TimedCursor) as cur:
+            status, payload = init(cur, data)
+        if status < 400:
+            instrument.commit(conn)
+        return status, payload
+    finally:
+        db.release(conn)
+
+# Ответ на preflight один на все запросы; instrument его не трогает
+PREFLIGHT = {
+    'statusCode': 200,
+    'headers': {
+        'Access-Control-Allow-Origin': '*',
+        'Access-Control-Allow-Methods': 'GET, POST, OPTIONS',
+        'Access-Control-Allow-Headers': 'Content-Type, X-User-Id, Idempotency-Key'
+    },
+    'body': '',
+    'isBase64Encoded': False
+}
+
+@instrument.instrumented('game-api', 'init')
 def handler(event: dict, context) -> dict:
     '''API для игровой логики: регистрация, начисление золота, покупка гоблинов'''
-    
+
     method = event.get('httpMethod', 'GET')
-    
+
     if method == 'OPTIONS':
-        return {
-            'statusCode': 200,
-            'headers': {
-                'Access-Control-Allow-Origin': '*',
-                'Access-Control-Allow-Methods': 'GET, POST, OPTIONS',
-                'Access-Control-Allow-Headers': 'Content-Type, X-User-Id'
-            },
-            'body': '',
-            'isBase64Encoded': False
-        }
-    
+        return PREFLIGHT
+
     headers = {
         'Content-Type': 'application/json',
         'Access-Control-Allow-Origin': '*'
     }
-    
+
     try:
-        conn = get_db_connection()
-        cur = conn.cursor()
-        
         query_params = event.get('queryStringParameters') or {}
         action = query_params.get('action', 'init')
-        
-        if action == 'init' and method == 'POST':
-            body = json.loads(event.get('body', '{}'))
-            user_id = body.get('user_id')
-            
-            if not user_id:
-                return {
-                    'statusCode': 400,
-                    'headers': headers,
-                    'body': json.dumps({'error': 'user_id обязателен'}),
-                    'isBase64Encoded': False
-                }
-            
-            cur.execute("SELECT id, memo_code, goblins, gold, ton_balance, last_harvest FROM players WHERE user_id = %s", (user_id,))
-            player = cur.fetchone()
-            
-            if player:
-                player_id, memo, goblins, gold, ton_balance, last_harvest = player
-                
-                now = datetime.now()
-                hours_passed = (now - last_harvest).total_seconds() / 3600
-                
-                if hours_passed >= 1:
-                    gold_earned = Decimal(str(goblins * 0.014 * int(hours_passed)))
-                    new_gold = float(gold) + float(gold_earned)
-                    
-                    cur.execute(
-                        "UPDATE players SET gold = %s, last_harvest = %s WHERE id = %s",
-                        (new_gold, now, player_id)
-                    )
-                    
-                    cur.execute(
-                        "INSERT INTO gold_harvests (player_id, gold_earned, goblins_count) VALUES (%s, %s, %s)",
-                        (player_id, float(gold_earned), goblins)
-                    )
-                    
-                    conn.commit()
-                    gold = new_gold
-                
-                return {
-                    'statusCode': 200,
-                    'headers': headers,
-                    'body': json.dumps({
-                        'player_id': player_id,
-                        'memo': memo,
-                        'goblins': goblins,
-                        'gold': float(gold),
-                        'ton_balance': float(ton_balance)
-                    }),
-                    'isBase64Encoded': False
-                }
-            
-            else:
-                memo = generate_memo()
-                while True:
-                    cur.execute("SELECT id FROM players WHERE memo_code = %s", (memo,))
-                    if not cur.fetchone():
-                        break
-                    memo = generate_memo()
-                
-                cur.execute(
-                    "INSERT INTO players (user_id, memo_code) VALUES (%s, %s) RETURNING id, goblins, gold, ton_balance",
-                    (user_id, memo)
-                )
-                player_id, goblins, gold, ton_balance = cur.fetchone()
-                conn.commit()
-                
-                return {
-                    'statusCode': 200,
-                    'headers': headers,
-                    'body': json.dumps({
-                        'player_id': player_id,
-                        'memo': memo,
-                        'goblins': goblins,
-                        'gold': float(gold),
-                        'ton_balance': float(ton_balance)
-                    }),
-                    'isBase64Encoded': False
-                }
-        
-        elif action == 'buy-goblins' and method == 'POST':
-            body = json.loads(event.get('body', '{}'))
-            user_id = body.get('user_id')
-            package = body.get('package')
-            
-            packages = {
-                'small': {'goblins': 3000, 'price': 1},
-                'large': {'goblins': 15000, 'price': 5}
-            }
-            
-            if package not in packages:
-                return {
-                    'statusCode': 400,
-                    'headers': headers,
-                    'body': json.dumps({'error': 'Неверный пакет'}),
-                    'isBase64Encoded': False
-                }
-            
-            pkg = packages[package]
-            
-            cur.execute("SELECT id, ton_balance, goblins FROM players WHERE user_id = %s", (user_id,))
-            player = cur.fetchone()
-            
-            if not player:
-                return {
-                    'statusCode': 404,
-                    'headers': headers,
-                    'body': json.dumps({'error': 'Игрок не найден'}),
-                    'isBase64Encoded': False
-                }
-            
-            player_id, ton_balance, current_goblins = player
-            
-            if float(ton_balance) < pkg['price']:
+        data = json.loads(event.get('body', '{}')) if method == 'POST' else query_params
+
+        user_id = data.get('user_id')
+        if user_id:
+            # Пакет расходует по жетону на каждое действие
+            actions = data.get('actions') if action == 'batch' else None
+            cost = min(len(actions), batch.MAX_ACTIONS) if isinstance(actions, list) and actions else 1
+            wait = throttle.wait(str(user_id), cost)
+            if wait:
+                headers['Retry-After'] = throttle.retry_after(wait)
+                headers['Access-Control-Expose-Headers'] = 'Retry-After'
                 return {
-                    'statusCode': 400,
+                    'statusCode': 429,
                     'headers': headers,
-                    'body': json.dumps({'error': 'Недостаточно TON'}),
+                    'body': money.error_body('Слишком много запросов, повторите позже'),
                     'isBase64Encoded': False
                 }
-            
-            new_balance = float(ton_balance) - pkg['price']
-            new_goblins = current_goblins + pkg['goblins']
-            
-            cur.execute(
-                "UPDATE players SET ton_balance = %s, goblins = %s WHERE id = %s",
-                (new_balance, new_goblins, player_id)
-            )
-            
-            cur.execute(
-                "INSERT INTO transactions (player_id, type, amount, description) VALUES (%s, %s, %s, %s)",
-                (player_id, 'goblin_purchase', pkg['price'], f"Куплено {pkg['goblins']} гоблинов")
-            )
-            
-            conn.commit()
-            
+
+        if action == 'init' and method == 'POST' and user_id:
+            status, payload = inits.do(str(user_id), lambda: run_init(data))
+            with instrument.span('serialize'):
+                response_body = money.dumps(payload)
             return {
-                'statusCode': 200,
+                'statusCode': status,
                 'headers': headers,
-                'body': json.dumps({
-                    'success': True,
-                    'new_balance': new_balance,
-                    'new_goblins': new_goblins
-                }),
+                'body': response_body,
                 'isBase64Encoded': False
             }
-        
-        elif action == 'exchange-gold' and method == 'POST':
-            body = json.loads(event.get('body', '{}'))
-            user_id = body.get('user_id')
-            gold_amount = float(body.get('gold_amount', 0))
-            
-            if gold_amount < 100:
-                return {
-                    'statusCode': 400,
-                    'headers': headers,
-                    'body': json.dumps({'error': 'Минимум 100 кг золота'}),
-                    'isBase64Encoded': False
-                }
-            
-            cur.execute("SELECT id, gold, goblins FROM players WHERE user_id = %s", (user_id,))
-            player = cur.fetchone()
-            
-            if not player:
-                return {
-                    'statusCode': 404,
-                    'headers': headers,
-                    'body': json.dumps({'error': 'Игрок не найден'}),
-                    'isBase64Encoded': False
-                }
-            
-            player_id, current_gold, current_goblins = player
-            
-            if float(current_gold) < gold_amount:
-                return {
-                    'statusCode': 400,
-                    'headers': headers,
-                    'body': json.dumps({'error': 'Недостаточно золота'}),
-                    'isBase64Encoded': False
-                }
-            
-            goblins_received = int((gold_amount / 100) * 95)
-            new_gold = float(current_gold) - gold_amount
-            new_goblins = current_goblins + goblins_received
-            
-            cur.execute(
-                "UPDATE players SET gold = %s, goblins = %s WHERE id = %s",
-                (new_gold, new_goblins, player_id)
-            )
-            
-            cur.execute(
-                "INSERT INTO transactions (player_id, type, amount, description) VALUES (%s, %s, %s, %s)",
-                (player_id, 'gold_exchange', gold_amount, f"Обменяно {gold_amount} кг золота на {goblins_received} гоблинов")
-            )
-            
-            conn.commit()
-            
+
+        idem = None
+        if method == 'POST' and action in IDEMPOTENT:
+            idem = idempotency.from_event(event, 'game-api', action, data)
+        if idem:
+            stored = idempotency.cache.get(idem)
+            if stored:
+                return idempotency.replay(stored, headers)
+
+        # Все действия запроса идут на узел игрока; у пакета игрок один
+        cluster = shards.cluster()
+        if action == 'batch' and cluster.count > 1 and not batch.single_user(data):
             return {
-                'statusCode': 200,
+                'statusCode': 400,
                 'headers': headers,
-                'body': json.dumps({
-                    'success': True,
-                    'new_gold': new_gold,
-                    'new_goblins': new_goblins,
-                    'goblins_received': goblins_received
-                }),
+                'body': money.error_body('Все действия пакета должны быть одного игрока'),
                 'isBase64Encoded': False
             }
-        
+        with instrument.span('connect'):
+            conn = cluster.acquire(cluster.for_user(user_id))
+        cur = conn.cursor(cursor_factory=instrument.TimedCursor)
+
+        if action == 'batch' and method == 'POST':
+            status, payload, _ = batch.run(conn, cur, ACTIONS, data)
+
+        elif action in ACTIONS and ACTIONS[action][0] == method:
+            if idem:
+                stored = idempotency.claim(cur, idem)
+                if stored:
+                    return idempotency.replay(stored, headers)
+            status, payload = ACTIONS[action][1](cur, data)
+            if status < 400 and method == 'POST':
+                if idem:
+                    stored = idempotency.store(cur, idem, status, payload)
+                instrument.commit(conn)
+                if idem:
+                    idempotency.cache.put(idem, stored)
+
         else:
-            return {
-                'statusCode': 404,
-                'headers': headers,
-                'body': json.dumps({'error': 'Endpoint не найден'}),
-                'isBase64Encoded': False
-            }
-    
+            status, payload = 404, {'error': 'Endpoint не найден'}
+
+        with instrument.span('serialize'):
+            response_body = money.dumps(payload)
+
+        return {
+            'statusCode': status,
+            'headers': headers,
+            'body': response_body,
+            'isBase64Encoded': False
+        }
+
+    except idempotency.IdempotencyError as e:
+        if e.status_code == 409:
+            headers['Retry-After'] = '1'
+        return {
+            'statusCode': e.status_code,
+            'headers': headers,
+            'body': money.error_body(str(e)),
+            'isBase64Encoded': False
+        }
+
     except Exception as e:
+        instrument.fail(e)
         return {
             'statusCode': 500,
             'headers': headers,
             'body': json.dumps({'error': str(e)}),
             'isBase64Encoded': False
         }
-    
+
     finally:
         if 'cur' in locals():
             cur.close()
         if 'conn' in locals():
-            conn.close()
\ No newline at end of file
+            db.release(conn)
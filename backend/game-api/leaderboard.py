@@ -0,0 +1,247 @@
+'''Рейтинг игроков по гоблинам и по золоту с учётом ненакопленного начисления.
+
+Пересчёт снимка по крону:
+    python leaderboard.py --top 100 --bucket 100
+
+Полная сортировка игроков идёт только здесь. В leaderboard_ranks пишутся первые
+--top позиций целиком, затем каждая --bucket-я позиция и последняя. Место игрока
+считается по его текущему значению: ближайшие строки снимка выше и ниже него
+находятся по индексу (metric, value), поэтому поиск O(log n). В пределах top
+место точное, дальше — интерполяция между границами корзины.
+'''
+import argparse
+import os
+import threading
+import time
+import psycopg2
+import harvest
+
+DEFAULT_TOP = 100
+DEFAULT_BUCKET = 100
+DEFAULT_LIMIT = 50
+CACHE_TTL = float(os.environ.get('LEADERBOARD_CACHE_TTL', '10'))
+
+# Рейтинг -> значение игрока; золото считается теми же фрагментами harvest, что и PLAYER_CTE
+METRICS = {
+    'goblins': "goblins",
+    'gold': f"gold + {harvest.earned_sql(hours=harvest.hours_sql())}",
+}
+
+REFRESH_SQL = """
+    WITH ranked AS (
+        SELECT id, RIGHT(user_id, 4) AS tag, value,
+               ROW_NUMBER() OVER (ORDER BY value DESC, id) AS position,
+               RANK() OVER (ORDER BY value DESC) AS rank,
+               COUNT(*) OVER () AS total
+        FROM (SELECT id, user_id, {value} AS value FROM players) p
+    ), stored AS (
+        INSERT INTO leaderboard_ranks (metric, position, rank, player_id, player_tag, value)
+        SELECT %(metric)s, position, rank, id, tag, value
+        FROM ranked
+        WHERE position <= %(top)s OR position %% %(bucket)s = 0 OR position = total
+        RETURNING position
+    )
+    INSERT INTO leaderboard_state (metric, players, top_size, refreshed_at)
+    SELECT %(metric)s, COALESCE(MAX(position), 0), %(top)s, LOCALTIMESTAMP FROM stored
+    ON CONFLICT (metric) DO UPDATE
+    SET players = EXCLUDED.players, top_size = EXCLUDED.top_size, refreshed_at = EXCLUDED.refreshed_at
+    RETURNING players
+"""
+
+TOP_SQL = """
+    SELECT l.rank, l.player_tag, l.value, s.refreshed_at
+    FROM leaderboard_state s
+    LEFT JOIN leaderboard_ranks l ON l.metric = s.metric AND l.position <= LEAST(%s, s.top_size)
+    WHERE s.metric = %s
+    ORDER BY l.position
+"""
+
+# above — последняя строка снимка со значением больше value, below — первая не больше
+RANK_SQL = """
+    SELECT above.position, above.value, below.position, below.value, s.players, own.value
+    FROM leaderboard_state s
+    LEFT JOIN LATERAL (
+        SELECT position, value FROM leaderboard_ranks
+        WHERE metric = %(metric)s AND value > %(value)s
+        ORDER BY value ASC, position DESC
+        LIMIT 1
+    ) above ON true
+    LEFT JOIN LATERAL (
+        SELECT position, value FROM leaderboard_ranks
+        WHERE metric = %(metric)s AND value <= %(value)s
+        ORDER BY value DESC, position ASC
+        LIMIT 1
+    ) below ON true
+    LEFT JOIN leaderboard_ranks own ON own.player_id = %(player_id)s AND own.metric = s.metric
+    WHERE s.metric = %(metric)s
+"""
+
+
+class LeaderboardError(ValueError):
+    '''Некорректные параметры рейтинга'''
+
+
+class TopCache:
+    '''Первые места рейтинга в памяти экземпляра; снимок всё равно обновляется по крону'''
+
+    def __init__(self, ttl: float = CACHE_TTL):
+        self.ttl = ttl
+        self._entries = {}
+        self._lock = threading.Lock()
+
+    def get(self, key: tuple):
+        with self._lock:
+            entry = self._entries.get(key)
+        if entry is None or time.monotonic() - entry[0] > self.ttl:
+            return None
+        return entry[1]
+
+    def put(self, key: tuple, value: dict):
+        with self._lock:
+            self._entries[key] = (time.monotonic(), value)
+
+
+cache = TopCache()
+
+
+def _fetch_top(cur, metric: str, limit: int) -> dict:
+    cur.execute(TOP_SQL, (limit, metric))
+    rows = cur.fetchall()
+    return {
+        'refreshed_at': rows[0][3].isoformat() if rows else None,
+        'top': [
+            {'rank': rank, 'player': f"Player#{tag}", 'value': _value(metric, value)}
+            for rank, tag, value, _ in rows if rank is not None
+        ],
+    }
+
+
+def merge_tops(results: list, limit: int) -> dict:
+    '''Первые места по нескольким узлам: у каждого узла снимок своих игроков'''
+    if len(results) == 1:
+        return results[0]
+    entries = sorted((entry for result in results for entry in result['top']),
+                     key=lambda entry: entry['value'], reverse=True)[:limit]
+    merged = []
+    for index, entry in enumerate(entries):
+        tied = merged and merged[-1]['value'] == entry['value']
+        merged.append(dict(entry, rank=merged[-1]['rank'] if tied else index + 1))
+    refreshed = [result['refreshed_at'] for result in results if result['refreshed_at']]
+    return {'refreshed_at': min(refreshed) if refreshed else None, 'top': merged}
+
+
+def top(cursors: list, metric: str, limit: int) -> dict:
+    '''Первые limit мест из снимков всех узлов'''
+    cached = cache.get((metric, limit))
+    if cached is not None:
+        return cached
+
+    result = merge_tops([_fetch_top(cur, metric, limit) for cur in cursors], limit)
+    cache.put((metric, limit), result)
+    return result
+
+
+def position(cur, metric: str, value, player_id=None):
+    '''Место значения среди снимка узла; None, если снимка ещё нет'''
+    cur.execute(RANK_SQL, {'metric': metric, 'player_id': player_id, 'value': value})
+    row = cur.fetchone()
+    if not row:
+        return None
+    above_pos, above_value, below_pos, below_value, players, own_value = row
+
+    if above_pos is None:
+        rank, exact = 1, True
+    elif below_pos is None or below_pos == above_pos + 1:
+        # Все, кто выше, есть в снимке построчно
+        rank, exact = above_pos + 1, True
+    else:
+        # Между границами корзины: доля пропущенных позиций пропорционально значению
+        share = (above_value - value) / (above_value - below_value)
+        rank, exact = above_pos + 1 + int((below_pos - above_pos - 1) * share), False
+    if own_value is not None and own_value > value:
+        # Сам игрок в снимке со старым значением выше текущего
+        rank -= 1
+    return {'rank': max(rank, 1), 'exact': exact, 'players': players}
+
+
+def player_rank(cur, metric: str, user_id: str, remote: list = ()):
+    '''Место игрока по его текущему значению среди снимка; None, если игрока нет.
+
+    remote — курсоры остальных узлов: на каждом считается, сколько игроков выше
+    того же значения, и места складываются.
+    '''
+    cur.execute(
+        "SELECT id, goblins, gold, last_harvest, LOCALTIMESTAMP FROM players WHERE user_id = %s",
+        (user_id,)
+    )
+    player = cur.fetchone()
+    if not player:
+        return None
+    player_id, goblins, gold, last_harvest, now = player
+    value = goblins if metric == 'goblins' else gold + harvest.accrued(goblins, last_harvest, now)
+
+    me = position(cur, metric, value, player_id)
+    if me is None:
+        return {'value': _value(metric, value), 'rank': None, 'exact': False}
+    for other in remote:
+        there = position(other, metric, value)
+        if there is None:
+            me['exact'] = False
+            continue
+        me['rank'] += there['rank'] - 1
+        me['exact'] = me['exact'] and there['exact']
+        me['players'] += there['players']
+
+    return {'value': _value(metric, value), **me}
+
+
+def _value(metric: str, value):
+    return int(value) if metric == 'goblins' else value
+
+
+def leaderboard(cur, params: dict, remote: list = ()) -> dict:
+    '''Рейтинг; cur — узел игрока из user_id, remote — курсоры остальных узлов'''
+    metric = params.get('metric', 'gold')
+    if not isinstance(metric, str) or metric not in METRICS:
+        raise LeaderboardError('Неверный рейтинг')
+    try:
+        limit = min(max(int(params.get('limit', DEFAULT_LIMIT)), 1), DEFAULT_TOP)
+    except (TypeError, ValueError):
+        raise LeaderboardError('Неверный limit')
+
+    result = dict(top([cur, *remote], metric, limit), metric=metric)
+    if params.get('user_id'):
+        result['me'] = player_rank(cur, metric, params['user_id'], remote)
+    return result
+
+
+def refresh(conn, top_size: int = DEFAULT_TOP, bucket: int = DEFAULT_BUCKET) -> dict:
+    '''Пересчитывает снимок каждого рейтинга в отдельной транзакции'''
+    stats = {}
+    with conn.cursor() as cur:
+        for metric, value in METRICS.items():
+            cur.execute("DELETE FROM leaderboard_ranks WHERE metric = %s", (metric,))
+            cur.execute(REFRESH_SQL.format(value=value), {'metric': metric, 'top': top_size, 'bucket': bucket})
+            stats[metric] = cur.fetchone()[0]
+            conn.commit()
+    return stats
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Пересчёт снимка рейтинга игроков')
+    parser.add_argument('--top', type=int, default=DEFAULT_TOP, help='сколько первых мест хранить построчно')
+    parser.add_argument('--bucket', type=int, default=DEFAULT_BUCKET, help='шаг позиций между границами корзин')
+    args = parser.parse_args()
+
+    conn = psycopg2.connect(os.environ.get('DATABASE_URL'))
+    try:
+        started = time.monotonic()
+        stats = refresh(conn, args.top, args.bucket)
+        stats['seconds'] = round(time.monotonic() - started, 3)
+        print(stats)
+    finally:
+        conn.close()
+
+
+if __name__ == '__main__':
+    main()
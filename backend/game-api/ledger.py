@@ -0,0 +1,209 @@
+'''История операций игрока и обслуживание секций transactions и gold_harvests.
+
+Обслуживание по крону:
+    python ledger.py --months-ahead 3 --keep-months 3
+
+Создаёт помесячные секции на текущий и months-ahead следующих месяцев, а также
+на месяцы, чьи строки уже попали в DEFAULT из-за пропущенного запуска (строки
+переносятся в новую секцию), и сворачивает секции
+gold_harvests, целиком лежащие раньше keep-months последних месяцев, в дневные
+итоги gold_harvest_daily. Свёртка и удаление секции идут в одной транзакции,
+поэтому повторный запуск ничего не задвоит.
+'''
+import argparse
+import base64
+import os
+import re
+import time
+from datetime import datetime
+import psycopg2
+from psycopg2 import sql
+
+DEFAULT_LIMIT = 50
+MAX_LIMIT = 100
+DEFAULT_DAYS = 90
+MAX_DAYS = 366
+
+# Таблицы, секционированные по месяцам в V0008, и их ключи секционирования
+PARTITIONED = {'transactions': 'created_at', 'gold_harvests': 'harvested_at'}
+
+# Месяцы, строки которых лежат в DEFAULT, и месяцы от текущего на months_ahead вперёд
+MONTHS_SQL = """
+    SELECT DISTINCT date_trunc('month', {key})::date FROM {default}
+    UNION
+    SELECT (date_trunc('month', LOCALTIMESTAMP) + i * INTERVAL '1 month')::date
+    FROM generate_series(0, %s) AS i
+    ORDER BY 1
+"""
+
+# Нижняя граница по времени отсекает старые секции, граница курсора — более новые;
+# player_id берётся подзапросом, чтобы секции читались по индексу уже в нужном порядке
+HISTORY_SQL = """
+    SELECT t.id, t.type, t.amount, t.description, t.created_at
+    FROM transactions t
+    WHERE t.player_id = (SELECT id FROM players WHERE user_id = %s)
+      AND t.created_at >= LOCALTIMESTAMP - %s * INTERVAL '1 day' {conditions}
+    ORDER BY t.created_at DESC, t.id DESC
+    LIMIT %s
+"""
+
+PARTITIONS_SQL = """
+    SELECT c.relname, pg_get_expr(c.relpartbound, c.oid)
+    FROM pg_inherits i
+    JOIN pg_class c ON c.oid = i.inhrelid
+    WHERE i.inhparent = %s::regclass
+    ORDER BY c.relname
+"""
+
+COMPACT_SQL = """
+    INSERT INTO gold_harvest_daily (player_id, day, gold_earned, harvests)
+    SELECT player_id, harvested_at::date, SUM(gold_earned), COUNT(*)
+    FROM {partition}
+    WHERE player_id IS NOT NULL
+    GROUP BY player_id, harvested_at::date
+    ON CONFLICT (player_id, day) DO UPDATE
+    SET gold_earned = gold_harvest_daily.gold_earned + EXCLUDED.gold_earned,
+        harvests = gold_harvest_daily.harvests + EXCLUDED.harvests
+"""
+
+UPPER_BOUND = re.compile(r"TO \('([^']+)'\)")
+
+
+class HistoryError(ValueError):
+    '''Некорректные параметры истории'''
+
+
+def encode_cursor(created_at: datetime, transaction_id: int) -> str:
+    raw = f'{created_at.isoformat()}|{transaction_id}'
+    return base64.urlsafe_b64encode(raw.encode()).decode().rstrip('=')
+
+
+def decode_cursor(cursor: str) -> tuple:
+    try:
+        padded = cursor + '=' * (-len(cursor) % 4)
+        created_at, transaction_id = base64.urlsafe_b64decode(padded).decode().split('|')
+        return datetime.fromisoformat(created_at), int(transaction_id)
+    except (TypeError, ValueError):
+        raise HistoryError('Некорректный курсор')
+
+
+def fetch_history(cur, params: dict) -> dict:
+    '''Страница истории операций игрока, новые сверху'''
+    try:
+        limit = min(max(int(params.get('limit', DEFAULT_LIMIT)), 1), MAX_LIMIT)
+        days = min(max(int(params.get('days', DEFAULT_DAYS)), 1), MAX_DAYS)
+    except (TypeError, ValueError):
+        raise HistoryError('Неверный limit или days')
+
+    conditions = []
+    args = [params.get('user_id'), days]
+    if params.get('type'):
+        if not isinstance(params['type'], str):
+            raise HistoryError('Неверный type')
+        conditions.append("AND t.type = %s")
+        args.append(params['type'])
+    if params.get('cursor'):
+        created_at, transaction_id = decode_cursor(params['cursor'])
+        conditions.append("AND t.created_at <= %s AND (t.created_at, t.id) < (%s, %s)")
+        args.extend([created_at, created_at, transaction_id])
+    # Лишняя строка показывает, есть ли следующая страница
+    args.append(limit + 1)
+
+    cur.execute(HISTORY_SQL.format(conditions=' '.join(conditions)), args)
+    rows = cur.fetchall()
+
+    next_cursor = None
+    if len(rows) > limit:
+        rows = rows[:limit]
+        next_cursor = encode_cursor(rows[-1][4], rows[-1][0])
+
+    history = []
+    for transaction_id, kind, amount, description, created_at in rows:
+        history.append({
+            'id': transaction_id,
+            'type': kind,
+            'amount': amount,
+            'description': description,
+            'created_at': created_at.isoformat()
+        })
+    return {'history': history, 'next_cursor': next_cursor}
+
+
+def partitions(cur, parent: str) -> list:
+    '''Секции таблицы и верхние границы их диапазонов; у DEFAULT граница None'''
+    cur.execute(PARTITIONS_SQL, (parent,))
+    result = []
+    for name, bound in cur.fetchall():
+        match = UPPER_BOUND.search(bound)
+        result.append((name, datetime.fromisoformat(match.group(1)) if match else None))
+    return result
+
+
+def ensure_partitions(conn, months_ahead: int) -> list:
+    '''Создаёт недостающие помесячные секции и забирает в них строки из DEFAULT'''
+    created = []
+    with conn.cursor() as cur:
+        for parent, key in PARTITIONED.items():
+            bounds = dict(partitions(cur, parent))
+            # Месяцы до верхней границы *_legacy уже покрыты ею
+            legacy_upper = bounds.get(parent + '_legacy')
+            cur.execute(
+                sql.SQL(MONTHS_SQL).format(key=sql.Identifier(key), default=sql.Identifier(parent + '_default')),
+                (months_ahead,)
+            )
+            for (month,) in cur.fetchall():
+                if legacy_upper is not None and month < legacy_upper.date():
+                    continue
+                cur.execute("SELECT create_month_partition(%s, %s)", (parent, month))
+                name = cur.fetchone()[0]
+                if name not in bounds:
+                    created.append(name)
+    conn.commit()
+    return created
+
+
+def compact_harvests(conn, keep_months: int) -> list:
+    '''Сворачивает старые секции gold_harvests в дневные итоги и удаляет их'''
+    compacted = []
+    with conn.cursor() as cur:
+        cur.execute(
+            "SELECT date_trunc('month', LOCALTIMESTAMP) - %s * INTERVAL '1 month'",
+            (keep_months,)
+        )
+        cutoff = cur.fetchone()[0]
+        conn.commit()
+
+        for name, upper in partitions(cur, 'gold_harvests'):
+            if upper is None or upper > cutoff:
+                continue
+            partition = sql.Identifier(name)
+            cur.execute(sql.SQL(COMPACT_SQL).format(partition=partition))
+            cur.execute(sql.SQL("DROP TABLE {partition}").format(partition=partition))
+            conn.commit()
+            compacted.append(name)
+    return compacted
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Обслуживание секций журналов операций и начислений')
+    parser.add_argument('--months-ahead', type=int, default=3)
+    parser.add_argument('--keep-months', type=int, default=3, help='сколько последних месяцев начислений хранить построчно')
+    args = parser.parse_args()
+    if args.keep_months < 1:
+        parser.error('--keep-months должен быть не меньше 1')
+
+    conn = psycopg2.connect(os.environ.get('DATABASE_URL'))
+    try:
+        started = time.monotonic()
+        stats = {
+            'created': ensure_partitions(conn, args.months_ahead),
+            'compacted': compact_harvests(conn, args.keep_months),
+            'seconds': round(time.monotonic() - started, 3),
+        }
+        print(stats)
+    finally:
+        conn.close()
+
+
+if __name__ == '__main__':
+    main()
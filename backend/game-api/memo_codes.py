@@ -0,0 +1,49 @@
+'''Выдача MEMO кодов за один INSERT без перебора свободных кодов.
+
+Код — это номер из последовательности memo_seq, переставленный аффинным
+отображением n -> (MULTIPLIER * n + OFFSET) mod 10**MEMO_DIGITS. Множитель
+взаимно прост с 10, поэтому отображение биективно: разные номера всегда дают
+разные коды, и стоимость выдачи не растёт с заполнением пространства.
+Конфликт возможен только со случайными кодами, выданными до перехода на
+последовательность; такой номер пропускается и берётся следующий.
+
+Расширение пространства кодов, когда memo_seq приближается к MAXVALUE:
+  1. ALTER TABLE players ALTER COLUMN memo_code TYPE VARCHAR(8);
+  2. ALTER SEQUENCE memo_seq MAXVALUE 99999999;
+  3. выставить MEMO_DIGITS=8 у функции game-api.
+Новые коды длиннее старых и поэтому не пересекаются с уже выданными;
+последовательность продолжает счёт без сброса.
+'''
+import os
+
+MEMO_DIGITS = int(os.environ.get('MEMO_DIGITS', '6'))
+MEMO_SPACE = 10 ** MEMO_DIGITS
+MULTIPLIER = 741103
+OFFSET = 382719
+MAX_ATTEMPTS = 16
+
+# Следующий код из memo_seq; MOD вместо %, чтобы фрагмент подходил и запросам
+# без параметров (tools/snapshot.py, tools/bench.py)
+NEXT_MEMO_SQL = f"LPAD(MOD(nextval('memo_seq') * {MULTIPLIER} + {OFFSET}, {MEMO_SPACE})::text, {MEMO_DIGITS}, '0')"
+
+REGISTER_SQL = f"""
+    INSERT INTO players (user_id, memo_code)
+    VALUES (%s, {NEXT_MEMO_SQL})
+    ON CONFLICT DO NOTHING
+    RETURNING id, memo_code, goblins, gold, ton_balance
+"""
+
+
+def register(cur, user_id: str) -> tuple:
+    '''Создаёт игрока с новым MEMO кодом; при гонке регистраций возвращает уже созданного'''
+    for _ in range(MAX_ATTEMPTS):
+        cur.execute(REGISTER_SQL, (user_id,))
+        player = cur.fetchone()
+        if player:
+            return player
+        # Конфликт по user_id означает параллельную регистрацию того же игрока
+        cur.execute("SELECT id, memo_code, goblins, gold, ton_balance FROM players WHERE user_id = %s", (user_id,))
+        player = cur.fetchone()
+        if player:
+            return player
+    raise RuntimeError('Не удалось выделить MEMO код')
@@ -0,0 +1,111 @@
+'''Пакетное начисление золота всем игрокам, у которых прошёл хотя бы час с last_harvest.
+
+Запуск по крону:
+    python settle.py --chunk-size 5000
+
+Проход идёт по players.id порциями; позиция хранится в harvest_settlement_state
+и фиксируется в той же транзакции, что и начисление, поэтому прерванный запуск
+продолжается с последней закоммиченной порции.
+'''
+import argparse
+import os
+import time
+import psycopg2
+import harvest
+
+DEFAULT_CHUNK_SIZE = int(os.environ.get('SETTLE_CHUNK_SIZE', '5000'))
+
+# Та же формула, что и в harvest.PLAYER_CTE, но для порции игроков
+SETTLE_CHUNK_SQL = f"""
+    WITH due AS (
+        SELECT id, goblins, {harvest.hours_sql()} AS hours
+        FROM players
+        WHERE id > %(after)s AND last_harvest <= LOCALTIMESTAMP - INTERVAL '1 hour'
+        ORDER BY id
+        LIMIT %(limit)s
+        FOR UPDATE SKIP LOCKED
+    ), settled AS (
+        UPDATE players p
+        SET gold = p.gold + {harvest.earned_sql('due.goblins', 'due.hours')},
+            last_harvest = p.last_harvest + due.hours * INTERVAL '1 hour'
+        FROM due
+        WHERE p.id = due.id
+        RETURNING p.id, {harvest.earned_sql('due.goblins', 'due.hours')} AS gold_earned, due.goblins
+    ), logged AS (
+        INSERT INTO gold_harvests (player_id, gold_earned, goblins_count)
+        SELECT id, gold_earned, goblins FROM settled
+    )
+    SELECT COUNT(*), MAX(id), COALESCE(SUM(gold_earned), 0) FROM settled
+"""
+
+
+def settle_all(conn, chunk_size: int = DEFAULT_CHUNK_SIZE, job: str = 'default',
+               max_chunks: int = None, restart: bool = False) -> dict:
+    '''Начисляет золото порциями до конца таблицы или до max_chunks порций'''
+    cur = conn.cursor()
+    cur.execute(
+        "INSERT INTO harvest_settlement_state (job) VALUES (%s) ON CONFLICT (job) DO NOTHING",
+        (job,)
+    )
+    if restart:
+        cur.execute(
+            "UPDATE harvest_settlement_state SET last_player_id = 0, players_settled = 0, started_at = NOW() WHERE job = %s",
+            (job,)
+        )
+    conn.commit()
+
+    stats = {'chunks': 0, 'players': 0, 'gold': 0, 'finished': False}
+    while max_chunks is None or stats['chunks'] < max_chunks:
+        # Блокировка строки прогресса сериализует параллельные запуски одной задачи
+        cur.execute("SELECT last_player_id FROM harvest_settlement_state WHERE job = %s FOR UPDATE", (job,))
+        after = cur.fetchone()[0]
+
+        cur.execute(SETTLE_CHUNK_SQL, {'after': after, 'limit': chunk_size})
+        settled, last_id, gold = cur.fetchone()
+
+        if not settled:
+            cur.execute(
+                "UPDATE harvest_settlement_state SET last_player_id = 0, updated_at = NOW() WHERE job = %s",
+                (job,)
+            )
+            conn.commit()
+            stats['finished'] = True
+            break
+
+        cur.execute(
+            """UPDATE harvest_settlement_state
+               SET last_player_id = %s, players_settled = players_settled + %s, updated_at = NOW()
+               WHERE job = %s""",
+            (last_id, settled, job)
+        )
+        conn.commit()
+
+        stats['chunks'] += 1
+        stats['players'] += settled
+        stats['gold'] += gold
+
+    cur.close()
+    stats['gold'] = float(stats['gold'])
+    return stats
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Пакетное начисление накопленного золота')
+    parser.add_argument('--chunk-size', type=int, default=DEFAULT_CHUNK_SIZE)
+    parser.add_argument('--job', default='default')
+    parser.add_argument('--max-chunks', type=int, default=None)
+    parser.add_argument('--restart', action='store_true', help='начать проход с первого игрока')
+    args = parser.parse_args()
+
+    conn = psycopg2.connect(os.environ.get('DATABASE_URL'))
+    try:
+        started = time.monotonic()
+        stats = settle_all(conn, args.chunk_size, args.job, args.max_chunks, args.restart)
+        stats['seconds'] = round(time.monotonic() - started, 3)
+        print(stats)
+    finally:
+        conn.close()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,186 @@
+'''Маршрутизация игроков по узлам Postgres.
+
+Узлы задаются SHARD_URLS (JSON-список или DSN через запятую); без него узел
+один — DATABASE_URL, и всё работает как на одной базе. Игрок живёт на узле,
+который выбирает кольцо консистентного хеширования по user_id; там же лежат его
+журналы, объявления и заявки. Данные игроков между узлами не переезжают:
+разметка (cd backend && python -m tools.shards provision) закрепляет в
+shard_directory первого узла тех, кто уже есть в базе, а кольцо выбирает для
+них другой узел. Пока разметка не выполнена для текущего числа узлов,
+маршрутизация отказывает (ShardError). Новый узел добавляется в конец списка,
+после чего разметку повторяют и перезапускают экземпляры: разметка и найденные
+узлы игроков кэшируются на всё время жизни экземпляра.
+
+id объявлений выдаются последовательностями узла с шагом ID_STRIDE и остатком,
+равным номеру узла, поэтому узел объявления определяется по его id без запроса;
+объявления, созданные до первой разметки, лежат на узле legacy_shard. Ленту объявлений
+можно читать с реплик: LISTINGS_REPLICA_URLS в том же порядке, что SHARD_URLS.
+
+Книга заявок и свечи у каждого узла свои: заявка сводится только со встречными
+заявками своего узла, а order-book и candles собирают уровни и свечи со всех
+узлов при чтении. Поэтому в общей книге покупка может стоять дороже продажи,
+пока их держат разные узлы.
+Кроны (settle.py, ledger.py, leaderboard.py) запускаются на каждом узле со
+своим DATABASE_URL.
+'''
+import bisect
+import hashlib
+import json
+import os
+import threading
+from collections import OrderedDict
+from contextlib import contextmanager
+import psycopg2.errors
+import db
+
+ID_STRIDE = 1024
+VNODES = 64
+DIRECTORY_CACHE_SIZE = int(os.environ.get('SHARD_DIRECTORY_CACHE_SIZE', '100000'))
+
+LAYOUT_SQL = "SELECT shards, listings_below, legacy_shard FROM shard_layout WHERE id = 1"
+DIRECTORY_SQL = "SELECT shard FROM shard_directory WHERE user_id = %s"
+
+
+class ShardError(Exception):
+    '''Узлы не размечены под текущий SHARD_URLS'''
+
+
+def parse_urls(value: str) -> list:
+    '''Список DSN из переменной окружения: JSON-список или через запятую'''
+    value = (value or '').strip()
+    if not value:
+        return []
+    if value.startswith('['):
+        return [url for url in json.loads(value)]
+    return [url.strip() for url in value.split(',')]
+
+
+def _point(key: str) -> int:
+    return int.from_bytes(hashlib.blake2b(key.encode(), digest_size=8).digest(), 'big')
+
+
+class Ring:
+    '''Кольцо консистентного хеширования с VNODES точками на узел'''
+
+    def __init__(self, count: int, vnodes: int = VNODES):
+        points = sorted((_point(f'shard-{shard}#{v}'), shard) for shard in range(count) for v in range(vnodes))
+        self._points = [point for point, _ in points]
+        self._shards = [shard for _, shard in points]
+
+    def shard(self, key: str) -> int:
+        index = bisect.bisect(self._points, _point(key)) % len(self._points)
+        return self._shards[index]
+
+
+class Cluster:
+    '''Узлы, их реплики для чтения ленты и пулы соединений к ним'''
+
+    def __init__(self, urls: list, replicas: list = ()):
+        if not urls or len(urls) > ID_STRIDE:
+            raise ValueError(f'Нужно от 1 до {ID_STRIDE} узлов')
+        self.urls = list(urls)
+        replicas = list(replicas) + [None] * (len(urls) - len(replicas))
+        self.replicas = [replica or url for url, replica in zip(self.urls, replicas)]
+        self.ring = Ring(len(urls))
+        self._layout = None
+        self._directory = OrderedDict()
+        self._lock = threading.Lock()
+
+    @property
+    def count(self) -> int:
+        return len(self.urls)
+
+    @property
+    def has_replicas(self) -> bool:
+        return self.replicas != self.urls
+
+    def layout(self) -> tuple:
+        '''(listings_below, legacy_shard) из разметки первого узла'''
+        if self._layout is None:
+            with self.connection(0) as conn, conn.cursor() as cur:
+                try:
+                    cur.execute(LAYOUT_SQL)
+                    row = cur.fetchone()
+                except psycopg2.errors.UndefinedTable:
+                    row = None
+            if row is None or row[0] != self.count:
+                raise ShardError(
+                    f'Узлы не размечены для {self.count} узлов: cd backend && python -m tools.shards provision'
+                )
+            self._layout = tuple(row[1:])
+        return self._layout
+
+    def for_user(self, user_id) -> int:
+        '''Узел игрока: закреплённый при разметке или по кольцу; запросы без игрока идут на первый узел'''
+        if self.count == 1 or not user_id:
+            return 0
+        self.layout()
+        user_id = str(user_id)
+        with self._lock:
+            shard = self._directory.get(user_id)
+            if shard is not None:
+                self._directory.move_to_end(user_id)
+                return shard
+
+        with self.connection(0) as conn, conn.cursor() as cur:
+            cur.execute(DIRECTORY_SQL, (user_id,))
+            row = cur.fetchone()
+        shard = row[0] if row else self.ring.shard(user_id)
+        with self._lock:
+            self._directory[user_id] = shard
+            if len(self._directory) > DIRECTORY_CACHE_SIZE:
+                self._directory.popitem(last=False)
+        return shard
+
+    def for_id(self, listing_id) -> int:
+        '''Узел объявления по id; None, если такого id быть не может'''
+        listing_id = int(listing_id)
+        if self.count == 1:
+            return 0
+        listings_below, legacy_shard = self.layout()
+        if listing_id < listings_below:
+            return legacy_shard
+        shard = listing_id % ID_STRIDE
+        return shard if shard < self.count else None
+
+    def shard_of(self, conn) -> int:
+        '''Узел, с которого выдано соединение: без повторного поиска игрока'''
+        return self.urls.index(conn.pool.dsn)
+
+    def acquire(self, shard: int, replica: bool = False):
+        return db.pool_for((self.replicas if replica else self.urls)[shard]).acquire()
+
+    @contextmanager
+    def connection(self, shard: int, replica: bool = False):
+        conn = self.acquire(shard, replica)
+        try:
+            yield conn
+        finally:
+            db.release(conn)
+
+    @contextmanager
+    def cursors(self, shards=None, replica: bool = False, cursor_factory=None):
+        '''Курсоры к нескольким узлам сразу; по умолчанию ко всем'''
+        conns, cursors = [], []
+        try:
+            for shard in (range(self.count) if shards is None else shards):
+                conns.append(self.acquire(shard, replica))
+            cursors = [conn.cursor(cursor_factory=cursor_factory) for conn in conns]
+            yield cursors
+        finally:
+            for cur in cursors:
+                cur.close()
+            for conn in conns:
+                db.release(conn)
+
+
+_cluster = None
+
+
+def cluster() -> Cluster:
+    '''Узлы из окружения; читаются один раз за жизнь экземпляра'''
+    global _cluster
+    if _cluster is None:
+        urls = parse_urls(os.environ.get('SHARD_URLS')) or [os.environ.get('DATABASE_URL')]
+        _cluster = Cluster(urls, parse_urls(os.environ.get('LISTINGS_REPLICA_URLS')))
+    return _cluster
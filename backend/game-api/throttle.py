@@ -0,0 +1,152 @@
+'''Ограничение частоты запросов игрока и склейка одинаковых одновременных запросов.
+
+Ограничение — token bucket по user_id: RATE_LIMIT_RATE жетонов в секунду,
+не больше RATE_LIMIT_BURST про запас. По умолчанию корзины живут в памяти
+экземпляра и отказ обходится без БД. RATE_LIMIT_BACKEND=table хранит корзины в
+таблице rate_limits, общей для всех экземпляров; проверка стоит один запрос.
+RATE_LIMIT_RATE=0 отключает ограничение.
+'''
+import math
+import os
+import random
+import threading
+import time
+from collections import OrderedDict
+import db
+import instrument
+
+RATE = float(os.environ.get('RATE_LIMIT_RATE', '2'))
+BURST = float(os.environ.get('RATE_LIMIT_BURST', '20'))
+BACKEND = os.environ.get('RATE_LIMIT_BACKEND', 'memory')
+MAX_BUCKETS = 10000
+SWEEP_PROBABILITY = 0.01
+SWEEP_BATCH = 500
+
+# Строка обновляется, только если после пополнения хватает жетонов;
+# пустой результат означает отказ
+TAKE_SQL = """
+    INSERT INTO rate_limits (bucket_key, tokens, updated_at)
+    VALUES (%(key)s, %(burst)s - %(cost)s, clock_timestamp())
+    ON CONFLICT (bucket_key) DO UPDATE
+    SET tokens = LEAST(%(burst)s, rate_limits.tokens
+                 + EXTRACT(EPOCH FROM clock_timestamp() - rate_limits.updated_at) * %(rate)s) - %(cost)s,
+        updated_at = clock_timestamp()
+    WHERE LEAST(%(burst)s, rate_limits.tokens
+          + EXTRACT(EPOCH FROM clock_timestamp() - rate_limits.updated_at) * %(rate)s) >= %(cost)s
+    RETURNING tokens
+"""
+
+# Корзина, не тронутая дольше burst / rate секунд, полна — строка ей не нужна
+SWEEP_SQL = """
+    DELETE FROM rate_limits
+    WHERE ctid IN (
+        SELECT ctid FROM rate_limits
+        WHERE updated_at < clock_timestamp() - %s * INTERVAL '1 second'
+        LIMIT %s
+        FOR UPDATE SKIP LOCKED
+    )
+"""
+
+
+class TokenBuckets:
+    '''Корзины жетонов в памяти экземпляра; давно не нужные вытесняются'''
+
+    def __init__(self, rate: float = RATE, burst: float = BURST, max_buckets: int = MAX_BUCKETS):
+        self.rate = rate
+        self.burst = burst
+        self.max_buckets = max_buckets
+        self._buckets = OrderedDict()
+        self._lock = threading.Lock()
+
+    def take(self, key: str, cost: float = 1) -> float:
+        '''Списывает cost жетонов; возвращает 0 или сколько секунд ждать'''
+        now = time.monotonic()
+        with self._lock:
+            tokens, updated = self._buckets.pop(key, (self.burst, now))
+            tokens = min(self.burst, tokens + (now - updated) * self.rate)
+            wait = 0.0
+            if tokens >= cost:
+                tokens -= cost
+            else:
+                wait = (cost - tokens) / self.rate
+            self._buckets[key] = (tokens, now)
+            while len(self._buckets) > self.max_buckets:
+                self._buckets.popitem(last=False)
+        return wait
+
+
+buckets = TokenBuckets()
+
+
+def take_shared(cur, key: str, cost: float = 1, rate: float = RATE, burst: float = BURST) -> float:
+    '''Списывает жетоны из общей таблицы; при отказе — оценка ожидания сверху'''
+    cur.execute(TAKE_SQL, {'key': key, 'cost': cost, 'rate': rate, 'burst': burst})
+    taken = cur.fetchone()
+    if random.random() < SWEEP_PROBABILITY:
+        cur.execute(SWEEP_SQL, (burst / rate, SWEEP_BATCH))
+    return 0.0 if taken else cost / rate
+
+
+def wait(key: str, cost: float = 1) -> float:
+    '''Сколько секунд ждать игроку до следующего запроса; 0 — запрос выполняется'''
+    if RATE <= 0:
+        return 0.0
+    if BACKEND != 'table':
+        return buckets.take(key, cost)
+
+    conn = db.acquire()
+    try:
+        with conn.cursor(cursor_factory=instrument.TimedCursor) as cur:
+            result = take_shared(cur, key, cost)
+        instrument.commit(conn)
+        return result
+    finally:
+        db.release(conn)
+
+
+def retry_after(wait: float) -> str:
+    return str(max(1, math.ceil(wait)))
+
+
+class SingleFlight:
+    '''Склеивает одновременные вызовы с одинаковым ключом в один.
+
+    Первый вызов выполняет функцию, остальные ждут и получают тот же результат
+    или то же исключение. Завершённые вызовы не кэшируются.
+    '''
+
+    class _Call:
+        __slots__ = ('done', 'result', 'error')
+
+        def __init__(self):
+            self.done = threading.Event()
+            self.result = None
+            self.error = None
+
+    def __init__(self):
+        self._calls = {}
+        self._lock = threading.Lock()
+
+    def do(self, key, function):
+        with self._lock:
+            call = self._calls.get(key)
+            leader = call is None
+            if leader:
+                call = self._calls[key] = self._Call()
+
+        if not leader:
+            call.done.wait()
+            if call.error is not None:
+                raise call.error
+            return call.result
+
+        try:
+            call.result = function()
+            return call.result
+        except Exception as e:
+            call.error = e
+            raise
+        finally:
+            with self._lock:
+                del self._calls[key]
+            call.done.set()
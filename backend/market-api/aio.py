@@ -0,0 +1,223 @@
+'''Асинхронная точка входа market-api для самостоятельного хостинга (ASGI).
+
+    cd backend/market-api && uvicorn aio:app --port 8001
+
+Нужны asyncpg и любой ASGI-сервер (uvicorn); облачной функции они не нужны —
+index.handler этот модуль не импортирует. Лента и покупка объявления идут через
+пул asyncpg и стоят по одному сетевому обходу: покупка — один запрос BUY_SQL
+вне явной транзакции (одиночный запрос атомарен сам по себе), страница ленты
+читается вместе с версией объявлений. Пока один запрос ждёт БД, цикл событий
+обслуживает остальные. Прочие действия, пакеты и запросы с Idempotency-Key
+передаются синхронному index.handler в пуле потоков; туда же идёт всё, если
+узлов несколько или лента читается с реплик (shards.py).
+'''
+import asyncio
+import json
+import os
+import re
+from urllib.parse import parse_qsl
+import asyncpg
+import idempotency
+import index
+import listings
+import money
+import orderbook
+import shards
+
+POOL_MIN_SIZE = int(os.environ.get('AIO_POOL_MIN_SIZE', '2'))
+POOL_MAX_SIZE = int(os.environ.get('AIO_POOL_MAX_SIZE', '16'))
+
+_PLACEHOLDER = re.compile(r'%\((\w+)\)s|%s|%%')
+_native = {}
+
+
+def native(query: str) -> tuple:
+    '''Переводит запрос с плейсхолдерами psycopg2 в нумерованные $n asyncpg.
+
+    Возвращает текст запроса и список имён параметров по порядку номеров
+    (для позиционных %s — их индексы).
+    '''
+    if query in _native:
+        return _native[query]
+    names = []
+
+    def replace(match):
+        if match.group(0) == '%%':
+            return '%'
+        name = match.group(1)
+        if name is None:
+            name = sum(1 for n in names if isinstance(n, int))
+        elif name in names:
+            return f'${names.index(name) + 1}'
+        names.append(name)
+        return f'${len(names)}'
+
+    result = (_PLACEHOLDER.sub(replace, query), names)
+    _native[query] = result
+    return result
+
+
+def bind(query: str, args) -> tuple:
+    '''Текст запроса asyncpg и аргументы по порядку $n'''
+    text, names = native(query)
+    return text, [args[name] for name in names]
+
+
+class Service:
+    '''Пул asyncpg, живущий всё время работы сервера'''
+
+    def __init__(self, dsn: str):
+        self.dsn = dsn
+        self.pool = None
+
+    async def start(self):
+        self.pool = await asyncpg.create_pool(self.dsn, min_size=POOL_MIN_SIZE, max_size=POOL_MAX_SIZE)
+
+    async def close(self):
+        if self.pool is not None:
+            await self.pool.close()
+
+    async def listings(self, params: dict):
+        '''Страница ленты: из кэша или вместе с версией за один обход'''
+        key = listings.PageCache.key(params)
+        page = listings.cache.fresh(key)
+        if page:
+            return page
+
+        query, args, sort, limit = listings.build_versioned_query(params)
+        text, values = bind(query, args)
+        async with self.pool.acquire() as conn:
+            rows = await conn.fetch(text, *values)
+        version = rows[0][0]
+        page = listings.cache.validate(key, version)
+        if page:
+            return page
+        rows = [tuple(row)[1:] for row in rows if row[1] is not None]
+        return listings.cache.store(key, version, listings.page_body(rows, sort, limit))
+
+    async def buy_listing(self, body: dict) -> tuple:
+        try:
+            listing_id = int(body.get('listing_id'))
+        except (TypeError, ValueError):
+            return 404, {'error': 'Объявление не найдено'}
+
+        text, values = bind(listings.BUY_SQL, {
+            'user_id': str(body.get('user_id') or ''),
+            'listing_id': listing_id,
+            'fee_rate': orderbook.FEE_RATE
+        })
+        async with self.pool.acquire() as conn:
+            row = await conn.fetchrow(text, *values)
+        status, payload = listings.purchase_result(row)
+        if status < 400:
+            listings.cache.invalidate()
+        return status, payload
+
+
+HEADERS = {
+    'Content-Type': 'application/json',
+    'Access-Control-Allow-Origin': '*'
+}
+
+
+async def handle(service: Service, event: dict) -> dict:
+    '''Асинхронный аналог index.handler для ленты и покупки объявления'''
+    method = event.get('httpMethod', 'GET')
+    query_params = event.get('queryStringParameters') or {}
+    action = query_params.get('action', 'listings')
+    keyed = any(name.lower() == idempotency.HEADER for name in (event.get('headers') or {}))
+    direct = shards.cluster().count == 1 and not shards.cluster().has_replicas
+
+    if method == 'OPTIONS':
+        # Без обращения к БД, отвечаем в цикле событий
+        return index.handler(event, None)
+
+    try:
+        if direct and action == 'listings' and method == 'GET':
+            try:
+                page = await service.listings(query_params)
+            except listings.PageError as e:
+                return {
+                    'statusCode': 400,
+                    'headers': HEADERS,
+                    'body': money.error_body(str(e)),
+                    'isBase64Encoded': False
+                }
+            return index.listings_response(page, event, HEADERS)
+
+        if direct and action == 'buy-listing' and method == 'POST' and not keyed:
+            status, payload = await service.buy_listing(json.loads(event.get('body') or '{}'))
+            return {
+                'statusCode': status,
+                'headers': HEADERS,
+                'body': money.dumps(payload),
+                'isBase64Encoded': False
+            }
+
+    except Exception as e:
+        return {
+            'statusCode': 500,
+            'headers': HEADERS,
+            'body': json.dumps({'error': str(e)}),
+            'isBase64Encoded': False
+        }
+
+    return await asyncio.to_thread(index.handler, event, None)
+
+
+def event_from_scope(scope: dict, body: bytes) -> dict:
+    '''HTTP-запрос ASGI в формате event облачной функции'''
+    headers = {}
+    for name, value in scope.get('headers', []):
+        headers[name.decode('latin-1')] = value.decode('latin-1')
+    return {
+        'httpMethod': scope['method'],
+        'path': scope.get('path', '/'),
+        'queryStringParameters': dict(parse_qsl(scope.get('query_string', b'').decode('latin-1'))),
+        'headers': headers,
+        'body': body.decode('utf-8') if body else None,
+        'isBase64Encoded': False,
+    }
+
+
+async def _read_body(receive) -> bytes:
+    chunks = []
+    while True:
+        message = await receive()
+        chunks.append(message.get('body', b''))
+        if not message.get('more_body'):
+            return b''.join(chunks)
+
+
+def create_app(dsn: str = None):
+    service = Service(dsn or os.environ.get('DATABASE_URL'))
+
+    async def app(scope, receive, send):
+        if scope['type'] == 'lifespan':
+            while True:
+                message = await receive()
+                if message['type'] == 'lifespan.startup':
+                    await service.start()
+                    await send({'type': 'lifespan.startup.complete'})
+                elif message['type'] == 'lifespan.shutdown':
+                    await service.close()
+                    await send({'type': 'lifespan.shutdown.complete'})
+                    return
+        if scope['type'] != 'http':
+            return
+
+        event = event_from_scope(scope, await _read_body(receive))
+        response = await handle(service, event)
+        body = response.get('body') or ''
+        await send({
+            'type': 'http.response.start',
+            'status': response['statusCode'],
+            'headers': [(k.encode('latin-1'), str(v).encode('latin-1')) for k, v in response.get('headers', {}).items()],
+        })
+        await send({'type': 'http.response.body', 'body': body.encode('utf-8')})
+
+    app.service = service
+    return app
+
+
+app = create_app()
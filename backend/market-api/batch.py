@@ -0,0 +1,68 @@
+import instrument
+
+MAX_ACTIONS = 20
+
+
+def single_user(body: dict) -> bool:
+    '''Все действия пакета относятся к игроку пакета, и пакет целиком идёт на его узел'''
+    user_id = body.get('user_id')
+    items = body.get('actions')
+    for item in items if isinstance(items, list) else []:
+        data = (item.get('body') or item.get('params') or {}) if isinstance(item, dict) else {}
+        if isinstance(data, dict) and data.get('user_id', user_id) != user_id:
+            return False
+    return True
+
+
+def run(conn, cur, actions: dict, body: dict) -> tuple:
+    '''Выполняет пакет действий на одном соединении.
+
+    actions — таблица действий функции: имя -> (HTTP-метод, обработчик(cur, data)).
+    При atomic=true все действия идут в одной транзакции и откатываются целиком
+    на первой ошибке; иначе каждое действие коммитится или откатывается отдельно.
+    Возвращает статус, тело ответа и имена закоммиченных действий.
+    '''
+    items = body.get('actions')
+    if not isinstance(items, list) or not items:
+        return 400, {'error': 'Пакет должен содержать список actions'}, []
+    if len(items) > MAX_ACTIONS:
+        return 400, {'error': f'Не больше {MAX_ACTIONS} действий в пакете'}, []
+
+    atomic = bool(body.get('atomic'))
+    results = []
+    committed = []
+
+    for index, item in enumerate(items):
+        name = item.get('action') if isinstance(item, dict) else None
+        route = actions.get(name)
+        if route is None:
+            status, payload = 404, {'error': 'Endpoint не найден'}
+        else:
+            data = dict(item.get('body') or item.get('params') or {})
+            if body.get('user_id'):
+                data.setdefault('user_id', body['user_id'])
+            try:
+                status, payload = route[1](cur, data)
+            except Exception as e:
+                if atomic:
+                    raise
+                instrument.fail(e)
+                conn.rollback()
+                status, payload = 500, {'error': str(e)}
+
+        results.append({'action': name, 'statusCode': status, 'body': payload})
+
+        if atomic:
+            if status >= 400:
+                conn.rollback()
+                return status, {'results': results, 'committed': False, 'failed_index': index}, []
+        elif status < 400:
+            instrument.commit(conn)
+            committed.append(name)
+        else:
+            conn.rollback()
+
+    if atomic:
+        instrument.commit(conn)
+        committed = [result['action'] for result in results]
+    return 200, {'results': results, 'committed': True}, committed
@@ -0,0 +1,130 @@
+from datetime import datetime
+from psycopg2.extras import execute_values
+
+RESOLUTIONS = ('1m', '1h', '1d')
+DEFAULT_LIMIT = 100
+MAX_LIMIT = 1000
+
+# Сделки транзакции сворачиваются в одну строку на интервал и вливаются в текущие
+# корзины. Строки свечей — общие для всех продаж, поэтому запрос выполняется
+# последним перед commit и блокирует их всегда в одном порядке.
+# {trades} — источник строк (n, amount, price, total): VALUES или выборка из CTE
+UPSERT_SQL = """
+    INSERT INTO market_candles AS c (resolution, bucket, open, high, low, close, volume, turnover, trades,
+                                     opened_at, closed_at)
+    SELECT r.resolution, date_trunc(r.unit, LOCALTIMESTAMP),
+           (array_agg(t.price ORDER BY t.n))[1], MAX(t.price), MIN(t.price),
+           (array_agg(t.price ORDER BY t.n DESC))[1],
+           SUM(t.amount), SUM(t.total), COUNT(*), LOCALTIMESTAMP, LOCALTIMESTAMP
+    FROM (VALUES ('1m', 'minute'), ('1h', 'hour'), ('1d', 'day')) r(resolution, unit)
+    CROSS JOIN {trades} t(n, amount, price, total)
+    GROUP BY r.resolution, r.unit
+    ORDER BY r.resolution
+    ON CONFLICT (resolution, bucket) DO UPDATE
+    SET high = GREATEST(c.high, EXCLUDED.high),
+        low = LEAST(c.low, EXCLUDED.low),
+        close = EXCLUDED.close,
+        volume = c.volume + EXCLUDED.volume,
+        turnover = c.turnover + EXCLUDED.turnover,
+        trades = c.trades + EXCLUDED.trades,
+        closed_at = EXCLUDED.closed_at
+"""
+
+RECORD_SQL = UPSERT_SQL.format(trades='(VALUES %s)')
+
+
+class CandleError(ValueError):
+    '''Некорректные параметры запроса свечей'''
+
+
+def record(cur, trades: list):
+    '''Учитывает сделки (количество, цена, сумма) в свечах текущих корзин'''
+    execute_values(
+        cur, RECORD_SQL,
+        [(n, amount, price, total) for n, (amount, price, total) in enumerate(trades)],
+        template='(%s, %s::numeric, %s::numeric, %s::numeric)'
+    )
+
+
+def _timestamp(params: dict, name: str):
+    if not params.get(name):
+        return None
+    try:
+        return datetime.fromisoformat(params[name])
+    except (TypeError, ValueError):
+        raise CandleError(f'Неверное значение {name}')
+
+
+def _merge(rows: list) -> list:
+    '''Свечи нескольких узлов, по одной на корзину; open и close — по времени сделок'''
+    merged = {}
+    for bucket, open_price, high, low, close, volume, turnover, trades, opened_at, closed_at in rows:
+        opened_at, closed_at = opened_at or bucket, closed_at or bucket
+        candle = merged.get(bucket)
+        if candle is None:
+            merged[bucket] = [bucket, open_price, high, low, close, volume, turnover, trades, opened_at, closed_at]
+            continue
+        if opened_at < candle[8]:
+            candle[1], candle[8] = open_price, opened_at
+        if closed_at > candle[9]:
+            candle[4], candle[9] = close, closed_at
+        candle[2], candle[3] = max(candle[2], high), min(candle[3], low)
+        candle[5] += volume
+        candle[6] += turnover
+        candle[7] += trades
+    return list(merged.values())
+
+
+def fetch_candles(cur, params: dict, remote: list = ()) -> dict:
+    '''Свечи за диапазон [from, to); без from — последние limit корзин до to.
+
+    Корзины без сделок не хранятся и в ответ не попадают. remote — курсоры
+    остальных узлов: их свечи сливаются со свечами cur по корзинам.
+    '''
+    resolution = params.get('resolution', '1h')
+    if resolution not in RESOLUTIONS:
+        raise CandleError('Неверный интервал свечей')
+    try:
+        limit = min(max(int(params.get('limit', DEFAULT_LIMIT)), 1), MAX_LIMIT)
+    except (TypeError, ValueError):
+        raise CandleError('Неверный limit')
+    start, end = _timestamp(params, 'from'), _timestamp(params, 'to')
+
+    conditions = ["resolution = %s"]
+    args = [resolution]
+    if start:
+        conditions.append("bucket >= %s")
+        args.append(start)
+    if end:
+        conditions.append("bucket < %s")
+        args.append(end)
+    args.append(limit)
+
+    rows = []
+    for node in (cur, *remote):
+        node.execute(f"""
+            SELECT bucket, open, high, low, close, volume, turnover, trades, opened_at, closed_at
+            FROM market_candles
+            WHERE {' AND '.join(conditions)}
+            ORDER BY bucket {'ASC' if start else 'DESC'}
+            LIMIT %s
+        """, args)
+        rows.extend(node.fetchall())
+    if remote:
+        rows = sorted(_merge(rows), key=lambda row: row[0], reverse=not start)[:limit]
+    if not start:
+        rows.reverse()
+
+    return {
+        'resolution': resolution,
+        'candles': [{
+            'time': bucket.isoformat(),
+            'open': open_price,
+            'high': high,
+            'low': low,
+            'close': close,
+            'volume': volume,
+            'turnover': turnover,
+            'trades': trades
+        } for bucket, open_price, high, low, close, volume, turnover, trades, _, _ in rows]
+    }
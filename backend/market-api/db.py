@@ -0,0 +1,155 @@
+import os
+import threading
+import time
+import psycopg2
+import psycopg2.extensions
+
+POOL_MAX_SIZE = int(os.environ.get('DB_POOL_MAX_SIZE', '4'))
+CONN_MAX_AGE = float(os.environ.get('DB_CONN_MAX_AGE', '300'))
+HEALTH_CHECK_AFTER = float(os.environ.get('DB_HEALTH_CHECK_AFTER', '30'))
+ACQUIRE_TIMEOUT = float(os.environ.get('DB_ACQUIRE_TIMEOUT', '10'))
+
+
+class PooledConnection(psycopg2.extensions.connection):
+    '''Соединение, которое помнит время создания и последнего использования'''
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.created_at = time.monotonic()
+        self.last_used = self.created_at
+        self.pool = None
+
+
+class ConnectionPool:
+    '''Ограниченный пул соединений, живущий между тёплыми вызовами функции'''
+
+    def __init__(self, dsn: str, max_size: int = POOL_MAX_SIZE,
+                 max_age: float = CONN_MAX_AGE, health_check_after: float = HEALTH_CHECK_AFTER):
+        self.dsn = dsn
+        self.max_size = max_size
+        self.max_age = max_age
+        self.health_check_after = health_check_after
+        self._idle = []
+        self._size = 0
+        self._cond = threading.Condition()
+
+    def _connect(self) -> PooledConnection:
+        conn = psycopg2.connect(self.dsn, connection_factory=PooledConnection)
+        conn.pool = self
+        return conn
+
+    def _is_alive(self, conn: PooledConnection) -> bool:
+        '''Проверка соединения: закрыто, устарело или давно простаивало'''
+        if conn.closed:
+            return False
+        now = time.monotonic()
+        if now - conn.created_at > self.max_age:
+            return False
+        if now - conn.last_used > self.health_check_after:
+            try:
+                with conn.cursor() as cur:
+                    cur.execute('SELECT 1')
+                conn.rollback()
+            except psycopg2.Error:
+                return False
+        return True
+
+    def _discard(self, conn: PooledConnection):
+        try:
+            conn.close()
+        except psycopg2.Error:
+            pass
+
+    def acquire(self) -> PooledConnection:
+        '''Выдаёт живое соединение из пула или открывает новое'''
+        deadline = time.monotonic() + ACQUIRE_TIMEOUT
+        with self._cond:
+            while not self._idle and self._size >= self.max_size:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    raise psycopg2.OperationalError('Пул соединений исчерпан')
+                self._cond.wait(remaining)
+            conn = self._idle.pop() if self._idle else None
+            self._size += conn is None
+
+        while conn is not None and not self._is_alive(conn):
+            self._discard(conn)
+            with self._cond:
+                if self._idle:
+                    conn = self._idle.pop()
+                    self._size -= 1
+                else:
+                    # слот мёртвого соединения переходит новому
+                    conn = None
+
+        if conn is None:
+            try:
+                conn = self._connect()
+            except Exception:
+                with self._cond:
+                    self._size -= 1
+                    self._cond.notify()
+                raise
+        return conn
+
+    def release(self, conn: PooledConnection):
+        '''Возвращает соединение в пул; сломанное соединение закрывается'''
+        broken = bool(conn.closed)
+        if not broken and conn.get_transaction_status() != psycopg2.extensions.TRANSACTION_STATUS_IDLE:
+            try:
+                conn.rollback()
+            except psycopg2.Error:
+                broken = True
+        if broken or time.monotonic() - conn.created_at > self.max_age:
+            self._discard(conn)
+            with self._cond:
+                self._size -= 1
+                self._cond.notify()
+            return
+        conn.last_used = time.monotonic()
+        with self._cond:
+            self._idle.append(conn)
+            self._cond.notify()
+
+    def close(self):
+        '''Закрывает все простаивающие соединения'''
+        with self._cond:
+            idle, self._idle = self._idle, []
+            self._size -= len(idle)
+        for conn in idle:
+            self._discard(conn)
+
+
+_pools = {}
+_pool_lock = threading.Lock()
+
+
+def pool_for(dsn: str) -> ConnectionPool:
+    '''Пул для DSN: создаётся при первом обращении и переживает тёплые старты'''
+    pool = _pools.get(dsn)
+    if pool is None:
+        with _pool_lock:
+            pool = _pools.get(dsn)
+            if pool is None:
+                pool = _pools[dsn] = ConnectionPool(dsn)
+    return pool
+
+
+def get_pool() -> ConnectionPool:
+    '''Пул основной базы DATABASE_URL'''
+    return pool_for(os.environ.get('DATABASE_URL'))
+
+
+def close_all():
+    '''Закрывает простаивающие соединения всех пулов'''
+    for pool in list(_pools.values()):
+        pool.close()
+
+
+def acquire() -> PooledConnection:
+    return get_pool().acquire()
+
+
+def release(conn: PooledConnection):
+    '''Возвращает соединение в пул, из которого оно выдано'''
+    conn.pool.release(conn)
@@ -0,0 +1,48 @@
+from decimal import Decimal, ROUND_HALF_UP
+from money import GOLD_QUANT
+
+GOLD_PER_GOBLIN_HOUR = Decimal('0.014')
+
+
+def hours_sql(last_harvest: str = 'last_harvest') -> str:
+    '''SQL: полные часы с last_harvest'''
+    return f"FLOOR(EXTRACT(EPOCH FROM (LOCALTIMESTAMP - {last_harvest})) / 3600)::int"
+
+
+def earned_sql(goblins: str = 'goblins', hours: str = 'hours') -> str:
+    '''SQL: золото за hours часов по ставке GOLD_PER_GOBLIN_HOUR, как в accrued()'''
+    return f"ROUND({goblins} * {GOLD_PER_GOBLIN_HOUR} * {hours}, 2)"
+
+
+# Начисление за полные часы с last_harvest; last_harvest сдвигается ровно на
+# начисленные часы, поэтому результат не зависит от того, как часто читают баланс.
+# Фрагменты ниже собираются в один запрос вместе с изменением игрока:
+#   WITH {PLAYER_CTE}, changed AS (UPDATE players p SET ..., {ADVANCE_HARVEST}
+#       FROM player WHERE p.id = player.id ... RETURNING p.id, {CHANGED_RETURNING}), {HARVEST_LOG_CTE}
+PLAYER_CTE = f"""player AS (
+        SELECT id, goblins, gold, ton_balance, hours, {earned_sql()} AS earned
+        FROM (
+            SELECT id, goblins, gold, ton_balance, {hours_sql()} AS hours
+            FROM players
+            WHERE user_id = %(user_id)s
+            FOR UPDATE
+        ) locked
+    )"""
+
+ADVANCE_HARVEST = "last_harvest = p.last_harvest + player.hours * INTERVAL '1 hour'"
+
+CHANGED_RETURNING = "player.earned, player.goblins AS harvested_goblins, player.hours"
+
+HARVEST_LOG_CTE = """harvested AS (
+        INSERT INTO gold_harvests (player_id, gold_earned, goblins_count)
+        SELECT id, earned, harvested_goblins FROM changed WHERE hours >= 1
+    )"""
+
+
+def accrued(goblins: int, last_harvest, now) -> Decimal:
+    '''Золото, накопленное с last_harvest, но ещё не записанное в БД'''
+    hours = int((now - last_harvest).total_seconds() // 3600)
+    if hours < 1:
+        return Decimal('0')
+    return (goblins * GOLD_PER_GOBLIN_HOUR * hours).quantize(GOLD_QUANT, ROUND_HALF_UP)
+
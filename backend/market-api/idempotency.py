@@ -0,0 +1,197 @@
+'''Заголовок Idempotency-Key для мутирующих действий.
+
+Ключ захватывается в транзакции самого действия: pg_try_advisory_xact_lock
+отсекает повтор, пока первый запрос ещё выполняется (409), а вставка строки
+ключа с ON CONFLICT видит уже закоммиченные ответы. Ответ записывается в ту же
+строку перед commit, так что повтор получает сохранённый ответ, только если
+операция действительно выполнилась; при ошибке ключ откатывается вместе с ней.
+Выполненные ответы дополнительно держатся в LRU процесса, и повтор на тёплом
+экземпляре обходится без БД.
+'''
+import hashlib
+import json
+import os
+import random
+import threading
+import time
+from collections import OrderedDict
+import money
+
+HEADER = 'idempotency-key'
+MAX_KEY_LENGTH = 255
+TTL = int(os.environ.get('IDEMPOTENCY_TTL', '86400'))
+CACHE_MAX_ENTRIES = 1024
+SWEEP_PROBABILITY = 0.01
+SWEEP_BATCH = 500
+
+CLAIM_SQL = """
+    WITH lock AS (
+        SELECT pg_try_advisory_xact_lock(%(lock_id)s) AS acquired
+    ), claimed AS (
+        INSERT INTO idempotency_keys (function_name, user_id, idem_key, request_hash)
+        SELECT %(function)s, %(user_id)s, %(key)s, %(fingerprint)s FROM lock WHERE acquired
+        ON CONFLICT (function_name, user_id, idem_key) DO UPDATE
+        SET request_hash = EXCLUDED.request_hash, status_code = NULL, response_body = NULL, created_at = NOW()
+        WHERE idempotency_keys.created_at < NOW() - %(ttl)s * INTERVAL '1 second'
+        RETURNING 1
+    )
+    SELECT lock.acquired, EXISTS (SELECT 1 FROM claimed) FROM lock
+"""
+
+STORED_SQL = """
+    SELECT request_hash, status_code, response_body
+    FROM idempotency_keys
+    WHERE function_name = %(function)s AND user_id = %(user_id)s AND idem_key = %(key)s
+"""
+
+STORE_SQL = """
+    UPDATE idempotency_keys SET status_code = %(status)s, response_body = %(body)s
+    WHERE function_name = %(function)s AND user_id = %(user_id)s AND idem_key = %(key)s
+"""
+
+SWEEP_SQL = """
+    DELETE FROM idempotency_keys
+    WHERE ctid IN (
+        SELECT ctid FROM idempotency_keys
+        WHERE created_at < NOW() - %s * INTERVAL '1 second'
+        LIMIT %s
+        FOR UPDATE SKIP LOCKED
+    )
+"""
+
+
+class IdempotencyError(Exception):
+    '''Ключ нельзя использовать: неверный, занят или уже использован с другим телом'''
+
+    def __init__(self, status_code: int, message: str):
+        super().__init__(message)
+        self.status_code = status_code
+
+
+class Request:
+    __slots__ = ('function', 'user_id', 'key', 'fingerprint', 'lock_id')
+
+    def __init__(self, function: str, user_id: str, key: str, fingerprint: str):
+        self.function = function
+        self.user_id = user_id
+        self.key = key
+        self.fingerprint = fingerprint
+        digest = hashlib.blake2b(f'{function}\0{user_id}\0{key}'.encode(), digest_size=8).digest()
+        self.lock_id = int.from_bytes(digest, 'big', signed=True)
+
+    def params(self) -> dict:
+        return {
+            'function': self.function,
+            'user_id': self.user_id,
+            'key': self.key,
+            'fingerprint': self.fingerprint,
+            'lock_id': self.lock_id,
+            'ttl': TTL,
+        }
+
+
+class Stored:
+    __slots__ = ('fingerprint', 'status', 'body', 'expires_at')
+
+    def __init__(self, fingerprint: str, status: int, body: str, ttl: float = TTL):
+        self.fingerprint = fingerprint
+        self.status = status
+        self.body = body
+        self.expires_at = time.monotonic() + ttl
+
+
+def from_event(event: dict, function: str, action: str, data: dict):
+    '''Ключ идемпотентности запроса или None, если заголовка нет'''
+    key = None
+    for name, value in (event.get('headers') or {}).items():
+        if name.lower() == HEADER:
+            key = value
+    if not key:
+        return None
+    if len(key) > MAX_KEY_LENGTH:
+        raise IdempotencyError(400, f'Idempotency-Key длиннее {MAX_KEY_LENGTH} символов')
+    canonical = json.dumps([action, data], sort_keys=True, default=str)
+    fingerprint = hashlib.blake2s(canonical.encode(), digest_size=16).hexdigest()
+    return Request(function, str(data.get('user_id') or ''), key, fingerprint)
+
+
+def _check(req: Request, stored: Stored) -> Stored:
+    if stored.fingerprint != req.fingerprint:
+        raise IdempotencyError(422, 'Idempotency-Key уже использован с другим запросом')
+    return stored
+
+
+class ResponseCache:
+    '''LRU выполненных ответов в памяти экземпляра функции'''
+
+    def __init__(self, max_entries: int = CACHE_MAX_ENTRIES):
+        self.max_entries = max_entries
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _key(req: Request) -> tuple:
+        return req.function, req.user_id, req.key
+
+    def get(self, req: Request):
+        with self._lock:
+            stored = self._entries.get(self._key(req))
+            if stored is None:
+                return None
+            if stored.expires_at < time.monotonic():
+                del self._entries[self._key(req)]
+                return None
+            self._entries.move_to_end(self._key(req))
+        return _check(req, stored)
+
+    def put(self, req: Request, stored: Stored):
+        with self._lock:
+            self._entries[self._key(req)] = stored
+            self._entries.move_to_end(self._key(req))
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+
+cache = ResponseCache()
+
+
+def claim(cur, req: Request):
+    '''Захватывает ключ в текущей транзакции.
+
+    Возвращает None, если действие нужно выполнить, или сохранённый ответ.
+    '''
+    cur.execute(CLAIM_SQL, req.params())
+    acquired, claimed = cur.fetchone()
+    if not acquired:
+        raise IdempotencyError(409, 'Запрос с этим Idempotency-Key ещё выполняется')
+    if claimed:
+        return None
+
+    cur.execute(STORED_SQL, req.params())
+    fingerprint, status, body = cur.fetchone()
+    if body is None:
+        raise IdempotencyError(409, 'Запрос с этим Idempotency-Key ещё выполняется')
+    stored = _check(req, Stored(fingerprint, status, body))
+    cache.put(req, stored)
+    return stored
+
+
+def store(cur, req: Request, status: int, payload: dict) -> Stored:
+    '''Записывает ответ в строку ключа; вызывается до commit действия'''
+    body = money.dumps(payload)
+    cur.execute(STORE_SQL, dict(req.params(), status=status, body=body))
+    if random.random() < SWEEP_PROBABILITY:
+        cur.execute(SWEEP_SQL, (TTL, SWEEP_BATCH))
+    return Stored(req.fingerprint, status, body)
+
+
+def replay(stored: Stored, headers: dict) -> dict:
+    return {
+        'statusCode': stored.status,
+        'headers': dict(headers, **{
+            'Idempotent-Replayed': 'true',
+            'Access-Control-Expose-Headers': 'Idempotent-Replayed'
+        }),
+        'body': stored.body,
+        'isBase64Encoded': False
+    }
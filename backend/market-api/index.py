@@ -1,282 +1,335 @@
 import json
-import os
-import psycopg2
-from datetime import datetime
-from decimal import Decimal
+import db
+import batch
+import candles
+import harvest
+import idempotency
+import instrument
+import listings
+import money
+import orderbook
+import shards
+import transfer
 
-def get_db_connection():
-    '''Подключение к БД'''
-    dsn = os.environ.get('DATABASE_URL')
-    return psycopg2.connect(dsn)
+# Объявление создаётся одним запросом: продавец блокируется, накопленное золото
+# фиксируется, остаток проверяется в WHERE, журнал и версия ленты пишутся в том же CTE
+CREATE_LISTING_SQL = f"""
+    WITH {harvest.PLAYER_CTE}, changed AS (
+        UPDATE players p
+        SET gold = p.gold + player.earned - %(amount)s,
+            {harvest.ADVANCE_HARVEST}
+        FROM player
+        WHERE p.id = player.id AND player.gold + player.earned >= %(amount)s
+        RETURNING p.id, p.gold, {harvest.CHANGED_RETURNING}
+    ), {harvest.HARVEST_LOG_CTE}, listed AS (
+        INSERT INTO market_listings (seller_id, seller_tag, gold_amount, price_per_kg, total_price)
+        SELECT id, RIGHT(%(user_id)s, 4), %(amount)s, %(price)s, %(total)s FROM changed
+        RETURNING id, seller_id
+    ), logged AS (
+        INSERT INTO transactions (player_id, type, amount, description)
+        SELECT seller_id, 'listing_created', %(amount)s, %(description)s FROM listed
+    ), bumped AS (
+        UPDATE market_version SET version = version + 1, updated_at = NOW()
+        WHERE id = 1 AND EXISTS (SELECT 1 FROM listed)
+    )
+    SELECT player.id, changed.gold, listed.id
+    FROM player
+    LEFT JOIN changed ON changed.id = player.id
+    LEFT JOIN listed ON true
+"""
 
-def handler(event: dict, context) -> dict:
-    '''API для P2P маркета: создание, просмотр и покупка объявлений'''
-    
-    method = event.get('httpMethod', 'GET')
-    
-    if method == 'OPTIONS':
+def listings_response(page, event: dict, headers: dict) -> dict:
+    '''Ответ ленты с ETag; при совпадении If-None-Match — 304 без тела'''
+    headers = dict(headers, **{
+        'ETag': page.etag,
+        'Cache-Control': 'no-cache',
+        'Access-Control-Expose-Headers': 'ETag'
+    })
+    if listings.if_none_match(event) == page.etag:
         return {
-            'statusCode': 200,
-            'headers': {
-                'Access-Control-Allow-Origin': '*',
-                'Access-Control-Allow-Methods': 'GET, POST, OPTIONS',
-                'Access-Control-Allow-Headers': 'Content-Type, X-User-Id'
-            },
+            'statusCode': 304,
+            'headers': headers,
             'body': '',
             'isBase64Encoded': False
         }
-    
+    return {
+        'statusCode': 200,
+        'headers': headers,
+        'body': page.body,
+        'isBase64Encoded': False
+    }
+
+def fetch_listings(params: dict):
+    '''Страница ленты; при нескольких узлах или репликах собирается со всех'''
+    cluster = shards.cluster()
+    with cluster.cursors(replica=cluster.has_replicas, cursor_factory=instrument.TimedCursor) as cursors:
+        if len(cursors) == 1:
+            return listings.cached_page(cursors[0], params)
+        return listings.merged_page(cursors, params)
+
+def remote_shards(cluster, cur) -> list:
+    '''Узлы, кроме узла, на котором открыт cur обработчика'''
+    own = cluster.shard_of(cur.connection)
+    return [shard for shard in range(cluster.count) if shard != own]
+
+def listings_page(cur, params: dict) -> tuple:
+    '''Страница ленты без кэша (для пакетных запросов); при нескольких узлах — со всех'''
+    cluster = shards.cluster()
+    try:
+        with cluster.cursors(remote_shards(cluster, cur), cursor_factory=instrument.TimedCursor) as remote:
+            return 200, listings.fetch_page(cur, params, remote)
+    except listings.PageError as e:
+        return 400, {'error': str(e)}
+
+def create_listing(cur, body: dict) -> tuple:
+    '''Создание объявления: золото списывается у продавца'''
+    try:
+        gold_amount = money.gold(body.get('gold_amount', 0))
+        price_per_kg = money.ton(body.get('price_per_kg', 0))
+    except money.MoneyError as e:
+        return 400, {'error': str(e)}
+
+    if gold_amount < 100:
+        return 400, {'error': 'Минимум 100 кг золота'}
+
+    if price_per_kg <= 0:
+        return 400, {'error': 'Цена должна быть больше 0'}
+
+    cur.execute(CREATE_LISTING_SQL, {
+        'user_id': body.get('user_id'),
+        'amount': gold_amount,
+        'price': price_per_kg,
+        'total': orderbook.trade_total(gold_amount, price_per_kg),
+        'description': f"Создано объявление на {gold_amount} кг по {price_per_kg} TON/кг"
+    })
+    player = cur.fetchone()
+
+    if not player:
+        return 404, {'error': 'Игрок не найден'}
+
+    player_id, new_gold, listing_id = player
+
+    if listing_id is None:
+        return 400, {'error': 'Недостаточно золота'}
+
+    return 200, {
+        'success': True,
+        'listing_id': listing_id,
+        'new_gold': new_gold
+    }
+
+def buy_listing(cur, body: dict) -> tuple:
+    '''Покупка объявления целиком с комиссией 5% с обеих сторон'''
+    try:
+        listing_id = int(body.get('listing_id'))
+    except (TypeError, ValueError):
+        return 404, {'error': 'Объявление не найдено'}
+
+    cluster = shards.cluster()
+    if cluster.count > 1:
+        # cur — узел покупателя; узел объявления виден по его id
+        listing_shard = cluster.for_id(listing_id)
+        if listing_shard is None:
+            return 404, {'error': 'Объявление не найдено'}
+        buyer_shard = cluster.shard_of(cur.connection)
+        if listing_shard != buyer_shard:
+            return transfer.purchase(cluster, cur.connection, body.get('user_id'), listing_id,
+                                     buyer_shard, listing_shard)
+
+    cur.execute(listings.BUY_SQL, {
+        'user_id': body.get('user_id'),
+        'listing_id': listing_id,
+        'fee_rate': orderbook.FEE_RATE
+    })
+    return listings.purchase_result(cur.fetchone())
+
+def place_order(cur, body: dict) -> tuple:
+    '''Лимитная заявка в книгу с частичным исполнением'''
+    user_id = body.get('user_id')
+    side = body.get('side')
+    try:
+        gold_amount = money.gold(body.get('gold_amount', 0))
+        price_per_kg = money.ton(body.get('price_per_kg', 0))
+    except money.MoneyError as e:
+        return 400, {'error': str(e)}
+
+    try:
+        result = orderbook.place_order(cur, user_id, side, gold_amount, price_per_kg)
+    except orderbook.OrderError as e:
+        return e.status_code, {'error': str(e)}
+
+    return 200, dict(result, success=True)
+
+def cancel_order(cur, body: dict) -> tuple:
+    '''Отмена открытой заявки с возвратом резерва'''
+    try:
+        return 200, orderbook.cancel_order(cur, body.get('user_id'), body.get('order_id'))
+    except orderbook.OrderError as e:
+        return e.status_code, {'error': str(e)}
+
+def price_candles(cur, params: dict) -> tuple:
+    '''Свечи OHLC по сделкам маркета на всех узлах'''
+    cluster = shards.cluster()
+    try:
+        with cluster.cursors(remote_shards(cluster, cur), cursor_factory=instrument.TimedCursor) as remote:
+            return 200, candles.fetch_candles(cur, params, remote)
+    except candles.CandleError as e:
+        return 400, {'error': str(e)}
+
+def order_book(cur, params: dict) -> tuple:
+    '''Ценовые уровни книги заявок всех узлов; сводятся заявки только внутри узла'''
+    try:
+        depth = min(max(int(params.get('depth', 20)), 1), 100)
+    except (TypeError, ValueError):
+        return 400, {'error': 'Неверный depth'}
+    cluster = shards.cluster()
+    with cluster.cursors(remote_shards(cluster, cur), cursor_factory=instrument.TimedCursor) as remote:
+        return 200, orderbook.book_depth(cur, depth, remote)
+
+# Действие -> (HTTP-метод, обработчик). Обработчик получает тело POST или
+# параметры GET и возвращает (статус, тело ответа); коммитит вызывающий код
+ACTIONS = {
+    'listings': ('GET', listings_page),
+    'create-listing': ('POST', create_listing),
+    'buy-listing': ('POST', buy_listing),
+    'place-order': ('POST', place_order),
+    'cancel-order': ('POST', cancel_order),
+    'order-book': ('GET', order_book),
+    'candles': ('GET', price_candles),
+}
+
+# Действия, после которых сбрасывается кэш ленты
+LISTING_WRITES = {'create-listing', 'buy-listing'}
+
+# Действия, повтор которых по Idempotency-Key отдаёт сохранённый ответ
+IDEMPOTENT = {'create-listing', 'buy-listing', 'place-order', 'cancel-order'}
+
+# Ответ на preflight один на все запросы; instrument его не трогает
+PREFLIGHT = {
+    'statusCode': 200,
+    'headers': {
+        'Access-Control-Allow-Origin': '*',
+        'Access-Control-Allow-Methods': 'GET, POST, OPTIONS',
+        'Access-Control-Allow-Headers': 'Content-Type, X-User-Id, If-None-Match, Idempotency-Key'
+    },
+    'body': '',
+    'isBase64Encoded': False
+}
+
+@instrument.instrumented('market-api', 'listings')
+def handler(event: dict, context) -> dict:
+    '''API для P2P маркета: объявления и книга заявок с частичным исполнением'''
+
+    method = event.get('httpMethod', 'GET')
+
+    if method == 'OPTIONS':
+        return PREFLIGHT
+
     headers = {
         'Content-Type': 'application/json',
         'Access-Control-Allow-Origin': '*'
     }
-    
+
+    query_params = event.get('queryStringParameters') or {}
+    action = query_params.get('action', 'listings')
+
     try:
-        conn = get_db_connection()
-        cur = conn.cursor()
-        
-        query_params = event.get('queryStringParameters') or {}
-        action = query_params.get('action', 'listings')
-        
         if action == 'listings' and method == 'GET':
-            cur.execute("""
-                SELECT ml.id, p.user_id, ml.gold_amount, ml.price_per_kg, ml.total_price, ml.created_at
-                FROM market_listings ml
-                JOIN players p ON ml.seller_id = p.id
-                WHERE ml.status = 'active'
-                ORDER BY ml.created_at DESC
-                LIMIT 50
-            """)
-            
-            listings = []
-            for row in cur.fetchall():
-                listing_id, seller_user_id, gold_amount, price_per_kg, total_price, created_at = row
-                listings.append({
-                    'id': listing_id,
-                    'seller': f"Player#{seller_user_id[-4:]}",
-                    'amount': float(gold_amount),
-                    'price': float(price_per_kg),
-                    'total': float(total_price),
-                    'created_at': created_at.isoformat()
-                })
-            
-            return {
-                'statusCode': 200,
-                'headers': headers,
-                'body': json.dumps({'listings': listings}),
-                'isBase64Encoded': False
-            }
-        
-        elif action == 'create-listing' and method == 'POST':
-            body = json.loads(event.get('body', '{}'))
-            user_id = body.get('user_id')
-            gold_amount = float(body.get('gold_amount', 0))
-            price_per_kg = float(body.get('price_per_kg', 0))
-            
-            if gold_amount < 100:
-                return {
-                    'statusCode': 400,
-                    'headers': headers,
-                    'body': json.dumps({'error': 'Минимум 100 кг золота'}),
-                    'isBase64Encoded': False
-                }
-            
-            if price_per_kg <= 0:
-                return {
-                    'statusCode': 400,
-                    'headers': headers,
-                    'body': json.dumps({'error': 'Цена должна быть больше 0'}),
-                    'isBase64Encoded': False
-                }
-            
-            cur.execute("SELECT id, gold FROM players WHERE user_id = %s", (user_id,))
-            player = cur.fetchone()
-            
-            if not player:
-                return {
-                    'statusCode': 404,
-                    'headers': headers,
-                    'body': json.dumps({'error': 'Игрок не найден'}),
-                    'isBase64Encoded': False
-                }
-            
-            player_id, current_gold = player
-            
-            if float(current_gold) < gold_amount:
-                return {
-                    'statusCode': 400,
-                    'headers': headers,
-                    'body': json.dumps({'error': 'Недостаточно золота'}),
-                    'isBase64Encoded': False
-                }
-            
-            total_price = gold_amount * price_per_kg
-            new_gold = float(current_gold) - gold_amount
-            
-            cur.execute(
-                "UPDATE players SET gold = %s WHERE id = %s",
-                (new_gold, player_id)
-            )
-            
-            cur.execute(
-                "INSERT INTO market_listings (seller_id, gold_amount, price_per_kg, total_price) VALUES (%s, %s, %s, %s) RETURNING id",
-                (player_id, gold_amount, price_per_kg, total_price)
-            )
-            listing_id = cur.fetchone()[0]
-            
-            cur.execute(
-                "INSERT INTO transactions (player_id, type, amount, description) VALUES (%s, %s, %s, %s)",
-                (player_id, 'listing_created', gold_amount, f"Создано объявление на {gold_amount} кг по {price_per_kg} TON/кг")
-            )
-            
-            conn.commit()
-            
-            return {
-                'statusCode': 200,
-                'headers': headers,
-                'body': json.dumps({
-                    'success': True,
-                    'listing_id': listing_id,
-                    'new_gold': new_gold
-                }),
-                'isBase64Encoded': False
-            }
-        
-        elif action == 'buy-listing' and method == 'POST':
-            body = json.loads(event.get('body', '{}'))
-            user_id = body.get('user_id')
-            listing_id = body.get('listing_id')
-            
-            cur.execute("""
-                SELECT ml.id, ml.seller_id, ml.gold_amount, ml.price_per_kg, ml.total_price, ml.status
-                FROM market_listings ml
-                WHERE ml.id = %s
-            """, (listing_id,))
-            
-            listing = cur.fetchone()
-            
-            if not listing:
-                return {
-                    'statusCode': 404,
-                    'headers': headers,
-                    'body': json.dumps({'error': 'Объявление не найдено'}),
-                    'isBase64Encoded': False
-                }
-            
-            _, seller_id, gold_amount, price_per_kg, total_price, status = listing
-            
-            if status != 'active':
-                return {
-                    'statusCode': 400,
-                    'headers': headers,
-                    'body': json.dumps({'error': 'Объявление уже неактивно'}),
-                    'isBase64Encoded': False
-                }
-            
-            cur.execute("SELECT id, ton_balance FROM players WHERE user_id = %s", (user_id,))
-            buyer = cur.fetchone()
-            
-            if not buyer:
-                return {
-                    'statusCode': 404,
-                    'headers': headers,
-                    'body': json.dumps({'error': 'Покупатель не найден'}),
-                    'isBase64Encoded': False
-                }
-            
-            buyer_id, buyer_balance = buyer
-            
-            if buyer_id == seller_id:
-                return {
-                    'statusCode': 400,
-                    'headers': headers,
-                    'body': json.dumps({'error': 'Нельзя купить своё объявление'}),
-                    'isBase64Encoded': False
-                }
-            
-            buyer_fee = float(total_price) * 0.05
-            total_cost = float(total_price) + buyer_fee
-            
-            if float(buyer_balance) < total_cost:
+            page = listings.cache.fresh(listings.PageCache.key(query_params))
+            if page:
+                return listings_response(page, event, headers)
+
+            try:
+                page = fetch_listings(query_params)
+            except listings.PageError as e:
                 return {
                     'statusCode': 400,
                     'headers': headers,
-                    'body': json.dumps({'error': f'Недостаточно TON. Нужно {total_cost:.4f} TON (включая комиссию 5%)'}),
+                    'body': money.error_body(str(e)),
                     'isBase64Encoded': False
                 }
-            
-            seller_fee = float(total_price) * 0.05
-            seller_receives = float(total_price) - seller_fee
-            
-            cur.execute("SELECT ton_balance, gold FROM players WHERE id = %s", (seller_id,))
-            seller_data = cur.fetchone()
-            seller_balance, seller_gold = seller_data
-            
-            new_buyer_balance = float(buyer_balance) - total_cost
-            new_seller_balance = float(seller_balance) + seller_receives
-            
-            cur.execute("SELECT gold FROM players WHERE id = %s", (buyer_id,))
-            buyer_gold = cur.fetchone()[0]
-            new_buyer_gold = float(buyer_gold) + float(gold_amount)
-            
-            cur.execute(
-                "UPDATE players SET ton_balance = %s, gold = %s WHERE id = %s",
-                (new_buyer_balance, new_buyer_gold, buyer_id)
-            )
-            
-            cur.execute(
-                "UPDATE players SET ton_balance = %s WHERE id = %s",
-                (new_seller_balance, seller_id)
-            )
-            
-            cur.execute(
-                "UPDATE market_listings SET status = 'sold', updated_at = NOW() WHERE id = %s",
-                (listing_id,)
-            )
-            
-            cur.execute(
-                "INSERT INTO transactions (player_id, type, amount, description) VALUES (%s, %s, %s, %s)",
-                (buyer_id, 'market_purchase', total_cost, f"Куплено {gold_amount} кг золота")
-            )
-            
-            cur.execute(
-                "INSERT INTO transactions (player_id, type, amount, description) VALUES (%s, %s, %s, %s)",
-                (seller_id, 'market_sale', seller_receives, f"Продано {gold_amount} кг золота")
-            )
-            
-            conn.commit()
-            
+
+            return listings_response(page, event, headers)
+
+        data = json.loads(event.get('body', '{}')) if method == 'POST' else query_params
+
+        idem = None
+        if method == 'POST' and action in IDEMPOTENT:
+            idem = idempotency.from_event(event, 'market-api', action, data)
+        if idem:
+            stored = idempotency.cache.get(idem)
+            if stored:
+                return idempotency.replay(stored, headers)
+
+        # Действия идут на узел игрока: там его баланс, объявления и заявки
+        cluster = shards.cluster()
+        if action == 'batch' and cluster.count > 1 and not batch.single_user(data):
             return {
-                'statusCode': 200,
+                'statusCode': 400,
                 'headers': headers,
-                'body': json.dumps({
-                    'success': True,
-                    'new_balance': new_buyer_balance,
-                    'new_gold': new_buyer_gold,
-                    'paid': total_cost,
-                    'fee': buyer_fee
-                }),
+                'body': money.error_body('Все действия пакета должны быть одного игрока'),
                 'isBase64Encoded': False
             }
-        
+        with instrument.span('connect'):
+            conn = cluster.acquire(cluster.for_user(data.get('user_id')))
+        cur = conn.cursor(cursor_factory=instrument.TimedCursor)
+
+        if action == 'batch' and method == 'POST':
+            status, payload, committed = batch.run(conn, cur, ACTIONS, data)
+            if LISTING_WRITES.intersection(committed):
+                listings.cache.invalidate()
+
+        elif action in ACTIONS and ACTIONS[action][0] == method:
+            if idem:
+                stored = idempotency.claim(cur, idem)
+                if stored:
+                    return idempotency.replay(stored, headers)
+            status, payload = ACTIONS[action][1](cur, data)
+            if status < 400 and method == 'POST':
+                if idem:
+                    stored = idempotency.store(cur, idem, status, payload)
+                instrument.commit(conn)
+                if idem:
+                    idempotency.cache.put(idem, stored)
+                if action in LISTING_WRITES:
+                    listings.cache.invalidate()
+
         else:
-            return {
-                'statusCode': 404,
-                'headers': headers,
-                'body': json.dumps({'error': 'Endpoint не найден'}),
-                'isBase64Encoded': False
-            }
-    
+            status, payload = 404, {'error': 'Endpoint не найден'}
+
+        with instrument.span('serialize'):
+            response_body = money.dumps(payload)
+
+        return {
+            'statusCode': status,
+            'headers': headers,
+            'body': response_body,
+            'isBase64Encoded': False
+        }
+
+    except idempotency.IdempotencyError as e:
+        if e.status_code == 409:
+            headers['Retry-After'] = '1'
+        return {
+            'statusCode': e.status_code,
+            'headers': headers,
+            'body': money.error_body(str(e)),
+            'isBase64Encoded': False
+        }
+
     except Exception as e:
+        instrument.fail(e)
         return {
             'statusCode': 500,
             'headers': headers,
             'body': json.dumps({'error': str(e)}),
             'isBase64Encoded': False
         }
-    
+
     finally:
         if 'cur' in locals():
             cur.close()
         if 'conn' in locals():
-            conn.close()
\ No newline at end of file
+            db.release(conn)
+        # Покупки с других узлов довершаются уже без соединения обработчика
+        transfer.finish(shards.cluster())
@@ -0,0 +1,257 @@
+'''Замеры обработки запроса: подключение, каждый запрос к БД, commit и сериализация.
+
+Декоратор instrumented() открывает трассу на время вызова handler, TimedCursor
+пишет в неё каждый execute, span() и commit() — остальные этапы, fail() —
+ошибку, которую handler перехватил и отдал ответом 500. По завершении
+запись уходит во все приёмники (по умолчанию — строка JSON в лог) и, если
+SERVER_TIMING=1, в заголовок Server-Timing ответа.
+'''
+import json
+import os
+import re
+import threading
+import time
+from contextlib import contextmanager
+import psycopg2
+import psycopg2.extensions
+
+SERVER_TIMING = os.environ.get('SERVER_TIMING') == '1'
+TIMING_LOG = os.environ.get('TIMING_LOG', '1') == '1'
+ERROR_MESSAGE_LENGTH = 300
+
+# Коды Postgres, которые означают ожидание блокировок или конфликт транзакций
+CONTENTION_CODES = {
+    '40001': 'serialization_failure',
+    '40P01': 'deadlock_detected',
+    '55P03': 'lock_not_available',
+    '57014': 'query_canceled',
+}
+
+_local = threading.local()
+_sinks = []
+
+
+class Trace:
+    '''Замеры одного вызова handler'''
+
+    def __init__(self, function: str, action: str):
+        self.function = function
+        self.action = action
+        self.started = time.perf_counter()
+        self.spans = {}
+        self.statements = {}
+        self.contention = []
+        self.error = None
+
+    def add_span(self, name: str, seconds: float):
+        self.spans[name] = self.spans.get(name, 0.0) + seconds
+
+    def add_statement(self, query, seconds: float, rows: int):
+        key = statement_key(query)
+        stat = self.statements.setdefault(key, {'calls': 0, 'ms': 0.0, 'rows': 0})
+        stat['calls'] += 1
+        stat['ms'] += seconds * 1000
+        stat['rows'] += max(rows, 0)
+        self.add_span('db', seconds)
+
+    def add_error(self, error: Exception):
+        code = getattr(error, 'pgcode', None)
+        if code in CONTENTION_CODES:
+            self.contention.append(CONTENTION_CODES[code])
+
+    def record(self, status: int, error: Exception = None) -> dict:
+        error = error if error is not None else self.error
+        total = time.perf_counter() - self.started
+        record = {
+            'event': 'request_timing',
+            'function': self.function,
+            'action': self.action,
+            'status': status,
+            'total_ms': round(total * 1000, 3),
+            'spans_ms': {name: round(seconds * 1000, 3) for name, seconds in self.spans.items()},
+            'statements': [
+                dict(sql=key, calls=stat['calls'], ms=round(stat['ms'], 3), rows=stat['rows'])
+                for key, stat in self.statements.items()
+            ],
+        }
+        if self.contention:
+            record['contention'] = self.contention
+        if error is not None:
+            record['error'] = type(error).__name__
+            record['error_message'] = str(error)[:ERROR_MESSAGE_LENGTH]
+        return record
+
+    def server_timing(self, record: dict) -> str:
+        parts = [f'{name};dur={ms}' for name, ms in record['spans_ms'].items()]
+        parts.append(f"total;dur={record['total_ms']}")
+        return ', '.join(parts)
+
+
+def statement_key(query) -> str:
+    '''Короткий ключ запроса для агрегации: первые слова без параметров'''
+    if isinstance(query, bytes):
+        query = query.decode('utf-8', 'replace')
+    return re.sub(r'\s+', ' ', str(query)).strip()[:80]
+
+
+def current():
+    return getattr(_local, 'trace', None)
+
+
+class TimedCursor(psycopg2.extensions.cursor):
+    '''Курсор, записывающий время и число строк каждого запроса в текущую трассу'''
+
+    def execute(self, query, vars=None):
+        trace = current()
+        if trace is None:
+            return super().execute(query, vars)
+        started = time.perf_counter()
+        try:
+            return super().execute(query, vars)
+        except psycopg2.Error as e:
+            trace.add_error(e)
+            raise
+        finally:
+            trace.add_statement(query, time.perf_counter() - started, self.rowcount)
+
+
+@contextmanager
+def span(name: str):
+    '''Замер произвольного этапа: подключение, сериализация'''
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        trace = current()
+        if trace is not None:
+            trace.add_span(name, time.perf_counter() - started)
+
+
+def fail(error: Exception):
+    '''Ошибка, которую handler перехватил сам и отдал ответом 500: попадает в запись трассы'''
+    trace = current()
+    if trace is not None:
+        trace.error = error
+
+
+def commit(conn):
+    '''conn.commit() с замером и учётом конфликтов сериализации'''
+    with span('commit'):
+        try:
+            conn.commit()
+        except psycopg2.Error as e:
+            trace = current()
+            if trace is not None:
+                trace.add_error(e)
+            raise
+
+
+def log_sink(record: dict):
+    if TIMING_LOG:
+        print(json.dumps(record, ensure_ascii=False), flush=True)
+
+
+def add_sink(sink):
+    '''Подключает приёмник записей: функция, принимающая dict'''
+    _sinks.append(sink)
+
+
+def remove_sink(sink):
+    _sinks.remove(sink)
+
+
+add_sink(log_sink)
+
+
+class HistogramSink:
+    '''Локальная агрегация: гистограммы длительности по действиям и запросам.
+
+    Корзины логарифмические (границы в мс удваиваются), поэтому память не
+    зависит от числа запросов. Подключается через add_sink(HistogramSink()).
+    '''
+
+    BOUNDS_MS = [0.25 * 2 ** i for i in range(18)]
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.actions = {}
+        self.statements = {}
+        self.contention = {}
+
+    def _observe(self, table: dict, key, ms: float):
+        buckets = table.setdefault(key, [0] * (len(self.BOUNDS_MS) + 1))
+        for index, bound in enumerate(self.BOUNDS_MS):
+            if ms <= bound:
+                buckets[index] += 1
+                return
+        buckets[-1] += 1
+
+    def __call__(self, record: dict):
+        with self._lock:
+            self._observe(self.actions, (record['function'], record['action']), record['total_ms'])
+            for stmt in record['statements']:
+                self._observe(self.statements, stmt['sql'], stmt['ms'] / stmt['calls'])
+            for kind in record.get('contention', []):
+                self.contention[kind] = self.contention.get(kind, 0) + 1
+
+    def quantile(self, buckets: list, q: float) -> float:
+        '''Верхняя граница корзины, в которую попадает квантиль q'''
+        total = sum(buckets)
+        seen = 0
+        for index, count in enumerate(buckets):
+            seen += count
+            if total and seen >= q * total:
+                return self.BOUNDS_MS[index] if index < len(self.BOUNDS_MS) else float('inf')
+        return 0.0
+
+    def snapshot(self) -> dict:
+        with self._lock:
+            return {
+                'actions': {
+                    f'{function}:{action}': {q: self.quantile(b, p) for q, p in (('p50', 0.5), ('p95', 0.95), ('p99', 0.99))}
+                    for (function, action), b in self.actions.items()
+                },
+                'statements': {
+                    key: {q: self.quantile(b, p) for q, p in (('p50', 0.5), ('p99', 0.99))}
+                    for key, b in self.statements.items()
+                },
+                'contention': dict(self.contention),
+            }
+
+
+def instrumented(function: str, default_action: str):
+    '''Декоратор handler: трасса на время вызова, запись в приёмники, Server-Timing'''
+
+    def decorate(handler):
+        def wrapper(event: dict, context) -> dict:
+            action = (event.get('queryStringParameters') or {}).get('action', default_action)
+            if event.get('httpMethod') == 'OPTIONS':
+                return handler(event, context)
+            trace = Trace(function, action)
+            _local.trace = trace
+            response, error = None, None
+            try:
+                response = handler(event, context)
+                return response
+            except Exception as e:
+                error = e
+                raise
+            finally:
+                _local.trace = None
+                record = trace.record(response['statusCode'] if response else 500, error)
+                for sink in list(_sinks):
+                    try:
+                        sink(record)
+                    except Exception:
+                        pass
+                if SERVER_TIMING and response is not None:
+                    response['headers'] = dict(response.get('headers') or {}, **{
+                        'Server-Timing': trace.server_timing(record),
+                        'Timing-Allow-Origin': '*'
+                    })
+
+        wrapper.__wrapped__ = handler
+        wrapper.__doc__ = handler.__doc__
+        return wrapper
+
+    return decorate
@@ -0,0 +1,396 @@
+import base64
+import hashlib
+import json
+import os
+import threading
+import time
+import candles
+import harvest
+from collections import OrderedDict
+from datetime import datetime
+from decimal import Decimal, InvalidOperation
+
+DEFAULT_LIMIT = 50
+MAX_LIMIT = 100
+CACHE_TTL = float(os.environ.get('LISTINGS_CACHE_TTL', '2'))
+CACHE_MAX_ENTRIES = 256
+
+VERSION_SQL = "SELECT version FROM market_version WHERE id = 1"
+
+# Покупка объявления одним запросом. Объявление и обе стороны блокируются сразу,
+# игроки — одним SELECT в порядке id, чтобы встречные покупки не взаимоблокировались.
+# Проверки собраны в deal, все записи (продажа, балансы, начисление покупателю,
+# журнал, свечи, версия ленты) идут от deal, поэтому при отказе ничего не меняется.
+# Строка результата есть, если объявление существует; пустой new_balance — отказ
+BUY_SQL = f"""
+    WITH listing AS (
+        SELECT id, seller_id, gold_amount, price_per_kg, total_price, status
+        FROM market_listings
+        WHERE id = %(listing_id)s
+        FOR UPDATE
+    ), parties AS (
+        SELECT id, user_id, goblins, ton_balance, {harvest.hours_sql()} AS hours
+        FROM players
+        WHERE user_id = %(user_id)s OR id = (SELECT seller_id FROM listing)
+        ORDER BY id
+        FOR UPDATE
+    ), buyer AS (
+        SELECT id, goblins, ton_balance, hours, {harvest.earned_sql()} AS earned
+        FROM parties
+        WHERE user_id = %(user_id)s
+    ), deal AS (
+        SELECT l.id, l.seller_id, buyer.id AS buyer_id, l.gold_amount, l.price_per_kg, l.total_price,
+               TRUNC(l.total_price * %(fee_rate)s, 4) AS fee, buyer.goblins, buyer.hours, buyer.earned
+        FROM listing l, buyer
+        WHERE l.status = 'active' AND l.seller_id <> buyer.id
+          AND buyer.ton_balance >= l.total_price + TRUNC(l.total_price * %(fee_rate)s, 4)
+    ), sold AS (
+        UPDATE market_listings m
+        SET status = 'sold', updated_at = NOW()
+        FROM deal
+        WHERE m.id = deal.id
+    ), changed AS (
+        UPDATE players p
+        SET ton_balance = p.ton_balance + CASE WHEN p.id = deal.buyer_id
+                THEN -(deal.total_price + deal.fee) ELSE deal.total_price - deal.fee END,
+            gold = p.gold + CASE WHEN p.id = deal.buyer_id THEN deal.gold_amount + deal.earned ELSE 0 END,
+            last_harvest = CASE WHEN p.id = deal.buyer_id
+                THEN p.last_harvest + deal.hours * INTERVAL '1 hour' ELSE p.last_harvest END
+        FROM deal
+        WHERE p.id IN (deal.buyer_id, deal.seller_id)
+        RETURNING p.id, p.ton_balance, p.gold
+    ), harvested AS (
+        INSERT INTO gold_harvests (player_id, gold_earned, goblins_count)
+        SELECT buyer_id, earned, goblins FROM deal WHERE hours >= 1
+    ), logged AS (
+        INSERT INTO transactions (player_id, type, amount, description)
+        SELECT buyer_id, 'market_purchase', total_price + fee, 'Куплено ' || gold_amount || ' кг золота' FROM deal
+        UNION ALL
+        SELECT seller_id, 'market_sale', total_price - fee, 'Продано ' || gold_amount || ' кг золота' FROM deal
+    ), charted AS (
+        {candles.UPSERT_SQL.format(trades='(SELECT 0, gold_amount, price_per_kg, total_price FROM deal)')}
+    ), bumped AS (
+        UPDATE market_version SET version = version + 1, updated_at = NOW()
+        WHERE id = 1 AND EXISTS (SELECT 1 FROM deal)
+    )
+    SELECT l.status, l.seller_id, buyer.id, l.total_price, TRUNC(l.total_price * %(fee_rate)s, 4),
+           changed.ton_balance, changed.gold
+    FROM listing l
+    LEFT JOIN buyer ON true
+    LEFT JOIN changed ON changed.id = buyer.id
+"""
+
+
+def _finite(value) -> Decimal:
+    '''Decimal из параметра запроса; nan и Infinity отклоняются, как в money.parse'''
+    number = Decimal(str(value))
+    if not number.is_finite():
+        raise InvalidOperation
+    return number
+
+
+# Ключ сортировки -> (колонка, направление по умолчанию, разбор значения из курсора)
+SORT_KEYS = {
+    'created_at': ('created_at', 'desc', datetime.fromisoformat),
+    'price_per_kg': ('price_per_kg', 'asc', _finite),
+}
+
+# Фильтр -> (колонка, оператор)
+FILTERS = {
+    'min_amount': ('gold_amount', '>='),
+    'max_amount': ('gold_amount', '<='),
+    'min_price': ('price_per_kg', '>='),
+    'max_price': ('price_per_kg', '<='),
+}
+
+
+COLUMNS_SQL = "id, seller_tag, gold_amount, price_per_kg, total_price, created_at"
+
+
+def _number_sql(column: str) -> str:
+    '''Число так, как его печатает money.dumps (float от Decimal): без нулей в конце, целое — с .0'''
+    return f"trim_scale({column})::text || CASE WHEN scale(trim_scale({column})) = 0 THEN '.0' ELSE '' END"
+
+
+# Объект объявления байт в байт как money.dumps(page_from_rows(...)): компактный
+# JSON, время — всегда с шестью знаками микросекунд
+DOCUMENT_SQL = f"""'{{"id":' || id || ',"seller":' || to_json('Player#' || COALESCE(seller_tag, ''))::text
+    || ',"amount":' || {_number_sql('gold_amount')}
+    || ',"price":' || {_number_sql('price_per_kg')}
+    || ',"total":' || {_number_sql('total_price')}
+    || ',"created_at":"' || to_char(created_at, 'YYYY-MM-DD"T"HH24:MI:SS.US') || '"}}'"""
+
+
+class PageError(ValueError):
+    '''Некорректные параметры страницы'''
+
+
+def encode_cursor(sort: str, value, listing_id: int) -> str:
+    raw = json.dumps([sort, str(value) if isinstance(value, Decimal) else value.isoformat(), listing_id])
+    return base64.urlsafe_b64encode(raw.encode()).decode().rstrip('=')
+
+
+def decode_cursor(cursor: str, sort: str) -> tuple:
+    try:
+        padded = cursor + '=' * (-len(cursor) % 4)
+        cursor_sort, value, listing_id = json.loads(base64.urlsafe_b64decode(padded))
+        if cursor_sort != sort:
+            raise PageError('Курсор относится к другой сортировке')
+        return SORT_KEYS[sort][2](value), int(listing_id)
+    except PageError:
+        raise
+    except (ValueError, TypeError, InvalidOperation):
+        raise PageError('Некорректный курсор')
+
+
+def build_query(params: dict, documents: bool = True) -> tuple:
+    '''Собирает keyset-запрос страницы активных объявлений.
+
+    При documents строка — id, ключ сортировки и готовый JSON объявления
+(page_body), иначе — колонки объявления (page_from_rows).
+    '''
+    sort = params.get('sort', 'created_at')
+    if not isinstance(sort, str) or sort not in SORT_KEYS:
+        raise PageError('Неверный ключ сортировки')
+    column, default_order, _ = SORT_KEYS[sort]
+    order = params.get('order', default_order)
+    if order not in ('asc', 'desc'):
+        raise PageError('Неверное направление сортировки')
+
+    try:
+        limit = min(max(int(params.get('limit', DEFAULT_LIMIT)), 1), MAX_LIMIT)
+    except (TypeError, ValueError):
+        raise PageError('Неверный limit')
+
+    conditions = ["status = 'active'"]
+    args = []
+    for name, (filter_column, op) in FILTERS.items():
+        if params.get(name) not in (None, ''):
+            try:
+                args.append(_finite(params[name]))
+            except InvalidOperation:
+                raise PageError(f'Неверное значение {name}')
+            conditions.append(f"{filter_column} {op} %s")
+
+    if params.get('cursor'):
+        value, listing_id = decode_cursor(params['cursor'], sort)
+        conditions.append(f"({column}, id) {'<' if order == 'desc' else '>'} (%s, %s)")
+        args.extend([value, listing_id])
+
+    # Лишняя строка показывает, есть ли следующая страница
+    args.append(limit + 1)
+    query = f"""
+        SELECT {f'id, {column}, {DOCUMENT_SQL}' if documents else COLUMNS_SQL}
+        FROM market_listings
+        WHERE {' AND '.join(conditions)}
+        ORDER BY {column} {order}, id {order}
+        LIMIT %s
+    """
+    return query, args, sort, limit
+
+
+def build_versioned_query(params: dict) -> tuple:
+    '''Страница вместе с версией объявлений одним запросом.
+
+    Версия и строки читаются в одном снимке, поэтому страницу можно сразу
+    сохранить под этой версией. Первая колонка — версия; у пустой страницы
+    остаётся одна строка с версией и NULL вместо объявления.
+    '''
+    query, args, sort, limit = build_query(params)
+    column, default_order, _ = SORT_KEYS[sort]
+    order = params.get('order', default_order)
+    versioned = f"""
+        SELECT v.version, p.*
+        FROM ({VERSION_SQL}) v
+        LEFT JOIN LATERAL ({query}) p ON true
+        ORDER BY p.{column} {order}, p.id {order}
+    """
+    return versioned, args, sort, limit
+
+
+def fetch_page(cur, params: dict, remote: list = ()) -> dict:
+    '''Страница ленты объявлений и курсор следующей страницы.
+
+    remote — курсоры остальных узлов: их первые limit + 1 строк сливаются со
+    строками cur в порядке сортировки.
+    '''
+    query, args, sort, limit = build_query(params, documents=False)
+    rows = []
+    for node in (cur, *remote):
+        node.execute(query, args)
+        rows.extend(node.fetchall())
+    if remote:
+        _, default_order, _ = SORT_KEYS[sort]
+        key_index = _key_index(sort)
+        rows.sort(key=lambda row: (row[key_index], row[0]), reverse=params.get('order', default_order) == 'desc')
+    return page_from_rows(rows, sort, limit)
+
+
+def _key_index(sort: str) -> int:
+    '''Номер колонки ключа сортировки в строке COLUMNS_SQL'''
+    return 5 if sort == 'created_at' else 3
+
+
+def _trim(rows: list, sort: str, limit: int, key_index: int) -> tuple:
+    '''Строки страницы и курсор следующей по лишней строке запроса'''
+    if len(rows) <= limit:
+        return rows, None
+    rows = rows[:limit]
+    last = rows[-1]
+    return rows, encode_cursor(sort, last[key_index], last[0])
+
+
+def page_from_rows(rows: list, sort: str, limit: int) -> dict:
+    rows, next_cursor = _trim(rows, sort, limit, _key_index(sort))
+    listings = []
+    for listing_id, seller_tag, gold_amount, price_per_kg, total_price, created_at in rows:
+        listings.append({
+            'id': listing_id,
+            'seller': f"Player#{seller_tag or ''}",
+            'amount': gold_amount,
+            'price': price_per_kg,
+            'total': total_price,
+            'created_at': created_at.isoformat(timespec='microseconds')
+        })
+    return {'listings': listings, 'next_cursor': next_cursor}
+
+
+def page_body(rows: list, sort: str, limit: int) -> str:
+    '''JSON страницы из строк с готовыми объектами объявлений: Python их только склеивает'''
+    rows, next_cursor = _trim(rows, sort, limit, 1)
+    return f'{{"listings":[{",".join(row[2] for row in rows)}],"next_cursor":{json.dumps(next_cursor)}}}'
+
+
+def purchase_result(row) -> tuple:
+    '''Статус и тело ответа по строке BUY_SQL'''
+    if not row:
+        return 404, {'error': 'Объявление не найдено'}
+
+    status, seller_id, buyer_id, total_price, fee, new_balance, new_gold = row
+
+    if status != 'active':
+        return 400, {'error': 'Объявление уже неактивно'}
+    if buyer_id is None:
+        return 404, {'error': 'Покупатель не найден'}
+    if buyer_id == seller_id:
+        return 400, {'error': 'Нельзя купить своё объявление'}
+    if new_balance is None:
+        return 400, {'error': f'Недостаточно TON. Нужно {total_price + fee:.4f} TON (включая комиссию 5%)'}
+
+    return 200, {
+        'success': True,
+        'new_balance': new_balance,
+        'new_gold': new_gold,
+        'paid': total_price + fee,
+        'fee': fee
+    }
+
+
+class CachedPage:
+    __slots__ = ('version', 'checked_at', 'body', 'etag')
+
+    def __init__(self, version: int, body: str, etag: str):
+        self.version = version
+        self.checked_at = time.monotonic()
+        self.body = body
+        self.etag = etag
+
+
+class PageCache:
+    '''Сериализованные страницы ленты, привязанные к версии market_version.
+
+    В пределах TTL страница отдаётся без обращения к БД; после TTL сверяется
+    только версия, и страница перезапрашивается, если объявления менялись.
+    '''
+
+    def __init__(self, ttl: float = CACHE_TTL, max_entries: int = CACHE_MAX_ENTRIES):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def key(params: dict) -> tuple:
+        return tuple(sorted((k, v) for k, v in params.items() if k != 'action'))
+
+    def fresh(self, key: tuple):
+        '''Страница, проверенная не раньше TTL назад'''
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None or time.monotonic() - entry.checked_at > self.ttl:
+                return None
+            self._entries.move_to_end(key)
+            return entry
+
+    def validate(self, key: tuple, version: int):
+        '''Страница той же версии; продлевает её TTL'''
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None or entry.version != version:
+                return None
+            entry.checked_at = time.monotonic()
+            self._entries.move_to_end(key)
+            return entry
+
+    def store(self, key: tuple, version: int, body: str) -> CachedPage:
+        digest = hashlib.blake2s(repr(key).encode(), digest_size=8).hexdigest()
+        entry = CachedPage(version, body, f'"{version}-{digest}"')
+        with self._lock:
+            self._entries[key] = entry
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+        return entry
+
+    def invalidate(self):
+        with self._lock:
+            self._entries.clear()
+
+
+cache = PageCache()
+
+
+def cached_page(cur, params: dict) -> CachedPage:
+    '''Страница ленты из кэша или из БД, если версия объявлений изменилась'''
+    key = PageCache.key(params)
+    # Версия читается до данных: если запись успеет закоммититься между ними,
+    # новые данные сохранятся под старой версией и будут перечитаны при следующей сверке
+    cur.execute(VERSION_SQL)
+    version = cur.fetchone()[0]
+    entry = cache.validate(key, version)
+    if entry is None:
+        query, args, sort, limit = build_query(params)
+        cur.execute(query, args)
+        entry = cache.store(key, version, page_body(cur.fetchall(), sort, limit))
+    return entry
+
+
+def merged_page(cursors: list, params: dict) -> CachedPage:
+    '''Страница ленты по нескольким узлам или их репликам.
+
+    Каждый узел отдаёт первые limit + 1 строк вместе со своей версией, строки
+    сливаются в порядке сортировки. Версия страницы — сумма версий узлов: она
+    растёт при любом изменении объявлений на любом узле.
+    '''
+    query, args, sort, limit = build_versioned_query(params)
+    _, default_order, _ = SORT_KEYS[sort]
+    version, rows = 0, []
+    for cur in cursors:
+        cur.execute(query, args)
+        part = cur.fetchall()
+        version += part[0][0]
+        rows.extend(row[1:] for row in part if row[1] is not None)
+
+    key = PageCache.key(params)
+    entry = cache.validate(key, version)
+    if entry is None:
+        rows.sort(key=lambda row: (row[1], row[0]), reverse=params.get('order', default_order) == 'desc')
+        entry = cache.store(key, version, page_body(rows, sort, limit))
+    return entry
+
+
+def if_none_match(event: dict) -> str:
+    for name, value in (event.get('headers') or {}).items():
+        if name.lower() == 'if-none-match':
+            return value
+    return None
@@ -0,0 +1,76 @@
+'''Денежные суммы: точность колонок БД и сериализация в JSON без float-арифметики.
+
+Золото хранится в DECIMAL(10, 2) (кг, шаг 10 г), TON — в DECIMAL(10, 4).
+В Python суммы держатся как Decimal, приведённый к шагу колонки, поэтому
+сложение и вычитание точны, а комиссии и начисления округляются явно.
+Во float сумма превращается только при выводе в JSON: число до 15 значащих
+цифр переходит в float и обратно без потерь, а в колонках их не больше 14.
+
+Если установлен orjson, dumps кодирует им (в несколько раз быстрее на длинных
+списках); без него — стандартный json, настроенный на те же байты: компактные
+разделители и UTF-8 без \\u-экранирования. Поэтому ответ (и его ETag) не зависит
+от того, есть ли orjson в окружении.
+'''
+import json
+from decimal import Decimal, InvalidOperation, ROUND_DOWN
+from functools import lru_cache
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+GOLD_QUANT = Decimal('0.01')
+TON_QUANT = Decimal('0.0001')
+
+
+class MoneyError(ValueError):
+    '''Сумма в запросе не число'''
+
+
+def parse(value, quant: Decimal, name: str) -> Decimal:
+    '''Сумма из тела запроса, округлённая вниз до шага колонки'''
+    if value is None or isinstance(value, bool):
+        raise MoneyError(f'Неверное значение {name}')
+    try:
+        amount = Decimal(str(value))
+        if not amount.is_finite():
+            raise InvalidOperation
+        return amount.quantize(quant, ROUND_DOWN)
+    except InvalidOperation:
+        raise MoneyError(f'Неверное значение {name}')
+
+
+def gold(value, name: str = 'gold_amount') -> Decimal:
+    return parse(value, GOLD_QUANT, name)
+
+
+def ton(value, name: str = 'price_per_kg') -> Decimal:
+    return parse(value, TON_QUANT, name)
+
+
+def _default(value):
+    if isinstance(value, Decimal):
+        return float(value)
+    raise TypeError(f'{type(value).__name__} не сериализуется в JSON')
+
+
+_encoder = json.JSONEncoder(default=_default, ensure_ascii=False, separators=(',', ':'))
+
+
+def stdlib_dumps(payload) -> str:
+    '''dumps стандартным json'''
+    return _encoder.encode(payload)
+
+
+def dumps(payload) -> str:
+    '''JSON тела ответа; Decimal выводится числом'''
+    if orjson is not None:
+        return orjson.dumps(payload, default=_default).decode()
+    return _encoder.encode(payload)
+
+
+@lru_cache(maxsize=256)
+def error_body(message: str) -> str:
+    '''Тело ответа с ошибкой; одинаковые сообщения сериализуются один раз'''
+    return _encoder.encode({'error': message})
@@ -0,0 +1,408 @@
+import heapq
+from decimal import Decimal, ROUND_DOWN
+import psycopg2.errors
+from psycopg2.extras import execute_values
+import candles
+import harvest
+from money import TON_QUANT
+
+FEE_RATE = Decimal('0.05')
+MIN_ORDER_GOLD = Decimal('100')
+MATCH_BATCH = 50
+DEADLOCK_RETRIES = 3
+
+# Все суммы сделок округляются вниз: тогда сумма списаний по частичным
+# исполнениям никогда не превышает резерв, взятый по лимитной цене
+def _ton(value: Decimal) -> Decimal:
+    return value.quantize(TON_QUANT, ROUND_DOWN)
+
+
+def trade_total(amount: Decimal, price: Decimal) -> Decimal:
+    return _ton(amount * price)
+
+
+def trade_fee(total: Decimal) -> Decimal:
+    return _ton(total * FEE_RATE)
+
+
+def buy_escrow(amount: Decimal, price: Decimal) -> Decimal:
+    '''Резерв TON под заявку на покупку: стоимость по лимитной цене плюс комиссия'''
+    total = trade_total(amount, price)
+    return total + trade_fee(total)
+
+
+class OrderError(Exception):
+    '''Заявку нельзя выставить или отменить'''
+
+    def __init__(self, status_code: int, message: str):
+        super().__init__(message)
+        self.status_code = status_code
+
+
+class Order:
+    __slots__ = ('id', 'player_id', 'side', 'price', 'remaining', 'escrow', 'status')
+
+    def __init__(self, id, player_id, side, price, remaining, escrow):
+        self.id = id
+        self.player_id = player_id
+        self.side = side
+        self.price = price
+        self.remaining = remaining
+        self.escrow = escrow
+        self.status = 'open'
+
+
+class OrderBook:
+    '''Одна сторона книги в памяти: лучшая цена, при равной цене — более ранняя заявка'''
+
+    def __init__(self, side: str):
+        self.side = side
+        self._heap = []
+
+    def _key(self, order: Order):
+        price = order.price if self.side == 'sell' else -order.price
+        return (price, order.id)
+
+    def add(self, order: Order):
+        heapq.heappush(self._heap, (self._key(order), order))
+
+    def best(self):
+        return self._heap[0][1] if self._heap else None
+
+    def pop(self) -> Order:
+        return heapq.heappop(self._heap)[1]
+
+    def __len__(self):
+        return len(self._heap)
+
+
+def crosses(taker: Order, maker: Order) -> bool:
+    if taker.side == 'buy':
+        return maker.price <= taker.price
+    return maker.price >= taker.price
+
+
+def match(taker: Order, book: OrderBook) -> list:
+    '''Сводит заявку с книгой противоположной стороны по цене мейкера'''
+    fills = []
+    while taker.remaining > 0 and book:
+        maker = book.best()
+        if not crosses(taker, maker):
+            break
+        amount = min(taker.remaining, maker.remaining)
+        fills.append((maker, amount, maker.price))
+        taker.remaining -= amount
+        maker.remaining -= amount
+        if maker.remaining == 0:
+            maker.status = 'filled'
+            book.pop()
+    if taker.remaining == 0:
+        taker.status = 'filled'
+    return fills
+
+
+def _placement_sql(side: str) -> str:
+    if side == 'sell':
+        reserve = "gold = p.gold + player.earned - %(amount)s"
+        enough = "player.gold + player.earned >= %(amount)s"
+    else:
+        reserve = "ton_balance = p.ton_balance - %(escrow)s, gold = p.gold + player.earned"
+        enough = "player.ton_balance >= %(escrow)s"
+    return f"""
+        WITH {harvest.PLAYER_CTE}, changed AS (
+            UPDATE players p
+            SET {reserve}, {harvest.ADVANCE_HARVEST}
+            FROM player
+            WHERE p.id = player.id AND {enough}
+            RETURNING p.id, p.gold, p.ton_balance, {harvest.CHANGED_RETURNING}
+        ), {harvest.HARVEST_LOG_CTE}, placed AS (
+            INSERT INTO market_orders (player_id, side, price_per_kg, gold_amount, remaining, escrow)
+            SELECT id, '{side}', %(price)s, %(amount)s, %(amount)s, %(escrow)s FROM changed
+            RETURNING id, player_id
+        ), logged AS (
+            INSERT INTO transactions (player_id, type, amount, description)
+            SELECT player_id, 'order_placed', %(ledger_amount)s, %(description)s FROM placed
+        )
+        SELECT player.id, placed.id, changed.gold, changed.ton_balance
+        FROM player
+        LEFT JOIN changed ON changed.id = player.id
+        LEFT JOIN placed ON placed.player_id = player.id
+    """
+
+
+PLACE_ORDER_SQL = {side: _placement_sql(side) for side in ('buy', 'sell')}
+
+# Следующая порция встречных заявок в порядке приоритета, начиная после (price, id).
+# Заявка блокируется вместе со строкой её владельца; занятые другой транзакцией
+# пропускаются, поэтому сведение не ждёт чужих блокировок и не замыкается в круг
+MAKERS_SQL = {
+    'buy': """
+        SELECT o.id, o.player_id, o.price_per_kg, o.remaining, o.escrow
+        FROM market_orders o
+        JOIN players p ON p.id = o.player_id
+        WHERE o.side = 'sell' AND o.status = 'open' AND o.price_per_kg <= %(price)s AND o.player_id <> %(player_id)s
+          AND (%(after_price)s IS NULL OR (o.price_per_kg, o.id) > (%(after_price)s, %(after_id)s))
+        ORDER BY o.price_per_kg ASC, o.id ASC
+        LIMIT %(limit)s
+        FOR UPDATE OF o, p SKIP LOCKED
+    """,
+    'sell': """
+        SELECT o.id, o.player_id, o.price_per_kg, o.remaining, o.escrow
+        FROM market_orders o
+        JOIN players p ON p.id = o.player_id
+        WHERE o.side = 'buy' AND o.status = 'open' AND o.price_per_kg >= %(price)s AND o.player_id <> %(player_id)s
+          AND (%(after_price)s IS NULL OR o.price_per_kg < %(after_price)s
+               OR (o.price_per_kg = %(after_price)s AND o.id > %(after_id)s))
+        ORDER BY o.price_per_kg DESC, o.id ASC
+        LIMIT %(limit)s
+        FOR UPDATE OF o, p SKIP LOCKED
+    """,
+}
+
+
+def _fill_book(cur, taker: Order, book: OrderBook, after: tuple) -> tuple:
+    '''Подгружает в книгу следующую порцию встречных заявок; возвращает новую позицию'''
+    cur.execute(MAKERS_SQL[taker.side], {
+        'price': taker.price,
+        'player_id': taker.player_id,
+        'after_price': after[0],
+        'after_id': after[1],
+        'limit': MATCH_BATCH,
+    })
+    rows = cur.fetchall()
+    maker_side = 'sell' if taker.side == 'buy' else 'buy'
+    for order_id, player_id, price, remaining, escrow in rows:
+        book.add(Order(order_id, player_id, maker_side, price, remaining, escrow))
+    return (rows[-1][2], rows[-1][0]) if rows else None
+
+
+def place_order(cur, user_id: str, side: str, amount: Decimal, price: Decimal) -> dict:
+    '''Выставляет лимитную заявку, сводит её с книгой и оставляет остаток открытым.
+
+    Заявка сводится только с заявками узла своего игрока: при нескольких узлах
+    у каждого своя книга, и встречные заявки с разных узлов не исполняются,
+    даже если цены пересекаются. Общими книга и свечи бывают только в ответах
+    на чтение (book_depth, candles.fetch_candles собирают все узлы).
+
+    Тейкер блокирует свою строку игрока при размещении, а встречные заявки
+    берёт вместе со строками их владельцев через SKIP LOCKED: заявка игрока,
+    который сейчас сам выставляет заявку или занят другим действием, в этот раз
+    пропускается. Так встречные тейкеры не ждут друг друга по кругу и могут
+    сводиться параллельно. На случай взаимоблокировки с другими действиями при
+    40P01 сведение повторяется с точки сохранения.
+    '''
+    if side not in PLACE_ORDER_SQL:
+        raise OrderError(400, 'Неверная сторона заявки')
+    if amount < MIN_ORDER_GOLD:
+        raise OrderError(400, 'Минимум 100 кг золота')
+    if price <= 0:
+        raise OrderError(400, 'Цена должна быть больше 0')
+
+    for attempt in range(DEADLOCK_RETRIES):
+        cur.execute("SAVEPOINT place_order")
+        try:
+            result = _place(cur, user_id, side, amount, price)
+        except psycopg2.errors.DeadlockDetected:
+            cur.execute("ROLLBACK TO SAVEPOINT place_order")
+            if attempt + 1 == DEADLOCK_RETRIES:
+                raise
+            continue
+        except OrderError:
+            cur.execute("RELEASE SAVEPOINT place_order")
+            raise
+        cur.execute("RELEASE SAVEPOINT place_order")
+        return result
+
+
+def _place(cur, user_id: str, side: str, amount: Decimal, price: Decimal) -> dict:
+    escrow = buy_escrow(amount, price) if side == 'buy' else Decimal('0')
+    side_name = 'покупку' if side == 'buy' else 'продажу'
+    reserved = f"{escrow} TON" if side == 'buy' else f"{amount} кг золота"
+    cur.execute(PLACE_ORDER_SQL[side], {
+        'user_id': user_id,
+        'amount': amount,
+        'price': price,
+        'escrow': escrow,
+        'ledger_amount': escrow if side == 'buy' else amount,
+        'description': f"Заявка на {side_name} {amount} кг по {price} TON/кг, в резерве {reserved}",
+    })
+    row = cur.fetchone()
+    if not row:
+        raise OrderError(404, 'Игрок не найден')
+    player_id, order_id, gold, ton_balance = row
+    if order_id is None:
+        raise OrderError(400, 'Недостаточно TON' if side == 'buy' else 'Недостаточно золота')
+
+    taker = Order(order_id, player_id, side, price, amount, escrow)
+    book = OrderBook('sell' if side == 'buy' else 'buy')
+    after = (None, None)
+    fills = []
+    while taker.remaining > 0 and after is not None:
+        after = _fill_book(cur, taker, book, after)
+        fills.extend(match(taker, book))
+
+    if fills:
+        gold, ton_balance = _settle_fills(cur, taker, fills, gold, ton_balance)
+
+    return {
+        'order_id': order_id,
+        'status': taker.status,
+        'filled': amount - taker.remaining,
+        'remaining': taker.remaining,
+        'fills': [{'price': fill_price, 'amount': fill_amount} for _, fill_amount, fill_price in fills],
+        'new_gold': gold,
+        'new_balance': ton_balance,
+    }
+
+
+def _settle_fills(cur, taker: Order, fills: list, gold: Decimal, ton_balance: Decimal) -> tuple:
+    '''Записывает исполнения пачкой: заявки, балансы, сделки и журнал транзакций.
+
+    Строка журнала — одно движение баланса в одной единице. TON покупателя уже
+    ушли в резерв строкой order_placed, поэтому исполнение пишет ему полученное
+    золото (order_filled, кг), а неиспользованный резерв — order_refund (TON).
+    Золото продавца ушло в order_placed, исполнение пишет выручку (market_sale, TON).
+    '''
+    deltas = {}
+    trades = []
+    ledger = []
+
+    def credit(player_id, d_gold=Decimal('0'), d_ton=Decimal('0')):
+        prev_gold, prev_ton = deltas.get(player_id, (Decimal('0'), Decimal('0')))
+        deltas[player_id] = (prev_gold + d_gold, prev_ton + d_ton)
+
+    for maker, amount, price in fills:
+        buy, sell = (taker, maker) if taker.side == 'buy' else (maker, taker)
+        total = trade_total(amount, price)
+        fee = trade_fee(total)
+        buy.escrow -= total + fee
+        credit(buy.player_id, d_gold=amount)
+        credit(sell.player_id, d_ton=total - fee)
+        trades.append((buy.id, sell.id, buy.player_id, sell.player_id, amount, price, total))
+        ledger.append((buy.player_id, 'order_filled', amount,
+                       f"Куплено {amount} кг золота по {price} TON/кг за {total + fee} TON с комиссией"))
+        ledger.append((sell.player_id, 'market_sale', total - fee, f"Продано {amount} кг золота"))
+
+    touched = {maker.id: maker for maker, _, _ in fills}
+    touched[taker.id] = taker
+    for order in touched.values():
+        if order.side == 'buy' and order.status == 'filled' and order.escrow:
+            # Остаток резерва после исполнения по лучшей цене возвращается покупателю
+            credit(order.player_id, d_ton=order.escrow)
+            ledger.append((order.player_id, 'order_refund', order.escrow, f"Возврат остатка резерва заявки #{order.id}"))
+            order.escrow = Decimal('0')
+
+    execute_values(cur, """
+        UPDATE market_orders o
+        SET remaining = v.remaining, escrow = v.escrow, status = v.status, updated_at = NOW()
+        FROM (VALUES %s) v(id, remaining, escrow, status)
+        WHERE o.id = v.id
+    """, [(o.id, o.remaining, o.escrow, o.status) for o in touched.values()],
+        template='(%s, %s::numeric, %s::numeric, %s)')
+
+    # Все стороны сделок уже заблокированы: тейкер размещением, мейкеры в MAKERS_SQL
+    balances = execute_values(cur, """
+        UPDATE players p
+        SET gold = p.gold + v.d_gold, ton_balance = p.ton_balance + v.d_ton
+        FROM (VALUES %s) v(id, d_gold, d_ton)
+        WHERE p.id = v.id
+        RETURNING p.id, p.gold, p.ton_balance
+    """, sorted((pid, dg, dt) for pid, (dg, dt) in deltas.items()),
+        template='(%s, %s::numeric, %s::numeric)', fetch=True)
+
+    execute_values(cur, """
+        INSERT INTO market_trades (buy_order_id, sell_order_id, buyer_id, seller_id, gold_amount, price_per_kg, total_price)
+        VALUES %s
+    """, trades)
+    execute_values(cur, "INSERT INTO transactions (player_id, type, amount, description) VALUES %s", ledger)
+    candles.record(cur, [(amount, price, total) for _, _, _, _, amount, price, total in trades])
+
+    for player_id, new_gold, new_ton in balances:
+        if player_id == taker.player_id:
+            return new_gold, new_ton
+    return gold, ton_balance
+
+
+CANCEL_ORDER_SQL = """
+    WITH target AS (
+        SELECT o.id, o.player_id, o.side, o.remaining, o.escrow
+        FROM market_orders o
+        JOIN players p ON p.id = o.player_id
+        WHERE o.id = %(order_id)s AND p.user_id = %(user_id)s AND o.status = 'open'
+        FOR UPDATE OF o
+    ), cancelled AS (
+        UPDATE market_orders o
+        SET status = 'cancelled', remaining = 0, escrow = 0, updated_at = NOW()
+        FROM target t
+        WHERE o.id = t.id
+        RETURNING t.player_id, t.side,
+                  CASE WHEN t.side = 'sell' THEN t.remaining ELSE 0 END AS gold_back,
+                  CASE WHEN t.side = 'buy' THEN t.escrow ELSE 0 END AS ton_back
+    ), refunded AS (
+        UPDATE players p
+        SET gold = p.gold + c.gold_back, ton_balance = p.ton_balance + c.ton_back
+        FROM cancelled c
+        WHERE p.id = c.player_id
+        RETURNING p.id, p.gold, p.ton_balance
+    ), logged AS (
+        INSERT INTO transactions (player_id, type, amount, description)
+        SELECT player_id, 'order_cancelled',
+               CASE WHEN side = 'sell' THEN gold_back ELSE ton_back END,
+               'Заявка отменена, возвращено '
+                   || CASE WHEN side = 'sell' THEN gold_back || ' кг золота' ELSE ton_back || ' TON' END
+        FROM cancelled
+    )
+    SELECT gold, ton_balance FROM refunded
+"""
+
+
+def cancel_order(cur, user_id: str, order_id) -> dict:
+    '''Отменяет открытую заявку игрока и возвращает зарезервированное'''
+    try:
+        order_id = int(order_id)
+    except (TypeError, ValueError):
+        raise OrderError(400, 'Неверный order_id')
+    cur.execute(CANCEL_ORDER_SQL, {'user_id': user_id, 'order_id': order_id})
+    row = cur.fetchone()
+    if not row:
+        raise OrderError(404, 'Открытая заявка не найдена')
+    gold, ton_balance = row
+    return {'success': True, 'new_gold': gold, 'new_balance': ton_balance}
+
+
+BOOK_DEPTH_SQL = {
+    'sell': """
+        SELECT price_per_kg, SUM(remaining), COUNT(*)
+        FROM market_orders
+        WHERE side = 'sell' AND status = 'open'
+        GROUP BY price_per_kg
+        ORDER BY price_per_kg ASC
+        LIMIT %s
+    """,
+    'buy': """
+        SELECT price_per_kg, SUM(remaining), COUNT(*)
+        FROM market_orders
+        WHERE side = 'buy' AND status = 'open'
+        GROUP BY price_per_kg
+        ORDER BY price_per_kg DESC
+        LIMIT %s
+    """,
+}
+
+
+def book_depth(cur, depth: int, remote: list = ()) -> dict:
+    '''Агрегированные ценовые уровни обеих сторон книги; remote — курсоры остальных узлов'''
+    result = {}
+    for side, key in (('buy', 'bids'), ('sell', 'asks')):
+        levels = {}
+        for node in (cur, *remote):
+            node.execute(BOOK_DEPTH_SQL[side], (depth,))
+            for price, amount, orders in node.fetchall():
+                level = levels.setdefault(price, [0, 0])
+                level[0] += amount
+                level[1] += orders
+        result[key] = [
+            {'price': price, 'amount': levels[price][0], 'orders': levels[price][1]}
+            for price in sorted(levels, reverse=side == 'buy')[:depth]
+        ]
+    return result
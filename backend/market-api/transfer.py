@@ -0,0 +1,269 @@
+'''Покупка объявления, когда покупатель и объявление живут на разных узлах.
+
+Одним запросом два узла не охватить, а подготовленные транзакции требуют
+max_prepared_transactions, который в Postgres по умолчанию 0. Поэтому покупка
+идёт тремя короткими транзакциями, исход которых записан на обоих узлах:
+
+1. на узле объявления оно получает статус 'reserved', пишется shard_transfers;
+2. на узле покупателя одним запросом списываются TON, начисляется золото и
+   пишется shard_inbox 'applied' — только если средств хватает. Списание идёт в
+   транзакции обработчика и коммитится вместе с ней (и с ответом на
+   Idempotency-Key);
+3. на узле объявления оно продаётся, продавцу зачисляется выручка.
+
+Шаг 3 выполняет finish() после того, как обработчик вернул соединение: resolve()
+пишет в shard_inbox 'aborted', если там ещё нет 'applied', и по первой записи
+довершает или отменяет покупку. Если процесс упал посередине, зависшие покупки
+разбирает крон:
+    python transfer.py --older-than 60
+'''
+import argparse
+import threading
+import time
+import uuid
+import psycopg2
+import candles
+import harvest
+import instrument
+import orderbook
+import shards
+
+DEFAULT_OLDER_THAN = 60
+DEFAULT_LIMIT = 1000
+
+# Строка есть, если объявление существует; пустой gold_amount — оно уже не активно
+RESERVE_SQL = """
+    WITH listing AS (
+        SELECT status FROM market_listings WHERE id = %(listing_id)s
+    ), reserved AS (
+        UPDATE market_listings
+        SET status = 'reserved', updated_at = NOW()
+        WHERE id = %(listing_id)s AND status = 'active'
+        RETURNING id, gold_amount, total_price, TRUNC(total_price * %(fee_rate)s, 4) AS fee
+    ), recorded AS (
+        INSERT INTO shard_transfers (id, listing_id, buyer_shard, buyer_user_id, total_price, fee)
+        SELECT %(transfer_id)s, id, %(buyer_shard)s, %(user_id)s, total_price, fee FROM reserved
+    ), bumped AS (
+        UPDATE market_version SET version = version + 1, updated_at = NOW()
+        WHERE id = 1 AND EXISTS (SELECT 1 FROM reserved)
+    )
+    SELECT listing.status, reserved.gold_amount, reserved.total_price, reserved.fee
+    FROM listing LEFT JOIN reserved ON true
+"""
+
+# Входящая запись и списание — в одном запросе: 'applied' появляется ровно тогда,
+# когда списаны деньги. Если 'aborted' уже записан, списания не будет
+DEBIT_SQL = f"""
+    WITH {harvest.PLAYER_CTE}, claimed AS (
+        INSERT INTO shard_inbox (transfer_id, state)
+        SELECT %(transfer_id)s, 'applied' FROM player WHERE player.ton_balance >= %(cost)s
+        ON CONFLICT (transfer_id) DO NOTHING
+        RETURNING transfer_id
+    ), changed AS (
+        UPDATE players p
+        SET ton_balance = p.ton_balance - %(cost)s,
+            gold = p.gold + player.earned + %(amount)s,
+            {harvest.ADVANCE_HARVEST}
+        FROM player, claimed
+        WHERE p.id = player.id
+        RETURNING p.id, p.ton_balance, p.gold, {harvest.CHANGED_RETURNING}
+    ), {harvest.HARVEST_LOG_CTE}, logged AS (
+        INSERT INTO transactions (player_id, type, amount, description)
+        SELECT id, 'market_purchase', %(cost)s, %(description)s FROM changed
+    )
+    SELECT player.id, changed.ton_balance, changed.gold
+    FROM player LEFT JOIN changed ON changed.id = player.id
+"""
+
+# Первая запись решает исход. Вторая часть не видит вставку из первой, поэтому
+# строка ровно одна — кроме случая, когда конкурирующая вставка закоммитилась
+# уже после начала запроса: тогда запрос повторяется
+ABORT_SQL = """
+    WITH aborted AS (
+        INSERT INTO shard_inbox (transfer_id, state) VALUES (%(transfer_id)s, 'aborted')
+        ON CONFLICT (transfer_id) DO NOTHING
+        RETURNING state
+    )
+    SELECT state FROM aborted
+    UNION ALL
+    SELECT state FROM shard_inbox WHERE transfer_id = %(transfer_id)s
+"""
+
+SETTLE_SQL = f"""
+    WITH transfer AS (
+        UPDATE shard_transfers
+        SET state = 'settled', updated_at = NOW()
+        WHERE id = %(transfer_id)s AND state = 'reserved'
+        RETURNING listing_id, fee
+    ), sold AS (
+        UPDATE market_listings m
+        SET status = 'sold', updated_at = NOW()
+        FROM transfer
+        WHERE m.id = transfer.listing_id
+        RETURNING m.seller_id, m.gold_amount, m.price_per_kg, m.total_price, transfer.fee
+    ), credited AS (
+        UPDATE players p
+        SET ton_balance = p.ton_balance + sold.total_price - sold.fee
+        FROM sold
+        WHERE p.id = sold.seller_id
+    ), logged AS (
+        INSERT INTO transactions (player_id, type, amount, description)
+        SELECT seller_id, 'market_sale', total_price - fee, 'Продано ' || gold_amount || ' кг золота' FROM sold
+    ), charted AS (
+        {candles.UPSERT_SQL.format(trades='(SELECT 0, gold_amount, price_per_kg, total_price FROM sold)')}
+    )
+    SELECT COUNT(*) FROM transfer
+"""
+
+CANCEL_SQL = """
+    WITH transfer AS (
+        UPDATE shard_transfers
+        SET state = 'cancelled', updated_at = NOW()
+        WHERE id = %(transfer_id)s AND state = 'reserved'
+        RETURNING listing_id
+    ), restored AS (
+        UPDATE market_listings m
+        SET status = 'active', updated_at = NOW()
+        FROM transfer
+        WHERE m.id = transfer.listing_id AND m.status = 'reserved'
+        RETURNING m.id
+    ), bumped AS (
+        UPDATE market_version SET version = version + 1, updated_at = NOW()
+        WHERE id = 1 AND EXISTS (SELECT 1 FROM restored)
+    )
+    SELECT COUNT(*) FROM transfer
+"""
+
+STALE_SQL = """
+    SELECT id, buyer_shard FROM shard_transfers
+    WHERE state = 'reserved' AND created_at < NOW() - %s * INTERVAL '1 second'
+    ORDER BY created_at
+    LIMIT %s
+"""
+
+
+# Покупки, начатые обработчиком в этом потоке и ещё не довершённые
+_local = threading.local()
+
+
+def _pending() -> list:
+    if not hasattr(_local, 'transfers'):
+        _local.transfers = []
+    return _local.transfers
+
+
+def _execute(conn, query: str, params: dict):
+    with conn.cursor(cursor_factory=instrument.TimedCursor) as cur:
+        cur.execute(query, params)
+        return cur.fetchone()
+
+
+def _run(cluster, shard: int, query: str, params: dict):
+    '''Один запрос в своей транзакции на узле shard; первая строка результата'''
+    with cluster.connection(shard) as conn:
+        row = _execute(conn, query, params)
+        instrument.commit(conn)
+    return row
+
+
+def purchase(cluster, conn, user_id: str, listing_id: int, buyer_shard: int, listing_shard: int) -> tuple:
+    '''Покупка объявления с другого узла; статус и тело ответа как у listings.purchase_result.
+
+    conn — соединение обработчика к узлу покупателя: списание остаётся в его
+    транзакции, коммитит обработчик. После этого он вызывает finish().
+    '''
+    transfer_id = str(uuid.uuid4())
+    row = _run(cluster, listing_shard, RESERVE_SQL, {
+        'transfer_id': transfer_id,
+        'listing_id': listing_id,
+        'buyer_shard': buyer_shard,
+        'user_id': user_id,
+        'fee_rate': orderbook.FEE_RATE
+    })
+    if not row:
+        return 404, {'error': 'Объявление не найдено'}
+    _, gold_amount, total_price, fee = row
+    if gold_amount is None:
+        return 400, {'error': 'Объявление уже неактивно'}
+
+    # Резерв есть: что бы ни случилось дальше, finish() его довершит или снимет
+    _pending().append((transfer_id, listing_shard, buyer_shard))
+    player = _execute(conn, DEBIT_SQL, {
+        'transfer_id': transfer_id,
+        'user_id': user_id,
+        'cost': total_price + fee,
+        'amount': gold_amount,
+        'description': f'Куплено {gold_amount} кг золота'
+    })
+    if not player:
+        return 404, {'error': 'Покупатель не найден'}
+    if player[1] is None:
+        return 400, {'error': f'Недостаточно TON. Нужно {total_price + fee:.4f} TON (включая комиссию 5%)'}
+
+    return 200, {
+        'success': True,
+        'new_balance': player[1],
+        'new_gold': player[2],
+        'paid': total_price + fee,
+        'fee': fee
+    }
+
+
+def finish(cluster):
+    '''Довершает или отменяет покупки этого потока.
+
+    Вызывается, когда транзакция обработчика закоммичена или откатана и его
+    соединение возвращено в пул; исход каждой покупки решает shard_inbox.
+    '''
+    transfers, _local.transfers = _pending(), []
+    for transfer_id, listing_shard, buyer_shard in transfers:
+        try:
+            resolve(cluster, transfer_id, listing_shard, buyer_shard)
+        except (psycopg2.Error, RuntimeError):
+            # Исход уже записан или будет записан кроном; покупку он и довершит
+            pass
+
+
+def resolve(cluster, transfer_id: str, listing_shard: int, buyer_shard: int) -> str:
+    '''Довершает или отменяет покупку по первой записи shard_inbox у покупателя'''
+    for _ in range(2):
+        row = _run(cluster, buyer_shard, ABORT_SQL, {'transfer_id': transfer_id})
+        if row:
+            break
+    else:
+        raise RuntimeError(f'Не удалось определить исход покупки {transfer_id}')
+
+    if row[0] == 'applied':
+        _run(cluster, listing_shard, SETTLE_SQL, {'transfer_id': transfer_id})
+        return 'settled'
+    _run(cluster, listing_shard, CANCEL_SQL, {'transfer_id': transfer_id})
+    return 'cancelled'
+
+
+def recover(cluster, older_than: float = DEFAULT_OLDER_THAN, limit: int = DEFAULT_LIMIT) -> dict:
+    '''Разбирает покупки, зависшие в 'reserved' дольше older_than секунд, на всех узлах'''
+    stats = {'settled': 0, 'cancelled': 0}
+    for shard in range(cluster.count):
+        with cluster.connection(shard) as conn:
+            with conn.cursor() as cur:
+                cur.execute(STALE_SQL, (older_than, limit))
+                stale = cur.fetchall()
+        for transfer_id, buyer_shard in stale:
+            stats[resolve(cluster, str(transfer_id), shard, buyer_shard)] += 1
+    return stats
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Восстановление покупок объявлений между узлами')
+    parser.add_argument('--older-than', type=float, default=DEFAULT_OLDER_THAN, help='секунд с резервирования')
+    parser.add_argument('--limit', type=int, default=DEFAULT_LIMIT, help='покупок на узел за запуск')
+    args = parser.parse_args()
+
+    started = time.monotonic()
+    stats = recover(shards.cluster(), args.older_than, args.limit)
+    stats['seconds'] = round(time.monotonic() - started, 3)
+    print(stats)
+
+
+if __name__ == '__main__':
+    main()
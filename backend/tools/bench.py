@@ -0,0 +1,317 @@
+'''Нагрузочный прогон обработчиков game-api и market-api на одноразовой базе.
+
+    cd backend && python -m tools.bench --players 10000 --listings 5000 --json bench.json
+
+Без --dsn поднимается свой кластер Postgres (initdb и pg_ctl из PATH или PG_BIN);
+с --dsn на указанном сервере создаётся и потом удаляется отдельная база.
+--shards N поднимает N размеченных узлов (SHARD_URLS), игроки раскладываются
+по ним тем же кольцом, что у обработчиков.
+Обработчики вызываются в процессе как handler(event, context); по каждому
+действию считаются p50/p95/p99, пропускная способность и число запросов к БД.
+'''
+import argparse
+import json
+import os
+import random
+import sys
+import threading
+import time
+from collections import Counter, defaultdict
+from concurrent.futures import ThreadPoolExecutor
+import psycopg2
+from tools.functions import load_function
+from tools.pg import throwaway_cluster
+
+_counter = threading.local()
+
+
+def count_queries(module):
+    '''Считает запросы к БД текущего потока по записям instrument функции'''
+    def counting_sink(record: dict):
+        _counter.queries = getattr(_counter, 'queries', 0) + sum(s['calls'] for s in record['statements'])
+
+    module.instrument.add_sink(counting_sink)
+
+
+def seed(dsn: str, players: int, listings: int, numbers: list = None):
+    '''Игроки с балансами и активные объявления, одной вставкой на таблицу.
+
+    numbers — номера игроков этого узла; без них на узел идут все.
+    '''
+    memo_codes = load_function('game-api').memo_codes
+    conn = psycopg2.connect(dsn)
+    with conn.cursor() as cur:
+        cur.execute(f"""
+            INSERT INTO players (user_id, memo_code, goblins, gold, ton_balance, last_harvest)
+            SELECT 'bench_' || g, {memo_codes.NEXT_MEMO_SQL},
+                   3000 + (g %% 50) * 300, 50000, 50000,
+                   LOCALTIMESTAMP - (g %% 72) * INTERVAL '1 hour'
+            FROM {'generate_series(1, %(players)s)' if numbers is None else 'unnest(%(numbers)s::int[])'} g
+        """, {'players': players, 'numbers': numbers})
+        cur.execute("""
+            INSERT INTO market_listings (seller_id, seller_tag, gold_amount, price_per_kg, total_price, created_at)
+            SELECT p.id, RIGHT(p.user_id, 4), l.amount, l.price, l.amount * l.price,
+                   NOW() - l.g * INTERVAL '1 second'
+            FROM (
+                SELECT g, 1 + (g * 7919) %% %s AS seller, 100 + (g %% 20) * 10 AS amount,
+                       ROUND((0.05 + (g %% 97) / 200.0)::numeric, 4) AS price
+                FROM generate_series(1, %s) g
+            ) l
+            JOIN players p ON p.user_id = 'bench_' || l.seller
+        """, (players, listings))
+        cur.execute("ANALYZE")
+    conn.commit()
+    conn.close()
+
+
+def user(rng: random.Random, players: int) -> str:
+    return f'bench_{rng.randint(1, players)}'
+
+
+def browse(rng, ctx):
+    '''Просмотр: лента с разными сортировками и фильтрами, книга заявок, init'''
+    roll = rng.random()
+    if roll < 0.85:
+        params = {'sort': rng.choice(['created_at', 'price_per_kg'])}
+        if rng.random() < 0.3:
+            params['min_amount'] = str(rng.choice([100, 150, 200]))
+        return 'market-api', 'listings', 'GET', params
+    if roll < 0.95:
+        return 'market-api', 'order-book', 'GET', {}
+    return 'game-api', 'init', 'POST', {'user_id': user(rng, ctx['players'])}
+
+
+def contended_buy(rng, ctx):
+    '''Гонка покупателей за самыми дешёвыми объявлениями'''
+    return 'market-api', 'buy-listing', 'POST', {
+        'user_id': user(rng, ctx['players']),
+        'listing_id': rng.choice(ctx['cheapest']),
+    }
+
+
+def registration(rng, ctx):
+    '''Всплеск регистраций новых игроков'''
+    return 'game-api', 'init', 'POST', {'user_id': f'new_{ctx["run"]}_{rng.getrandbits(48)}'}
+
+
+def trading(rng, ctx):
+    '''Игровые операции и заявки в книгу'''
+    uid = user(rng, ctx['players'])
+    roll = rng.random()
+    if roll < 0.25:
+        return 'game-api', 'buy-goblins', 'POST', {'user_id': uid, 'package': rng.choice(['small', 'large'])}
+    if roll < 0.45:
+        return 'game-api', 'exchange-gold', 'POST', {'user_id': uid, 'gold_amount': rng.choice([100, 250, 500])}
+    if roll < 0.6:
+        return 'market-api', 'create-listing', 'POST', {
+            'user_id': uid, 'gold_amount': rng.choice([100, 200]), 'price_per_kg': round(rng.uniform(0.05, 0.6), 4)
+        }
+    return 'market-api', 'place-order', 'POST', {
+        'user_id': uid, 'side': rng.choice(['buy', 'sell']),
+        'gold_amount': rng.choice([100, 150, 300]), 'price_per_kg': round(rng.uniform(0.2, 0.4), 2)
+    }
+
+
+SCENARIOS = {
+    'browse': browse,
+    'contended-buy': contended_buy,
+    'registration': registration,
+    'trading': trading,
+}
+
+
+def percentile(sorted_values: list, q: float) -> float:
+    if not sorted_values:
+        return 0.0
+    index = min(len(sorted_values) - 1, int(round(q * (len(sorted_values) - 1))))
+    return sorted_values[index]
+
+
+def run_scenario(name: str, handlers: dict, ctx: dict, ops: int, concurrency: int, seed_value: int) -> dict:
+    generator = SCENARIOS[name]
+    samples = defaultdict(list)
+    statuses = defaultdict(Counter)
+    queries = Counter()
+    lock = threading.Lock()
+
+    def worker(worker_id: int, count: int):
+        rng = random.Random(seed_value * 1000 + worker_id)
+        for _ in range(count):
+            function, action, method, data = generator(rng, ctx)
+            event = {
+                'httpMethod': method,
+                'queryStringParameters': dict(data, action=action) if method == 'GET' else {'action': action},
+                'headers': {},
+                'body': json.dumps(data) if method == 'POST' else None,
+            }
+            _counter.queries = 0
+            started = time.perf_counter()
+            response = handlers[function].handler(event, None)
+            elapsed = time.perf_counter() - started
+            key = f'{function}:{action}'
+            with lock:
+                samples[key].append(elapsed)
+                statuses[key][response['statusCode']] += 1
+                queries[key] += _counter.queries
+
+    per_worker = [ops // concurrency + (1 if i < ops % concurrency else 0) for i in range(concurrency)]
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        for future in [executor.submit(worker, i, n) for i, n in enumerate(per_worker)]:
+            future.result()
+    elapsed = time.perf_counter() - started
+
+    actions = {}
+    for key, values in samples.items():
+        values.sort()
+        codes = statuses[key]
+        actions[key] = {
+            'calls': len(values),
+            'ok': sum(n for code, n in codes.items() if code < 400),
+            'rejected': sum(n for code, n in codes.items() if 400 <= code < 500),
+            'errors': sum(n for code, n in codes.items() if code >= 500),
+            'p50_ms': round(percentile(values, 0.50) * 1000, 3),
+            'p95_ms': round(percentile(values, 0.95) * 1000, 3),
+            'p99_ms': round(percentile(values, 0.99) * 1000, 3),
+            'mean_ms': round(sum(values) / len(values) * 1000, 3),
+            'queries_per_call': round(queries[key] / len(values), 2),
+        }
+    return {
+        'ops': ops,
+        'concurrency': concurrency,
+        'elapsed_s': round(elapsed, 3),
+        'throughput_ops_s': round(ops / elapsed, 1) if elapsed else None,
+        'actions': actions,
+    }
+
+
+def measure_serialization(dsn: str, market, rounds: int) -> dict:
+    '''Цена строки полной страницы ленты: чтение из БД и сборка JSON, мкс на строку.
+
+    dicts — словари в Python и json (или orjson, если он установлен),
+    postgres — объекты объявлений из json_build_object, склеенные в Python.
+    '''
+    listings, money = market.listings, market.money
+    variants = {
+        'dicts+json': (False, lambda rows, sort, limit: money.stdlib_dumps(listings.page_from_rows(rows, sort, limit))),
+        'postgres': (True, listings.page_body),
+    }
+    if money.orjson is not None:
+        variants['dicts+orjson'] = (False, lambda rows, sort, limit: money.dumps(listings.page_from_rows(rows, sort, limit)))
+
+    params = {'sort': 'price_per_kg', 'limit': str(listings.MAX_LIMIT)}
+    report = {}
+    conn = psycopg2.connect(dsn)
+    with conn.cursor() as cur:
+        for name, (documents, build) in variants.items():
+            query, args, sort, limit = listings.build_query(params, documents)
+            fetch = encode = 0.0
+            count = 0
+            for _ in range(rounds):
+                started = time.perf_counter()
+                cur.execute(query, args)
+                rows = cur.fetchall()
+                fetched = time.perf_counter()
+                build(rows, sort, limit)
+                encode += time.perf_counter() - fetched
+                fetch += fetched - started
+                count += min(len(rows), limit)
+            report[name] = {
+                'rows': count // rounds,
+                'fetch_us_per_row': round(fetch / count * 1e6, 2),
+                'build_us_per_row': round(encode / count * 1e6, 2),
+                'total_us_per_row': round((fetch + encode) / count * 1e6, 2),
+            }
+    conn.close()
+    return report
+
+
+def print_report(results: dict):
+    if results.get('serialization'):
+        print(f"\nserialization: страница ленты, мкс на строку")
+        print(f"  {'variant':14} {'rows':>5} {'fetch':>8} {'build':>8} {'total':>8}")
+        for name, row in results['serialization'].items():
+            print(f"  {name:14} {row['rows']:>5} {row['fetch_us_per_row']:>8} "
+                  f"{row['build_us_per_row']:>8} {row['total_us_per_row']:>8}")
+    for name, result in results['scenarios'].items():
+        print(f"\n{name}: {result['ops']} ops, {result['concurrency']} потоков, "
+              f"{result['elapsed_s']} с, {result['throughput_ops_s']} ops/s")
+        print(f"  {'action':32} {'calls':>6} {'ok':>6} {'4xx':>6} {'5xx':>5} "
+              f"{'p50':>8} {'p95':>8} {'p99':>8} {'q/call':>7}")
+        for key, row in sorted(result['actions'].items()):
+            print(f"  {key:32} {row['calls']:>6} {row['ok']:>6} {row['rejected']:>6} {row['errors']:>5} "
+                  f"{row['p50_ms']:>8} {row['p95_ms']:>8} {row['p99_ms']:>8} {row['queries_per_call']:>7}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Нагрузочный прогон обработчиков на одноразовой базе')
+    parser.add_argument('--dsn', help='сервер Postgres, на котором создать временную базу')
+    parser.add_argument('--shards', type=int, default=1, help='сколько узлов Postgres поднять')
+    parser.add_argument('--players', type=int, default=10000)
+    parser.add_argument('--listings', type=int, default=5000)
+    parser.add_argument('--ops', type=int, default=2000, help='операций на сценарий')
+    parser.add_argument('--concurrency', type=int, default=8)
+    parser.add_argument('--scenario', action='append', choices=sorted(SCENARIOS), help='по умолчанию все')
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--serialization-rounds', type=int, default=200,
+                        help='повторов замера сборки страницы ленты; 0 — без замера')
+    parser.add_argument('--json', help='куда записать результаты')
+    args = parser.parse_args()
+
+    with throwaway_cluster(args.shards, args.dsn) as dsns:
+        os.environ['DATABASE_URL'] = dsns[0]
+        if args.shards > 1:
+            os.environ['SHARD_URLS'] = json.dumps(dsns)
+        os.environ.setdefault('TIMING_LOG', '0')
+        os.environ['DB_POOL_MAX_SIZE'] = str(args.concurrency)
+
+        cluster = load_function('game-api').shards.Cluster(dsns)
+        numbers = defaultdict(list)
+        for g in range(1, args.players + 1):
+            numbers[cluster.for_user(f'bench_{g}')].append(g)
+        for shard, dsn in enumerate(dsns):
+            seed(dsn, args.players, args.listings, numbers[shard] if args.shards > 1 else None)
+
+        handlers = {name: load_function(name) for name in ('game-api', 'market-api')}
+        for module in handlers.values():
+            count_queries(module)
+
+        cheapest = []
+        for dsn in dsns:
+            conn = psycopg2.connect(dsn)
+            with conn.cursor() as cur:
+                cur.execute("SELECT price_per_kg, id FROM market_listings WHERE status = 'active' ORDER BY price_per_kg, id LIMIT 20")
+                cheapest.extend(cur.fetchall())
+            conn.close()
+        cheapest = [listing_id for _, listing_id in sorted(cheapest)[:20]]
+
+        results = {
+            'meta': {
+                'shards': args.shards,
+                'players': args.players,
+                'listings': args.listings,
+                'ops': args.ops,
+                'concurrency': args.concurrency,
+                'seed': args.seed,
+                'python': sys.version.split()[0],
+                'started_at': time.strftime('%Y-%m-%dT%H:%M:%S'),
+            },
+            'scenarios': {},
+        }
+        if args.serialization_rounds > 0:
+            results['serialization'] = measure_serialization(dsns[0], handlers['market-api'], args.serialization_rounds)
+        for index, name in enumerate(args.scenario or list(SCENARIOS)):
+            ctx = {'players': args.players, 'cheapest': cheapest, 'run': index}
+            results['scenarios'][name] = run_scenario(name, handlers, ctx, args.ops, args.concurrency, args.seed + index)
+
+        for module in handlers.values():
+            module.db.close_all()
+
+    print_report(results)
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,44 @@
+'''Загрузка обработчиков функций из backend/<имя>/index.py в один процесс.
+
+Каждая функция кладёт свои модули (db, harvest, ...) рядом с index.py, и имена
+у разных функций совпадают. Модули каждой функции загружаются изолированно,
+поэтому у каждой свой пул соединений и свои кэши, как при отдельном деплое.
+'''
+import importlib.util
+import json
+import os
+import sys
+
+BACKEND_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+MIGRATIONS_DIR = os.path.join(os.path.dirname(BACKEND_DIR), 'db_migrations')
+
+
+def function_names() -> list:
+    with open(os.path.join(BACKEND_DIR, 'func2url.json')) as f:
+        return sorted(json.load(f))
+
+
+def load_function(name: str):
+    '''Импортирует index.py функции вместе с её соседними модулями'''
+    func_dir = os.path.join(BACKEND_DIR, name)
+    local_names = {f[:-3] for f in os.listdir(func_dir) if f.endswith('.py')}
+    saved = {n: sys.modules.pop(n) for n in local_names if n in sys.modules}
+    sys.path.insert(0, func_dir)
+    try:
+        spec = importlib.util.spec_from_file_location(f"{name.replace('-', '_')}_index", os.path.join(func_dir, 'index.py'))
+        module = importlib.util.module_from_spec(spec)
+        spec.loader.exec_module(module)
+    finally:
+        sys.path.remove(func_dir)
+        for n in local_names:
+            sys.modules.pop(n, None)
+        sys.modules.update(saved)
+    return module
+
+
+def migration_files() -> list:
+    return sorted(
+        os.path.join(MIGRATIONS_DIR, f)
+        for f in os.listdir(MIGRATIONS_DIR)
+        if f.startswith('V') and f.endswith('.sql')
+    )
@@ -0,0 +1,117 @@
+'''Одноразовый Postgres для локальных прогонов: свой кластер во временном каталоге
+или отдельная база на уже запущенном сервере.'''
+import os
+import shutil
+import socket
+import subprocess
+import tempfile
+import uuid
+from contextlib import ExitStack, contextmanager
+import psycopg2
+from psycopg2.extensions import make_dsn
+from tools.functions import migration_files
+
+
+def _free_port() -> int:
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+def _pg_bin(name: str) -> str:
+    bin_dir = os.environ.get('PG_BIN')
+    path = os.path.join(bin_dir, name) if bin_dir else shutil.which(name)
+    if not path or not os.path.exists(path):
+        raise RuntimeError(f'{name} не найден: добавьте каталог Postgres в PATH или задайте PG_BIN')
+    return path
+
+
+class LocalPostgres:
+    '''Кластер Postgres во временном каталоге; слушает только unix-сокет'''
+
+    def __init__(self, settings: dict = None):
+        self.settings = settings or {}
+        self.workdir = None
+        self.port = None
+
+    def start(self) -> str:
+        self.workdir = tempfile.mkdtemp(prefix='goblin-pg-')
+        self.port = _free_port()
+        data_dir = os.path.join(self.workdir, 'data')
+        subprocess.run(
+            [_pg_bin('initdb'), '-D', data_dir, '-U', 'postgres', '-A', 'trust', '-E', 'UTF8', '--no-sync'],
+            check=True, stdout=subprocess.DEVNULL
+        )
+        options = f"-p {self.port} -k {self.workdir} -c listen_addresses='' -c fsync=off"
+        for key, value in self.settings.items():
+            options += f' -c {key}={value}'
+        subprocess.run(
+            [_pg_bin('pg_ctl'), '-D', data_dir, '-o', options, '-l', os.path.join(self.workdir, 'postgres.log'), '-w', 'start'],
+            check=True, stdout=subprocess.DEVNULL
+        )
+        return self.dsn('postgres')
+
+    def dsn(self, dbname: str) -> str:
+        return f'postgresql://postgres@/{dbname}?host={self.workdir}&port={self.port}'
+
+    def stop(self):
+        if self.workdir:
+            subprocess.run(
+                [_pg_bin('pg_ctl'), '-D', os.path.join(self.workdir, 'data'), '-m', 'immediate', 'stop'],
+                stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL
+            )
+            shutil.rmtree(self.workdir, ignore_errors=True)
+            self.workdir = None
+
+
+def apply_migrations(dsn: str):
+    conn = psycopg2.connect(dsn)
+    conn.autocommit = True
+    with conn.cursor() as cur:
+        for path in migration_files():
+            with open(path) as f:
+                cur.execute(f.read())
+    conn.close()
+
+
+@contextmanager
+def throwaway_database(admin_dsn: str = None, settings: dict = None):
+    '''База с применёнными миграциями; удаляется вместе с кластером по выходу.
+
+    Без admin_dsn поднимается собственный кластер (нужны initdb и pg_ctl).
+    '''
+    cluster = None
+    if admin_dsn is None:
+        cluster = LocalPostgres(settings)
+        admin_dsn = cluster.start()
+    dbname = f'goblin_{uuid.uuid4().hex[:12]}'
+    admin = psycopg2.connect(admin_dsn)
+    admin.autocommit = True
+    try:
+        with admin.cursor() as cur:
+            cur.execute(f"CREATE DATABASE {dbname} ENCODING 'UTF8' TEMPLATE template0")
+        dsn = make_dsn(admin_dsn, dbname=dbname)
+        apply_migrations(dsn)
+        yield dsn
+    finally:
+        with admin.cursor() as cur:
+            cur.execute(f'DROP DATABASE IF EXISTS {dbname} WITH (FORCE)')
+        admin.close()
+        if cluster:
+            cluster.stop()
+
+
+@contextmanager
+def throwaway_cluster(count: int, admin_dsn: str = None, settings: dict = None):
+    '''count размеченных узлов для SHARD_URLS (см. tools.shards).
+
+    Без admin_dsn каждый узел — собственный кластер Postgres, с ним — отдельные
+    базы на одном сервере, чего достаточно для проверки маршрутизации.
+    Единственный узел не размечается.
+    '''
+    from tools.shards import provision
+    with ExitStack() as stack:
+        dsns = [stack.enter_context(throwaway_database(admin_dsn, settings)) for _ in range(count)]
+        if count > 1:
+            provision(dsns)
+        yield dsns
@@ -0,0 +1,188 @@
+'''HTTP-сервер для своего железа: все функции из func2url.json в одном процессе.
+
+    cd backend && DATABASE_URL=... python -m tools.server --port 8000 --workers 4
+
+Функция выбирается по первому сегменту пути: /game-api?action=init,
+/market-api?action=listings. HTTP-запрос переводится в event облачной функции
+(httpMethod, path, queryStringParameters, headers, body), ответ handler — обратно
+в HTTP. Обработчики импортируются один раз до fork, после fork каждый рабочий
+процесс открывает свои соединения (--warm на функцию), так что первые запросы
+не ждут ни импорта, ни подключения к БД. Все рабочие процессы принимают
+соединения с общего сокета. Предварительные запросы OPTIONS отдаются из
+ответов, снятых с handler при старте, без вызова обработчика.
+'''
+import argparse
+import base64
+import os
+import signal
+import sys
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qsl, urlsplit
+from tools.functions import function_names, load_function
+
+
+def build_event(method: str, target: str, headers, body: bytes) -> dict:
+    '''Запрос HTTP в формате event облачной функции'''
+    url = urlsplit(target)
+    return {
+        'httpMethod': method,
+        'path': url.path,
+        'queryStringParameters': dict(parse_qsl(url.query, keep_blank_values=True)),
+        'headers': dict(headers.items()),
+        'body': body.decode('utf-8') if body else None,
+        'isBase64Encoded': False,
+    }
+
+
+def preflight(module) -> dict:
+    '''Ответ функции на OPTIONS; обработчики отвечают на него без БД'''
+    return module.handler({'httpMethod': 'OPTIONS', 'headers': {}, 'queryStringParameters': {}}, None)
+
+
+def warm(module, connections: int):
+    '''Открывает соединения пулов функции ко всем узлам заранее'''
+    for url in module.shards.cluster().urls:
+        pool = module.db.pool_for(url)
+        conns = [pool.acquire() for _ in range(min(connections, pool.max_size))]
+        for conn in conns:
+            pool.release(conn)
+
+
+class Router:
+    '''Обработчики функций по имени и их готовые ответы на OPTIONS'''
+
+    def __init__(self, names: list):
+        self.functions = {name: load_function(name) for name in names}
+        self.preflights = {name: preflight(module) for name, module in self.functions.items()}
+
+    def warm(self, connections: int):
+        for module in self.functions.values():
+            warm(module, connections)
+
+    def close(self):
+        for module in self.functions.values():
+            module.db.close_all()
+
+    def dispatch(self, event: dict) -> dict:
+        name = event['path'].strip('/').split('/', 1)[0]
+        if name not in self.functions:
+            return {'statusCode': 404, 'headers': {'Content-Type': 'application/json'},
+                    'body': '{"error": "Функция не найдена"}'}
+        if event['httpMethod'] == 'OPTIONS':
+            return self.preflights[name]
+        return self.functions[name].handler(event, None)
+
+
+class RequestHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    router = None
+
+    def _serve(self):
+        length = int(self.headers.get('Content-Length') or 0)
+        body = self.rfile.read(length) if length else b''
+        event = build_event(self.command, self.path, self.headers, body)
+        try:
+            response = self.router.dispatch(event)
+        except Exception as e:
+            response = {'statusCode': 500, 'headers': {}, 'body': str(e)}
+
+        payload = response.get('body') or ''
+        if response.get('isBase64Encoded'):
+            payload = base64.b64decode(payload)
+        elif isinstance(payload, str):
+            payload = payload.encode('utf-8')
+
+        self.send_response(response.get('statusCode', 200))
+        for name, value in (response.get('headers') or {}).items():
+            self.send_header(name, str(value))
+        self.send_header('Content-Length', str(len(payload)))
+        self.end_headers()
+        if self.command != 'HEAD':
+            self.wfile.write(payload)
+
+    do_GET = do_POST = do_PUT = do_PATCH = do_DELETE = do_OPTIONS = do_HEAD = _serve
+
+    def log_message(self, format, *args):
+        # Время запросов пишет instrument самих функций
+        pass
+
+
+class Server(ThreadingHTTPServer):
+    daemon_threads = True
+    request_queue_size = 128
+
+
+def serve_worker(server: Server, router: Router, connections: int):
+    '''Рабочий процесс: свои соединения с БД и цикл приёма на общем сокете'''
+    for signum in (signal.SIGTERM, signal.SIGINT):
+        signal.signal(signum, lambda *_: sys.exit(0))
+    router.warm(connections)
+    try:
+        server.serve_forever()
+    finally:
+        router.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Локальный HTTP-сервер для всех функций')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8000)
+    parser.add_argument('--workers', type=int, default=os.cpu_count() or 1, help='рабочих процессов')
+    parser.add_argument('--warm', type=int, default=2, help='соединений с БД на функцию, открываемых при старте')
+    parser.add_argument('--function', action='append', choices=function_names(), help='по умолчанию все')
+    args = parser.parse_args()
+    if not os.environ.get('DATABASE_URL'):
+        parser.error('не задан DATABASE_URL')
+
+    RequestHandler.router = router = Router(args.function or function_names())
+    server = Server((args.host, args.port), RequestHandler)
+    print({'listening': f'http://{args.host}:{server.server_address[1]}',
+           'functions': sorted(router.functions), 'workers': args.workers})
+    sys.stdout.flush()
+
+    if args.workers <= 1 or not hasattr(os, 'fork'):
+        serve_worker(server, router, args.warm)
+        return
+
+    children = set()
+
+    def spawn():
+        pid = os.fork()
+        if pid == 0:
+            try:
+                serve_worker(server, router, args.warm)
+            finally:
+                os._exit(0)
+        children.add(pid)
+
+    stopping = False
+
+    def stop(signum, frame):
+        nonlocal stopping
+        stopping = True
+        for pid in children:
+            os.kill(pid, signal.SIGTERM)
+
+    signal.signal(signal.SIGTERM, stop)
+    signal.signal(signal.SIGINT, stop)
+    for _ in range(args.workers):
+        spawn()
+
+    while children:
+        try:
+            pid, _ = os.wait()
+        except ChildProcessError:
+            break
+        except InterruptedError:
+            continue
+        children.discard(pid)
+        if not stopping:
+            # Упавший рабочий процесс заменяется новым
+            time.sleep(0.1)
+            spawn()
+    server.server_close()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,148 @@
+'''Разметка узлов для backend/*/shards.py.
+
+    cd backend && SHARD_URLS='["postgresql://...", "postgresql://..."]' python -m tools.shards provision
+    cd backend && SHARD_URLS=... python -m tools.shards locate user_1 user_2
+
+provision перезапускает последовательности на каждом узле: у узла k id игроков
+и объявлений равны k по модулю ID_STRIDE, номера memo_seq — k по модулю числа
+узлов, поэтому id и memo-коды разных узлов не пересекаются (id — BIGINT, шаг
+не исчерпывает их). Отсчёт идёт с общей базы выше всего, что уже выдано на любом узле. Миграции на узлы накатываются как
+обычно, до разметки; после добавления узла в конец SHARD_URLS разметку повторяют.
+
+Данные не переносятся. Игроки, которых кольцо для нового числа узлов отправило
+бы не туда, где они лежат, закрепляются в shard_directory первого узла; на время
+разметки таблица players на узлах блокируется от записи. Объявления, созданные
+до первой разметки, остаются на своём узле (shard_layout.legacy_shard); если они
+есть больше чем на одном неразмеченном узле, разметка отказывает. Разметка первого
+узла коммитится последней: пока её нет, экземпляры с новым SHARD_URLS не
+маршрутизируют запросы.
+'''
+import argparse
+import time
+import psycopg2
+from psycopg2 import sql
+from psycopg2.extras import execute_values
+from tools.functions import load_function
+
+# Таблицы, чей id определяет узел (shards.Cluster.for_id)
+ROUTED_TABLES = ('players', 'market_listings')
+
+
+def _routing():
+    return load_function('game-api').shards
+
+
+def _top(cur, table: str) -> tuple:
+    '''Последовательность id таблицы и наибольшее уже выданное значение'''
+    cur.execute("SELECT pg_get_serial_sequence(%s, 'id')", (table,))
+    sequence = cur.fetchone()[0]
+    cur.execute(sql.SQL("SELECT GREATEST((SELECT COALESCE(MAX(id), 0) FROM {}), last_value) FROM {}").format(
+        sql.Identifier(table), sql.SQL(sequence)
+    ))
+    return sequence, cur.fetchone()[0]
+
+
+def _restart(cur, sequence: str, step: int, start: int):
+    cur.execute(sql.SQL("ALTER SEQUENCE {} INCREMENT BY {} RESTART WITH {}").format(
+        sql.SQL(sequence), sql.Literal(step), sql.Literal(start)
+    ))
+
+
+def _pins(cursors: list, ring) -> list:
+    '''(user_id, узел) игроков, которых кольцо отправило бы не на их узел'''
+    pins, seen = [], {}
+    for shard, cur in enumerate(cursors):
+        cur.execute("LOCK TABLE players IN SHARE MODE")
+        cur.execute("SELECT user_id FROM players")
+        for (user_id,) in cur.fetchall():
+            if user_id in seen:
+                raise ValueError(f'Игрок {user_id} есть на узлах {seen[user_id]} и {shard}')
+            seen[user_id] = shard
+            if ring.shard(user_id) != shard:
+                pins.append((user_id, shard))
+    return pins
+
+
+def _legacy_shard(cursors: list) -> int:
+    '''Узел объявлений, созданных до первой разметки'''
+    holders = []
+    for shard, cur in enumerate(cursors):
+        cur.execute("SELECT EXISTS (SELECT 1 FROM market_listings)")
+        if cur.fetchone()[0]:
+            holders.append(shard)
+    if len(holders) > 1:
+        raise ValueError(f'Объявления есть на неразмеченных узлах {holders}: узел объявления по id не определить')
+    return holders[0] if holders else 0
+
+
+def provision(urls: list) -> dict:
+    '''Размечает последовательности узлов urls (в порядке SHARD_URLS) и закрепляет игроков'''
+    routing = _routing()
+    stride = routing.ID_STRIDE
+    conns = [psycopg2.connect(url) for url in urls]
+    try:
+        cursors = [conn.cursor() for conn in conns]
+        stats = {'shards': len(urls)}
+
+        cursors[0].execute("SELECT listings_below, legacy_shard FROM shard_layout WHERE id = 1")
+        layout = cursors[0].fetchone()
+        legacy_shard = layout[1] if layout else _legacy_shard(cursors)
+        pins = _pins(cursors, routing.Ring(len(urls)))
+
+        for table in ROUTED_TABLES:
+            tops = [_top(cur, table) for cur in cursors]
+            base = (max(top for _, top in tops) // stride + 1) * stride
+            for shard, (cur, (sequence, _)) in enumerate(zip(cursors, tops)):
+                _restart(cur, sequence, stride, base + shard)
+            stats[table] = base
+
+        top = 0
+        for cur in cursors:
+            cur.execute("SELECT last_value FROM memo_seq")
+            top = max(top, cur.fetchone()[0])
+        base = (top // len(urls) + 1) * len(urls)
+        for shard, cur in enumerate(cursors):
+            _restart(cur, 'memo_seq', len(urls), base + shard)
+        stats['memo_seq'] = base
+
+        # Объявления ниже первой базы выданы до разметки; при повторной разметке граница не меняется
+        listings_below = layout[0] if layout else stats['market_listings']
+        cursors[0].execute("""
+            INSERT INTO shard_layout (id, shards, listings_below, legacy_shard) VALUES (1, %s, %s, %s)
+            ON CONFLICT (id) DO UPDATE SET shards = EXCLUDED.shards, provisioned_at = NOW()
+        """, (len(urls), listings_below, legacy_shard))
+        cursors[0].execute("DELETE FROM shard_directory")
+        execute_values(cursors[0], "INSERT INTO shard_directory (user_id, shard) VALUES %s", pins)
+        stats['listings_below'] = listings_below
+        stats['legacy_shard'] = legacy_shard
+        stats['pinned'] = len(pins)
+
+        for conn in conns[1:]:
+            conn.commit()
+        conns[0].commit()
+        return stats
+    finally:
+        for conn in conns:
+            conn.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Разметка узлов Postgres')
+    commands = parser.add_subparsers(dest='command', required=True)
+    commands.add_parser('provision', help='разметить последовательности id на узлах SHARD_URLS')
+    locate_parser = commands.add_parser('locate', help='номер узла игрока')
+    locate_parser.add_argument('user_ids', nargs='+')
+    args = parser.parse_args()
+
+    cluster = _routing().cluster()
+    started = time.monotonic()
+    if args.command == 'provision':
+        stats = provision(cluster.urls)
+    else:
+        stats = {user_id: cluster.for_user(user_id) for user_id in args.user_ids}
+    stats['seconds'] = round(time.monotonic() - started, 3)
+    print(stats)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,354 @@
+'''Выгрузка, загрузка и генерация игровых данных через COPY.
+
+    cd backend
+    DATABASE_URL=... python -m tools.snapshot export --dir snap [--format binary]
+    DATABASE_URL=... python -m tools.snapshot import --dir snap
+    DATABASE_URL=... python -m tools.snapshot generate --players 1000000 --listings 200000
+
+Таблицы идут потоком COPY ... TO/FROM STDIN через gzip-файлы, память не растёт
+с размером данных. Выгрузка читает все таблицы в одном снимке REPEATABLE READ и
+пишет manifest.json с форматом, числом строк и положением memo_seq.
+
+Загрузка идёт в одной транзакции: каждая таблица копируется во временную
+таблицу и переносится INSERT ... ON CONFLICT DO NOTHING. Игрок с уже занятым id
+или memo_code получает новый, с занятым user_id — пропускается. Объявления и
+журналы привязываются к игроку базы с тем же user_id, что у их игрока в
+выгрузке; строка с id, занятым другой строкой, получает новый id, а та же
+строка под другим id считается уже загруженной. Повторная загрузка той же
+выгрузки ничего не добавляет; пропущенное считается в skipped.
+Последовательности id и memo_seq после загрузки только сдвигаются вперёд.
+
+Генерация строит строки в Python генератором и тоже загружает их через COPY;
+MEMO коды выдаются той же формулой от memo_seq, что и при регистрации. Больше
+10**MEMO_DIGITS игроков не поместится — см. расширение в memo_codes.py.
+'''
+import argparse
+import gzip
+import json
+import os
+import random
+import time
+import psycopg2
+from psycopg2 import sql
+from tools.functions import load_function
+
+# Порядок важен для загрузки: сначала игроки, на которых ссылаются остальные
+TABLES = {
+    'players': ('id', 'user_id', 'memo_code', 'goblins', 'gold', 'ton_balance', 'last_harvest', 'created_at'),
+    'market_listings': ('id', 'seller_id', 'seller_tag', 'gold_amount', 'price_per_kg', 'total_price',
+                        'status', 'created_at', 'updated_at'),
+    'transactions': ('id', 'player_id', 'type', 'amount', 'description', 'created_at'),
+    'gold_harvests': ('id', 'player_id', 'gold_earned', 'goblins_count', 'harvested_at'),
+}
+
+# Колонка со ссылкой на игрока; при загрузке она переводится через user_id
+PLAYER_COLUMNS = {
+    'market_listings': 'seller_id',
+    'transactions': 'player_id',
+    'gold_harvests': 'player_id',
+}
+
+FORMATS = {'csv': 'csv', 'binary': 'copy'}
+MANIFEST = 'manifest.json'
+CHUNK_SIZE = 1 << 16
+
+# Сдвигает последовательность id таблицы не ниже её максимального id
+SEQUENCE_SQL = """
+    SELECT setval(seq, GREATEST(COALESCE(pg_sequence_last_value(seq::regclass), 1),
+                                (SELECT COALESCE(MAX(id), 1) FROM {table})))
+    FROM pg_get_serial_sequence(%s, 'id') AS seq
+"""
+
+MEMO_SEQ_SQL = "SELECT setval('memo_seq', GREATEST(COALESCE(pg_sequence_last_value('memo_seq'), 0), %s))"
+
+BUMP_VERSION_SQL = "UPDATE market_version SET version = version + 1, updated_at = NOW() WHERE id = 1"
+
+
+class LineStream:
+    '''Файлоподобная обёртка над генератором строк для COPY FROM STDIN'''
+
+    def __init__(self, lines):
+        self._lines = lines
+        self._buffer = b''
+
+    def read(self, size: int = -1) -> bytes:
+        size = CHUNK_SIZE if size is None or size < 0 else size
+        while len(self._buffer) < size:
+            line = next(self._lines, None)
+            if line is None:
+                break
+            self._buffer += line.encode('utf-8')
+        chunk, self._buffer = self._buffer[:size], self._buffer[size:]
+        return chunk
+
+    readline = read
+
+
+def _path(directory: str, table: str, fmt: str) -> str:
+    return os.path.join(directory, f'{table}.{FORMATS[fmt]}.gz')
+
+
+def _columns(columns) -> sql.Composed:
+    return sql.SQL(', ').join(map(sql.Identifier, columns))
+
+
+def _copy_options(fmt: str) -> sql.SQL:
+    return sql.SQL('(FORMAT binary)' if fmt == 'binary' else '(FORMAT csv)')
+
+
+def export(conn, directory: str, fmt: str, tables: list) -> dict:
+    '''Выгружает таблицы в каталог; все таблицы из одного снимка'''
+    os.makedirs(directory, exist_ok=True)
+    conn.set_session(isolation_level='REPEATABLE READ', readonly=True)
+    manifest = {'format': fmt, 'exported_at': time.strftime('%Y-%m-%dT%H:%M:%S'), 'tables': {}}
+    with conn.cursor() as cur:
+        cur.execute("SELECT last_value FROM memo_seq")
+        manifest['memo_seq'] = cur.fetchone()[0]
+        for table in tables:
+            columns = TABLES[table]
+            query = sql.SQL("COPY (SELECT {columns} FROM {table} ORDER BY id) TO STDOUT WITH {options}").format(
+                columns=_columns(columns), table=sql.Identifier(table), options=_copy_options(fmt)
+            )
+            with gzip.open(_path(directory, table, fmt), 'wb', compresslevel=3) as f:
+                cur.copy_expert(query, f, size=CHUNK_SIZE)
+            manifest['tables'][table] = {'columns': list(columns), 'rows': cur.rowcount}
+    conn.rollback()
+
+    with open(os.path.join(directory, MANIFEST), 'w') as f:
+        json.dump(manifest, f, indent=2)
+    return manifest
+
+
+def _stage(cur, table: str, columns, source, fmt: str) -> int:
+    '''COPY выгрузки во временную таблицу staging_<table>; число строк'''
+    cur.execute(sql.SQL("CREATE TEMP TABLE {staging} (LIKE {table} INCLUDING DEFAULTS) ON COMMIT DROP").format(
+        staging=sql.Identifier(f'staging_{table}'), table=sql.Identifier(table)
+    ))
+    cur.copy_expert(
+        sql.SQL("COPY {staging} ({columns}) FROM STDIN WITH {options}").format(
+            staging=sql.Identifier(f'staging_{table}'), columns=_columns(columns), options=_copy_options(fmt)
+        ),
+        source, size=CHUNK_SIZE
+    )
+    return cur.rowcount
+
+
+def _load_players(cur, columns, loaded: int, memo_seq: int) -> dict:
+    '''Игроки из staging_players.
+
+    Игрок с занятым id получает новый id, с занятым memo_code — новый код из
+    memo_seq (считаются в new_memo), с занятым user_id — пропускается.
+    '''
+    memo_codes = load_function('game-api').memo_codes
+    cur.execute(sql.SQL("""
+        INSERT INTO players ({columns}) SELECT {columns} FROM staging_players s
+        WHERE NOT EXISTS (SELECT 1 FROM players p WHERE p.id = s.id)
+        ON CONFLICT DO NOTHING
+    """).format(columns=_columns(columns)))
+    inserted = cur.rowcount
+
+    # Новые id и коды выдаются выше всех уже выданных здесь и в выгрузке
+    _advance_sequences(cur, ['players'])
+    cur.execute(MEMO_SEQ_SQL, (memo_seq,))
+    rest = [column for column in columns if column != 'id']
+    cur.execute(sql.SQL("""
+        WITH pending AS (
+            SELECT s.*, EXISTS (SELECT 1 FROM players p WHERE p.memo_code = s.memo_code) AS memo_taken
+            FROM staging_players s
+            WHERE NOT EXISTS (SELECT 1 FROM players p WHERE p.user_id = s.user_id)
+        ), added AS (
+            INSERT INTO players ({columns})
+            SELECT {values} FROM pending s
+            ON CONFLICT DO NOTHING
+            RETURNING 1
+        )
+        SELECT (SELECT COUNT(*) FROM added), (SELECT COUNT(*) FROM pending WHERE memo_taken)
+    """).format(
+        columns=_columns(rest),
+        values=sql.SQL(', ').join(
+            sql.SQL(f"CASE WHEN s.memo_taken THEN {memo_codes.NEXT_MEMO_SQL} ELSE s.memo_code END")
+            if column == 'memo_code' else sql.SQL('s.{}').format(sql.Identifier(column))
+            for column in rest
+        ),
+    ))
+    added, new_memo = cur.fetchone()
+    inserted += added
+    return {'loaded': loaded, 'inserted': inserted, 'skipped': loaded - inserted, 'new_memo': new_memo}
+
+
+def _load(cur, table: str, columns, loaded: int) -> dict:
+    '''Строки staging_<table> у игрока базы с тем же user_id.
+
+    Строка с id, занятым другой строкой, получает новый id. Строка без игрока
+    и уже загруженная (совпадают все колонки, кроме id) пропускаются.
+    '''
+    player_column = PLAYER_COLUMNS[table]
+    rest = [column for column in columns if column != 'id']
+    insert = sql.SQL("""
+        INSERT INTO {table} ({columns})
+        SELECT {values}
+        FROM {staging} s
+        JOIN staging_players sp ON sp.id = s.{player_column}
+        JOIN players p ON p.user_id = sp.user_id
+        WHERE NOT EXISTS (SELECT 1 FROM {table} t WHERE {loaded})
+        ON CONFLICT DO NOTHING
+    """)
+
+    def statement(names, loaded_sql):
+        return insert.format(
+            table=sql.Identifier(table),
+            columns=_columns(names),
+            values=sql.SQL(', ').join(
+                sql.SQL('p.id') if column == player_column else sql.SQL('s.{}').format(sql.Identifier(column))
+                for column in names
+            ),
+            staging=sql.Identifier(f'staging_{table}'),
+            player_column=sql.Identifier(player_column),
+            loaded=loaded_sql,
+        )
+
+    cur.execute(statement(columns, sql.SQL("t.id = s.id")))
+    inserted = cur.rowcount
+    _advance_sequences(cur, [table])
+    cur.execute(statement(rest, sql.SQL(' AND ').join(
+        sql.SQL('t.{} = p.id').format(sql.Identifier(column)) if column == player_column
+        else sql.SQL('t.{0} IS NOT DISTINCT FROM s.{0}').format(sql.Identifier(column))
+        for column in rest
+    )))
+    inserted += cur.rowcount
+    return {'loaded': loaded, 'inserted': inserted, 'skipped': loaded - inserted}
+
+
+def _advance_sequences(cur, tables):
+    for table in tables:
+        cur.execute(sql.SQL(SEQUENCE_SQL).format(table=sql.Identifier(table)), (table,))
+
+
+def import_snapshot(conn, directory: str, tables: list) -> dict:
+    '''Загружает выгрузку export в одной транзакции'''
+    with open(os.path.join(directory, MANIFEST)) as f:
+        manifest = json.load(f)
+    fmt = manifest['format']
+    tables = [table for table in TABLES if table in tables and table in manifest['tables']]
+    if tables and 'players' not in manifest['tables']:
+        raise ValueError('В выгрузке нет players: строки не к кому привязать')
+    stats = {}
+    with conn.cursor() as cur:
+        # Игроки выгрузки нужны и без их загрузки: по ним id игрока переводится в user_id
+        for table in ['players'] + [table for table in tables if table != 'players']:
+            columns = manifest['tables'][table]['columns']
+            with gzip.open(_path(directory, table, fmt), 'rb') as source:
+                loaded = _stage(cur, table, columns, source, fmt)
+            if table == 'players':
+                if 'players' in tables:
+                    stats[table] = _load_players(cur, columns, loaded, manifest['memo_seq'])
+            else:
+                stats[table] = _load(cur, table, columns, loaded)
+        _advance_sequences(cur, stats)
+        if 'market_listings' in stats:
+            cur.execute(BUMP_VERSION_SQL)
+    conn.commit()
+    return stats
+
+
+def player_lines(rng: random.Random, prefix: str, count: int):
+    '''Строки CSV игроков без id и MEMO: их выдаёт база при переносе'''
+    for i in range(1, count + 1):
+        yield (f'{prefix}{i},{3000 + rng.randrange(50) * 300},{rng.randrange(100000)}.{rng.randrange(100):02d},'
+               f'{rng.randrange(1000)}.{rng.randrange(10000):04d},{rng.randrange(72 * 3600)}\n')
+
+
+def listing_lines(rng: random.Random, prefix: str, players: int, count: int):
+    '''Строки CSV объявлений; продавец указан по user_id, его id подставит база'''
+    for _ in range(count):
+        amount = 100 + rng.randrange(100) * 10
+        price = 500 + rng.randrange(5000)
+        yield f'{prefix}{1 + rng.randrange(players)},{amount},0.{price:04d},{rng.randrange(7 * 86400)}\n'
+
+
+def generate(conn, players: int, listings: int, prefix: str, seed_value: int) -> dict:
+    '''Синтетические игроки и активные объявления'''
+    memo_codes = load_function('game-api').memo_codes
+    rng = random.Random(seed_value)
+    stats = {}
+    with conn.cursor() as cur:
+        cur.execute("""
+            CREATE TEMP TABLE staging_players (
+                user_id VARCHAR(100), goblins INTEGER, gold NUMERIC(10, 2),
+                ton_balance NUMERIC(10, 4), idle_seconds INTEGER
+            ) ON COMMIT DROP
+        """)
+        cur.copy_expert(
+            "COPY staging_players FROM STDIN WITH (FORMAT csv)",
+            LineStream(player_lines(rng, prefix, players)), size=CHUNK_SIZE
+        )
+        cur.execute(f"""
+            INSERT INTO players (user_id, memo_code, goblins, gold, ton_balance, last_harvest)
+            SELECT user_id, {memo_codes.NEXT_MEMO_SQL}, goblins, gold, ton_balance, LOCALTIMESTAMP - idle_seconds * INTERVAL '1 second'
+            FROM staging_players
+            ON CONFLICT DO NOTHING
+        """)
+        stats['players'] = cur.rowcount
+
+        if listings:
+            cur.execute("""
+                CREATE TEMP TABLE staging_listings (
+                    user_id VARCHAR(100), gold_amount NUMERIC(10, 2), price_per_kg NUMERIC(10, 4), age_seconds INTEGER
+                ) ON COMMIT DROP
+            """)
+            cur.copy_expert(
+                "COPY staging_listings FROM STDIN WITH (FORMAT csv)",
+                LineStream(listing_lines(rng, prefix, players, listings)), size=CHUNK_SIZE
+            )
+            cur.execute("""
+                INSERT INTO market_listings (seller_id, seller_tag, gold_amount, price_per_kg, total_price, created_at)
+                SELECT p.id, RIGHT(p.user_id, 4), l.gold_amount, l.price_per_kg, l.gold_amount * l.price_per_kg,
+                       NOW() - l.age_seconds * INTERVAL '1 second'
+                FROM staging_listings l
+                JOIN players p ON p.user_id = l.user_id
+            """)
+            stats['listings'] = cur.rowcount
+            cur.execute(BUMP_VERSION_SQL)
+        cur.execute("ANALYZE players")
+        cur.execute("ANALYZE market_listings")
+    conn.commit()
+    return stats
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Выгрузка, загрузка и генерация данных через COPY')
+    commands = parser.add_subparsers(dest='command', required=True)
+
+    export_parser = commands.add_parser('export', help='выгрузить таблицы в каталог')
+    export_parser.add_argument('--dir', required=True)
+    export_parser.add_argument('--format', choices=sorted(FORMATS), default='csv')
+    export_parser.add_argument('--table', action='append', choices=list(TABLES), help='по умолчанию все')
+
+    import_parser = commands.add_parser('import', help='загрузить выгрузку export')
+    import_parser.add_argument('--dir', required=True)
+    import_parser.add_argument('--table', action='append', choices=list(TABLES), help='по умолчанию все')
+
+    generate_parser = commands.add_parser('generate', help='создать синтетических игроков и объявления')
+    generate_parser.add_argument('--players', type=int, required=True)
+    generate_parser.add_argument('--listings', type=int, default=0)
+    generate_parser.add_argument('--prefix', default='synthetic_', help='префикс user_id')
+    generate_parser.add_argument('--seed', type=int, default=1)
+
+    args = parser.parse_args()
+    conn = psycopg2.connect(os.environ.get('DATABASE_URL'))
+    try:
+        started = time.monotonic()
+        if args.command == 'export':
+            stats = {t: v['rows'] for t, v in export(conn, args.dir, args.format, args.table or list(TABLES))['tables'].items()}
+        elif args.command == 'import':
+            stats = import_snapshot(conn, args.dir, args.table or list(TABLES))
+        else:
+            stats = generate(conn, args.players, args.listings, args.prefix, args.seed)
+        stats['seconds'] = round(time.monotonic() - started, 3)
+        print(stats)
+    finally:
+        conn.close()
+
+
+if __name__ == '__main__':
+    main()
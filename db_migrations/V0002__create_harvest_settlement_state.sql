@@ -0,0 +1,8 @@
+-- Прогресс пакетного начисления золота: позволяет продолжить проход после прерывания
+CREATE TABLE IF NOT EXISTS harvest_settlement_state (
+    job VARCHAR(50) PRIMARY KEY,
+    last_player_id INTEGER NOT NULL DEFAULT 0,
+    players_settled BIGINT NOT NULL DEFAULT 0,
+    started_at TIMESTAMP DEFAULT NOW(),
+    updated_at TIMESTAMP DEFAULT NOW()
+);
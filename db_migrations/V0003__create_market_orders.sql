@@ -0,0 +1,35 @@
+-- Книга заявок P2P маркета: покупки и продажи по цене с частичным исполнением
+CREATE TABLE IF NOT EXISTS market_orders (
+    id SERIAL PRIMARY KEY,
+    player_id INTEGER NOT NULL REFERENCES players(id),
+    side VARCHAR(4) NOT NULL CHECK (side IN ('buy', 'sell')),
+    price_per_kg DECIMAL(10, 4) NOT NULL CHECK (price_per_kg > 0),
+    gold_amount DECIMAL(10, 2) NOT NULL CHECK (gold_amount > 0),
+    remaining DECIMAL(10, 2) NOT NULL CHECK (remaining >= 0),
+    escrow DECIMAL(12, 4) NOT NULL DEFAULT 0,
+    status VARCHAR(20) DEFAULT 'open' CHECK (status IN ('open', 'filled', 'cancelled')),
+    created_at TIMESTAMP DEFAULT NOW(),
+    updated_at TIMESTAMP DEFAULT NOW()
+);
+
+-- Лучшая цена и приоритет времени: продажи по возрастанию цены, покупки по убыванию
+CREATE INDEX IF NOT EXISTS idx_orders_open_sell ON market_orders(price_per_kg ASC, id ASC) WHERE side = 'sell' AND status = 'open';
+CREATE INDEX IF NOT EXISTS idx_orders_open_buy ON market_orders(price_per_kg DESC, id ASC) WHERE side = 'buy' AND status = 'open';
+
+-- Индекс для заявок игрока
+CREATE INDEX IF NOT EXISTS idx_orders_player ON market_orders(player_id, created_at DESC);
+
+-- Сделки, получившиеся при сведении заявок
+CREATE TABLE IF NOT EXISTS market_trades (
+    id SERIAL PRIMARY KEY,
+    buy_order_id INTEGER NOT NULL REFERENCES market_orders(id),
+    sell_order_id INTEGER NOT NULL REFERENCES market_orders(id),
+    buyer_id INTEGER NOT NULL REFERENCES players(id),
+    seller_id INTEGER NOT NULL REFERENCES players(id),
+    gold_amount DECIMAL(10, 2) NOT NULL,
+    price_per_kg DECIMAL(10, 4) NOT NULL,
+    total_price DECIMAL(12, 4) NOT NULL,
+    created_at TIMESTAMP DEFAULT NOW()
+);
+
+CREATE INDEX IF NOT EXISTS idx_trades_created ON market_trades(created_at DESC);
@@ -0,0 +1,17 @@
+-- Метка продавца хранится в объявлении, чтобы лента не делала JOIN с players
+ALTER TABLE market_listings ADD COLUMN IF NOT EXISTS seller_tag VARCHAR(4);
+
+UPDATE market_listings ml
+SET seller_tag = RIGHT(p.user_id, 4)
+FROM players p
+WHERE p.id = ml.seller_id AND ml.seller_tag IS NULL;
+
+-- Покрывающие частичные индексы активных объявлений: каждая страница ленты
+-- читается index-only scan'ом по ключу сортировки (новые первыми или по цене)
+CREATE INDEX IF NOT EXISTS idx_listings_active_created ON market_listings(created_at DESC, id DESC)
+    INCLUDE (seller_tag, gold_amount, price_per_kg, total_price)
+    WHERE status = 'active';
+
+CREATE INDEX IF NOT EXISTS idx_listings_active_price ON market_listings(price_per_kg ASC, id ASC)
+    INCLUDE (seller_tag, gold_amount, total_price, created_at)
+    WHERE status = 'active';
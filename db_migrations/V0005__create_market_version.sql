@@ -0,0 +1,9 @@
+-- Версия ленты объявлений: растёт при каждом изменении объявлений в той же
+-- транзакции, по ней market-api сбрасывает кэш ленты и строит ETag
+CREATE TABLE IF NOT EXISTS market_version (
+    id SMALLINT PRIMARY KEY CHECK (id = 1),
+    version BIGINT NOT NULL DEFAULT 0,
+    updated_at TIMESTAMP DEFAULT NOW()
+);
+
+INSERT INTO market_version (id, version) VALUES (1, 0) ON CONFLICT (id) DO NOTHING;
@@ -0,0 +1,4 @@
+-- Номера для выдачи MEMO кодов: код получается биективной перестановкой номера
+-- (см. backend/game-api/memo_codes.py). MAXVALUE равен размеру пространства кодов,
+-- поэтому исчерпание даёт явную ошибку, а не повторяющиеся коды
+CREATE SEQUENCE IF NOT EXISTS memo_seq MINVALUE 0 START 0 MAXVALUE 999999 NO CYCLE;
@@ -0,0 +1,15 @@
+-- Ключи идемпотентности мутирующих действий: строка вставляется в транзакции
+-- самого действия и коммитится вместе с ним, поэтому сохранённый ответ есть
+-- ровно у выполненных операций. Старые ключи удаляются выборочно по created_at
+CREATE TABLE IF NOT EXISTS idempotency_keys (
+    function_name VARCHAR(32) NOT NULL,
+    user_id VARCHAR(255) NOT NULL DEFAULT '',
+    idem_key VARCHAR(255) NOT NULL,
+    request_hash CHAR(32) NOT NULL,
+    status_code INTEGER,
+    response_body TEXT,
+    created_at TIMESTAMP NOT NULL DEFAULT NOW(),
+    PRIMARY KEY (function_name, user_id, idem_key)
+);
+
+CREATE INDEX IF NOT EXISTS idx_idempotency_keys_created ON idempotency_keys (created_at);
@@ -0,0 +1,109 @@
+-- Помесячное секционирование transactions и gold_harvests.
+-- Существующая таблица становится секцией *_legacy с диапазоном до начала
+-- следующего месяца (без перезаписи строк), дальше идут помесячные секции,
+-- которые заранее создаёт ledger.py. Секция DEFAULT страхует вставки, если
+-- задача обслуживания давно не запускалась.
+
+-- Помесячная секция parent_YYYY_MM; возвращает имя секции
+CREATE OR REPLACE FUNCTION create_month_partition(parent TEXT, month DATE) RETURNS TEXT AS $$
+DECLARE
+    start_at DATE := date_trunc('month', month)::date;
+    partition_name TEXT := parent || '_' || to_char(start_at, 'YYYY_MM');
+BEGIN
+    EXECUTE format(
+        'CREATE TABLE IF NOT EXISTS %I PARTITION OF %I FOR VALUES FROM (%L) TO (%L)',
+        partition_name, parent, start_at, (start_at + INTERVAL '1 month')::date
+    );
+    RETURN partition_name;
+END;
+$$ LANGUAGE plpgsql;
+
+DO $$
+DECLARE
+    boundary DATE;
+BEGIN
+    IF EXISTS (SELECT 1 FROM pg_partitioned_table WHERE partrelid = 'transactions'::regclass) THEN
+        RETURN;
+    END IF;
+
+    ALTER TABLE transactions RENAME TO transactions_legacy;
+    DROP INDEX IF EXISTS idx_transactions_player;
+    UPDATE transactions_legacy SET created_at = NOW() WHERE created_at IS NULL;
+    ALTER TABLE transactions_legacy ALTER COLUMN created_at SET NOT NULL,
+        DROP CONSTRAINT transactions_pkey,
+        ADD PRIMARY KEY (id, created_at);
+
+    CREATE TABLE transactions (
+        id INTEGER NOT NULL DEFAULT nextval('transactions_id_seq'),
+        player_id INTEGER REFERENCES players(id),
+        type VARCHAR(50) NOT NULL,
+        amount DECIMAL(10, 4) NOT NULL,
+        description TEXT,
+        created_at TIMESTAMP NOT NULL DEFAULT NOW(),
+        PRIMARY KEY (id, created_at)
+    ) PARTITION BY RANGE (created_at);
+    ALTER SEQUENCE transactions_id_seq OWNED BY transactions.id;
+
+    -- Индекс истории игрока с id для keyset-пагинации
+    CREATE INDEX idx_transactions_player ON transactions (player_id, created_at DESC, id DESC);
+
+    SELECT date_trunc('month', GREATEST(MAX(created_at), LOCALTIMESTAMP)) + INTERVAL '1 month'
+    INTO boundary FROM transactions_legacy;
+    EXECUTE format(
+        'ALTER TABLE transactions ATTACH PARTITION transactions_legacy FOR VALUES FROM (MINVALUE) TO (%L)',
+        boundary
+    );
+    CREATE TABLE transactions_default PARTITION OF transactions DEFAULT;
+    FOR i IN 0..2 LOOP
+        PERFORM create_month_partition('transactions', (boundary + i * INTERVAL '1 month')::date);
+    END LOOP;
+END $$;
+
+DO $$
+DECLARE
+    boundary DATE;
+BEGIN
+    IF EXISTS (SELECT 1 FROM pg_partitioned_table WHERE partrelid = 'gold_harvests'::regclass) THEN
+        RETURN;
+    END IF;
+
+    ALTER TABLE gold_harvests RENAME TO gold_harvests_legacy;
+    DROP INDEX IF EXISTS idx_harvests_player;
+    UPDATE gold_harvests_legacy SET harvested_at = NOW() WHERE harvested_at IS NULL;
+    ALTER TABLE gold_harvests_legacy ALTER COLUMN harvested_at SET NOT NULL,
+        DROP CONSTRAINT gold_harvests_pkey,
+        ADD PRIMARY KEY (id, harvested_at);
+
+    CREATE TABLE gold_harvests (
+        id INTEGER NOT NULL DEFAULT nextval('gold_harvests_id_seq'),
+        player_id INTEGER REFERENCES players(id),
+        gold_earned DECIMAL(10, 2) NOT NULL,
+        goblins_count INTEGER NOT NULL,
+        harvested_at TIMESTAMP NOT NULL DEFAULT NOW(),
+        PRIMARY KEY (id, harvested_at)
+    ) PARTITION BY RANGE (harvested_at);
+    ALTER SEQUENCE gold_harvests_id_seq OWNED BY gold_harvests.id;
+
+    CREATE INDEX idx_harvests_player ON gold_harvests (player_id, harvested_at DESC);
+
+    SELECT date_trunc('month', GREATEST(MAX(harvested_at), LOCALTIMESTAMP)) + INTERVAL '1 month'
+    INTO boundary FROM gold_harvests_legacy;
+    EXECUTE format(
+        'ALTER TABLE gold_harvests ATTACH PARTITION gold_harvests_legacy FOR VALUES FROM (MINVALUE) TO (%L)',
+        boundary
+    );
+    CREATE TABLE gold_harvests_default PARTITION OF gold_harvests DEFAULT;
+    FOR i IN 0..2 LOOP
+        PERFORM create_month_partition('gold_harvests', (boundary + i * INTERVAL '1 month')::date);
+    END LOOP;
+END $$;
+
+-- Дневные итоги начислений: сюда сворачиваются секции gold_harvests старше
+-- срока хранения подробной истории, после чего секции удаляются
+CREATE TABLE IF NOT EXISTS gold_harvest_daily (
+    player_id INTEGER NOT NULL REFERENCES players(id),
+    day DATE NOT NULL,
+    gold_earned DECIMAL(14, 2) NOT NULL,
+    harvests INTEGER NOT NULL,
+    PRIMARY KEY (player_id, day)
+);
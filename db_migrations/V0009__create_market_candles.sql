@@ -0,0 +1,30 @@
+-- Свечи OHLC по сделкам маркета (объявления и книга заявок): обновляются
+-- в транзакции каждой продажи, по одной строке на интервал и начало корзины
+CREATE TABLE IF NOT EXISTS market_candles (
+    resolution VARCHAR(3) NOT NULL CHECK (resolution IN ('1m', '1h', '1d')),
+    bucket TIMESTAMP NOT NULL,
+    open DECIMAL(10, 4) NOT NULL,
+    high DECIMAL(10, 4) NOT NULL,
+    low DECIMAL(10, 4) NOT NULL,
+    close DECIMAL(10, 4) NOT NULL,
+    volume DECIMAL(16, 2) NOT NULL,
+    turnover DECIMAL(18, 4) NOT NULL,
+    trades INTEGER NOT NULL,
+    PRIMARY KEY (resolution, bucket)
+);
+
+-- Начальное заполнение по уже совершённым сделкам
+INSERT INTO market_candles (resolution, bucket, open, high, low, close, volume, turnover, trades)
+SELECT r.resolution, date_trunc(r.unit, s.sold_at),
+       (array_agg(s.price ORDER BY s.sold_at, s.n))[1], MAX(s.price), MIN(s.price),
+       (array_agg(s.price ORDER BY s.sold_at DESC, s.n DESC))[1],
+       SUM(s.amount), SUM(s.total), COUNT(*)
+FROM (VALUES ('1m', 'minute'), ('1h', 'hour'), ('1d', 'day')) r(resolution, unit)
+CROSS JOIN (
+    SELECT id AS n, updated_at AS sold_at, price_per_kg AS price, gold_amount AS amount, total_price AS total
+    FROM market_listings WHERE status = 'sold'
+    UNION ALL
+    SELECT id, created_at, price_per_kg, gold_amount, total_price FROM market_trades
+) s
+GROUP BY r.resolution, r.unit, date_trunc(r.unit, s.sold_at)
+ON CONFLICT (resolution, bucket) DO NOTHING;
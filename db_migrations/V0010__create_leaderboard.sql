@@ -0,0 +1,23 @@
+-- Снимок рейтинга игроков: первые позиции целиком и дальше каждая N-я позиция
+-- как граница корзины. По снимку место игрока ищется двумя проходами индекса
+-- по value; снимок пересчитывает leaderboard.py по крону
+CREATE TABLE IF NOT EXISTS leaderboard_ranks (
+    metric VARCHAR(10) NOT NULL CHECK (metric IN ('goblins', 'gold')),
+    position INTEGER NOT NULL,
+    rank INTEGER NOT NULL,
+    player_id INTEGER NOT NULL,
+    player_tag VARCHAR(4) NOT NULL,
+    value DECIMAL(16, 2) NOT NULL,
+    PRIMARY KEY (metric, position)
+);
+
+CREATE INDEX IF NOT EXISTS idx_leaderboard_value ON leaderboard_ranks(metric, value DESC, position);
+CREATE INDEX IF NOT EXISTS idx_leaderboard_player ON leaderboard_ranks(player_id, metric);
+
+-- Время и размер последнего пересчёта по каждому рейтингу
+CREATE TABLE IF NOT EXISTS leaderboard_state (
+    metric VARCHAR(10) PRIMARY KEY,
+    players INTEGER NOT NULL,
+    top_size INTEGER NOT NULL,
+    refreshed_at TIMESTAMP NOT NULL
+);
@@ -0,0 +1,10 @@
+-- Общие корзины жетонов ограничения частоты запросов (RATE_LIMIT_BACKEND=table
+-- у game-api). Строка на ключ; жетоны пополняются при следующем обращении
+CREATE TABLE IF NOT EXISTS rate_limits (
+    bucket_key VARCHAR(150) PRIMARY KEY,
+    tokens DOUBLE PRECISION NOT NULL,
+    updated_at TIMESTAMP NOT NULL DEFAULT clock_timestamp()
+);
+
+-- Для очистки давно не обновлявшихся корзин
+CREATE INDEX IF NOT EXISTS idx_rate_limits_updated ON rate_limits (updated_at);
@@ -0,0 +1,29 @@
+-- Покупки объявлений между узлами (backend/market-api/transfer.py).
+-- Исходящая запись живёт на узле объявления: объявление на время покупки
+-- получает статус 'reserved', а запись — исход сделки
+ALTER TABLE market_listings DROP CONSTRAINT IF EXISTS market_listings_status_check;
+ALTER TABLE market_listings ADD CONSTRAINT market_listings_status_check
+    CHECK (status IN ('active', 'reserved', 'sold', 'cancelled'));
+
+CREATE TABLE IF NOT EXISTS shard_transfers (
+    id UUID PRIMARY KEY,
+    listing_id INTEGER NOT NULL,
+    buyer_shard INTEGER NOT NULL,
+    buyer_user_id VARCHAR(100) NOT NULL,
+    total_price DECIMAL(10, 4) NOT NULL,
+    fee DECIMAL(10, 4) NOT NULL,
+    state VARCHAR(20) NOT NULL DEFAULT 'reserved' CHECK (state IN ('reserved', 'settled', 'cancelled')),
+    created_at TIMESTAMP NOT NULL DEFAULT NOW(),
+    updated_at TIMESTAMP NOT NULL DEFAULT NOW()
+);
+
+-- Незавершённые покупки для восстановления после сбоя
+CREATE INDEX IF NOT EXISTS idx_shard_transfers_reserved ON shard_transfers (created_at) WHERE state = 'reserved';
+
+-- Входящая запись на узле покупателя: 'applied' пишется вместе со списанием,
+-- 'aborted' — при отмене; первая записанная решает исход покупки
+CREATE TABLE IF NOT EXISTS shard_inbox (
+    transfer_id UUID PRIMARY KEY,
+    state VARCHAR(20) NOT NULL CHECK (state IN ('applied', 'aborted')),
+    created_at TIMESTAMP NOT NULL DEFAULT NOW()
+);
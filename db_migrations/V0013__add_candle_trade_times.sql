@@ -0,0 +1,5 @@
+-- Время первой и последней сделки корзины на узле: по нему свечи нескольких
+-- узлов сливаются в одну (open — самой ранней сделки, close — самой поздней).
+-- У корзин, записанных до миграции, вместо времени берётся начало корзины
+ALTER TABLE market_candles ADD COLUMN IF NOT EXISTS opened_at TIMESTAMP;
+ALTER TABLE market_candles ADD COLUMN IF NOT EXISTS closed_at TIMESTAMP;
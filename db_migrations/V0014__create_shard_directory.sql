@@ -0,0 +1,16 @@
+-- Разметка узлов (backend/*/shards.py, tools/shards.py); читается с первого узла.
+-- Объявления с id ниже listings_below созданы до первой разметки и лежат на legacy_shard
+CREATE TABLE IF NOT EXISTS shard_layout (
+    id INTEGER PRIMARY KEY CHECK (id = 1),
+    shards INTEGER NOT NULL,
+    listings_below INTEGER NOT NULL,
+    legacy_shard INTEGER NOT NULL,
+    provisioned_at TIMESTAMP NOT NULL DEFAULT NOW()
+);
+
+-- Игроки, которые живут не на узле, выбранном кольцом: они были в базе до
+-- разметки или до добавления узла и остаются там, где лежат их данные
+CREATE TABLE IF NOT EXISTS shard_directory (
+    user_id VARCHAR(100) PRIMARY KEY,
+    shard INTEGER NOT NULL
+);
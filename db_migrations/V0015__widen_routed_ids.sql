@@ -0,0 +1,20 @@
+-- id игроков и объявлений выдаются с шагом ID_STRIDE (tools/shards.py), и
+-- INTEGER хватило бы узлу лишь на 2^31 / ID_STRIDE значений. Ключи и все
+-- ссылки на них переводятся в BIGINT; последовательности — тоже, их предел
+-- меняется вместе с типом
+ALTER SEQUENCE players_id_seq AS BIGINT;
+ALTER SEQUENCE market_listings_id_seq AS BIGINT;
+
+ALTER TABLE players ALTER COLUMN id TYPE BIGINT;
+ALTER TABLE market_listings ALTER COLUMN id TYPE BIGINT,
+    ALTER COLUMN seller_id TYPE BIGINT;
+ALTER TABLE transactions ALTER COLUMN player_id TYPE BIGINT;
+ALTER TABLE gold_harvests ALTER COLUMN player_id TYPE BIGINT;
+ALTER TABLE gold_harvest_daily ALTER COLUMN player_id TYPE BIGINT;
+ALTER TABLE market_orders ALTER COLUMN player_id TYPE BIGINT;
+ALTER TABLE market_trades ALTER COLUMN buyer_id TYPE BIGINT,
+    ALTER COLUMN seller_id TYPE BIGINT;
+ALTER TABLE leaderboard_ranks ALTER COLUMN player_id TYPE BIGINT;
+ALTER TABLE harvest_settlement_state ALTER COLUMN last_player_id TYPE BIGINT;
+ALTER TABLE shard_transfers ALTER COLUMN listing_id TYPE BIGINT;
+ALTER TABLE shard_layout ALTER COLUMN listings_below TYPE BIGINT;
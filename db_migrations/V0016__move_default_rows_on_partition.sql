@@ -0,0 +1,81 @@
+-- Если задача обслуживания пропустила месяц, его строки уже лежат в секции
+-- DEFAULT, и CREATE TABLE ... PARTITION OF на этот месяц падает. Теперь такие
+-- строки переносятся: секция создаётся отдельной таблицей, строки месяца
+-- переезжают в неё из DEFAULT, и она подключается к родителю. Вставки в DEFAULT
+-- ждут до конца транзакции, чтобы ATTACH не застал там новые строки месяца
+
+-- Помесячная секция parent_YYYY_MM; возвращает имя секции
+CREATE OR REPLACE FUNCTION create_month_partition(parent TEXT, month DATE) RETURNS TEXT AS $$
+DECLARE
+    start_at DATE := date_trunc('month', month)::date;
+    end_at DATE := (date_trunc('month', month) + INTERVAL '1 month')::date;
+    partition_name TEXT := parent || '_' || to_char(start_at, 'YYYY_MM');
+    key_column TEXT;
+    default_partition REGCLASS;
+    stray BOOLEAN := false;
+BEGIN
+    IF to_regclass(partition_name) IS NOT NULL THEN
+        RETURN partition_name;
+    END IF;
+
+    SELECT a.attname, NULLIF(pt.partdefid, 0)::regclass
+    INTO key_column, default_partition
+    FROM pg_partitioned_table pt
+    JOIN pg_attribute a ON a.attrelid = pt.partrelid AND a.attnum = pt.partattrs[0]
+    WHERE pt.partrelid = parent::regclass;
+
+    IF default_partition IS NOT NULL THEN
+        EXECUTE format('LOCK TABLE %s IN SHARE ROW EXCLUSIVE MODE', default_partition);
+        EXECUTE format(
+            'SELECT EXISTS (SELECT 1 FROM %s WHERE %I >= %L AND %I < %L)',
+            default_partition, key_column, start_at, key_column, end_at
+        ) INTO stray;
+    END IF;
+
+    IF NOT stray THEN
+        EXECUTE format(
+            'CREATE TABLE %I PARTITION OF %I FOR VALUES FROM (%L) TO (%L)',
+            partition_name, parent, start_at, end_at
+        );
+        RETURN partition_name;
+    END IF;
+
+    EXECUTE format(
+        'CREATE TABLE %I (LIKE %I INCLUDING DEFAULTS INCLUDING CONSTRAINTS)',
+        partition_name, parent
+    );
+    EXECUTE format(
+        'WITH moved AS (DELETE FROM %s WHERE %I >= %L AND %I < %L RETURNING *) '
+        'INSERT INTO %I SELECT * FROM moved',
+        default_partition, key_column, start_at, key_column, end_at, partition_name
+    );
+    EXECUTE format(
+        'ALTER TABLE %I ATTACH PARTITION %I FOR VALUES FROM (%L) TO (%L)',
+        parent, partition_name, start_at, end_at
+    );
+    RETURN partition_name;
+END;
+$$ LANGUAGE plpgsql;
+
+-- Проверка на пустой таблице: строка пропущенного месяца из DEFAULT должна
+-- оказаться в новой секции
+DO $$
+DECLARE
+    moved BIGINT;
+    left_behind BIGINT;
+BEGIN
+    CREATE TABLE partition_check (at TIMESTAMP NOT NULL) PARTITION BY RANGE (at);
+    CREATE TABLE partition_check_default PARTITION OF partition_check DEFAULT;
+    INSERT INTO partition_check VALUES ('2000-01-15'), ('2000-02-15');
+
+    PERFORM create_month_partition('partition_check', '2000-01-01');
+    PERFORM create_month_partition('partition_check', '2000-03-01');
+
+    SELECT count(*) INTO moved FROM partition_check_2000_01;
+    SELECT count(*) INTO left_behind FROM partition_check_default;
+    DROP TABLE partition_check;
+
+    IF moved <> 1 OR left_behind <> 1 THEN
+        RAISE EXCEPTION 'create_month_partition: перенесено %, осталось в DEFAULT %', moved, left_behind;
+    END IF;
+END $$;